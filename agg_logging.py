@@ -30,7 +30,13 @@ def pretty_printer_compact():
     else:
         return pprint.PrettyPrinter(indent=4, compact=True, width=210)
 
+def flush():
+    if out_file != None:
+        out_file.flush()
+
 def close():
+    global out_file
     if out_file != None:
         out_file.close()
+        out_file = None
 
@@ -6,19 +6,31 @@ import json
 from tqdm import tqdm
 import pprint
 import math
+import numpy as np
 
 from . import agg_logging as log
+from . import crosswalk
+from . import json_stream
 
-def handle_field(dest_block_map, dest_key, ok_to_agg, result_props, props_total, props_count, key, value):
+def handle_field(dest_block_map, dest_key, ok_to_agg, result_props, props_total, props_count, key, value, plan=None):
+  """
+  Adds the fields (value) of block key to its dest in result_props
+  plan: {prop: True/False} of props already checked (prop != dest_key and ok_to_agg), filled in as new props are seen
+  """
   if not (key in dest_block_map):
     tot = value["TOT"] if "TOT" in value else 0
     log.dprint("blk not in map: " + key + ", Tot: " + str(tot))
   else:
-    vtd = dest_block_map[key]
+    vtd = crosswalk.block_dest(dest_block_map, key)
     if not (vtd in result_props):
         result_props[vtd] = {dest_key: vtd}
     for prop, prop_value in value.items():
-        if prop != dest_key and ok_to_agg(prop):
+        keep = plan.get(prop) if plan != None else None
+        if keep == None:
+            keep = prop != dest_key and ok_to_agg(prop)
+            if plan != None:
+                plan[prop] = keep
+        if keep:
             try:
                 if math.isnan(prop_value):
                     prop_value = 0
@@ -40,45 +52,185 @@ def handle_field(dest_block_map, dest_key, ok_to_agg, result_props, props_total,
               log.dprint("Non number prop: ", prop)
 
 
-def make_aggregated_props(block_props_path, dest_block_map_path, dest_key, ok_to_agg, srcIsGeojson=False):
+def make_accumulator(dest_block_map, dest_key, ok_to_agg, registry=None):
     """
-        block_props: block fields to be aggregated {blkid: {field1: value1, ...}}  [if not SrcIsGeojson]
-        dest_block_map: map of block to containing larger geo (e.g. precinct) {blkid: dest_key}
+        Accumulator for aggregating blocks into dests: blocks go in with add_block (or add_block_props, or the crosswalk versions),
+        and make_feature_collection makes the result
+        dest_block_map: map of block to containing larger geo (e.g. precinct) {blkid: dest_key} (or {blkid: [dest_key]})
+        registry: block registry ==> dest_block_map is compact, dest codes by block ordinal (see block_registry.make_dest_codes),
+            and blocks go in with the crosswalk versions only (add_block_props and add_blocks use them whatever the engine)
+    """
+    return {"dest_block_map": dest_block_map, "dest_key": dest_key, "ok_to_agg": ok_to_agg, "result_props": {}, "props_total": {}, "props_count": {}, "plan": {},
+            "registry": registry}
 
-        Return geojson with empty geometry and all of the aggregated properties {..., features: [{properties: {dest_key: id, field1: value1, ...}, ...]}
+
+def add_block(acc, key, value):
+    """
+        Adds block key with fields value {field1: value1, ...} into accumulator acc; a block can be added more than once
+        (e.g. once for each precinct it gets values from), with the same result as adding the summed fields
     """
+    handle_field(acc["dest_block_map"], acc["dest_key"], acc["ok_to_agg"], acc["result_props"], acc["props_total"], acc["props_count"], key, value, acc["plan"])
 
-    with open(block_props_path) as json_file:
-        block_props = json.load(json_file)
-    with open(dest_block_map_path) as json_file2:
-        dest_block_map = json.load(json_file2)
 
-    log.dprint("Build map {dest_key: {field1: value1, ...}")
-    print("Build map {dest_key: {field1: value1, ...}")
-    result_props = {}
-    props_total = {}
-    props_count = {}
+def add_block_props(acc, block_props, srcIsGeojson=False, engine="dict"):
+    """
+        Adds all blocks of block_props {blkid: {field1: value1, ...}} (or geojson features with GEOID, if srcIsGeojson) into accumulator acc
+        engine: "dict" ==> handle_field for each block; "crosswalk" ==> sparse reduction (see crosswalk.add_block_rows), same result
+    """
+    add_block_props_multi([acc], block_props, srcIsGeojson, engine)
+
+
+def add_block_props_multi(accs, block_props, srcIsGeojson=False, engine="dict"):
+    """
+        add_block_props into each accumulator of accs (one per dest geography), in one scan of the blocks
+    """
     if not srcIsGeojson:
-        for key, value in tqdm(block_props.items()):
-            handle_field(dest_block_map, dest_key, ok_to_agg, result_props, props_total, props_count, key, value)
+        block_keys, block_rows = list(block_props.keys()), list(block_props.values())
     else:
-        for feature in tqdm(block_props["features"]):
-            props = feature["properties"]
-            geoid = props["GEOID"]
-            handle_field(dest_block_map, dest_key, ok_to_agg, result_props, props_total, props_count, geoid, props)
+        block_rows = [feature["properties"] for feature in block_props["features"]]
+        block_keys = [props["GEOID"] for props in block_rows]
+    add_blocks(accs, block_keys, block_rows, engine)
 
 
+def add_blocks(accs, blocks, rows, engine="dict", progress=True):
+    """
+        Adds blocks (list of blkids) with their fields (rows, list of {field1: value1, ...}) into each accumulator of accs
+    """
+    if engine == "crosswalk" or any(acc["registry"] != None for acc in accs):
+        crosswalk.add_block_rows_multi(accs, blocks, rows)
+    else:
+        for key, value in tqdm(zip(blocks, rows), total=len(blocks), disable=not progress):
+            for acc in accs:
+                add_block(acc, key, value)
+
+
+def make_feature_collection(acc):
+    """
+        Return geojson with empty geometry and all of the aggregated properties of accumulator acc
+            {..., features: [{properties: {dest_key: id, field1: value1, ...}, ...]}
+    """
     pp = log.pretty_printer()
     log.dprint("Props totals")
-    pp.pprint(props_total)        
+    pp.pprint(acc["props_total"])
 
     log.dprint("Props Count")
-    pp.pprint(props_count)        
+    pp.pprint(acc["props_count"])
 
     print("Build geojson")
     features = []
-    for vtd, props in tqdm(result_props.items()):
+    for vtd, props in tqdm(acc["result_props"].items()):
         features.append({'type': 'Feature', 'geometry': None, 'properties': props})
 
     return {'type': 'FeatureCollection', 'features': features}
-        
+
+
+def make_dest_index(dest_block_map_path, chunk_blocks=100000):
+    """
+        Compact block ==> dest lookup, read incrementally from dest_block_map_path ({blkid: dest_key} or {blkid: [dest_key]}):
+        returns (block_ids, dest_codes, dests): the block ids sorted (bytes array), the dest of each (int32 code, index into dests),
+        and the list of dests; a few bytes per block instead of a dict entry, strings and list per block
+    """
+    dest_codes_map = {}
+    id_chunks = []
+    code_chunks = []
+    ids = []
+    codes = []
+    for block, dest in json_stream.iter_items(dest_block_map_path):
+        ids.append(block.encode())
+        codes.append(dest_codes_map.setdefault(dest[0] if isinstance(dest, list) else dest, len(dest_codes_map)))
+        if len(ids) >= chunk_blocks:
+            id_chunks.append(np.array(ids))
+            code_chunks.append(np.array(codes, dtype=np.int32))
+            ids = []
+            codes = []
+    id_chunks.append(np.array(ids, dtype=bytes))
+    code_chunks.append(np.array(codes, dtype=np.int32))
+    block_ids = np.concatenate(id_chunks)
+    dest_codes = np.concatenate(code_chunks)
+    order = np.argsort(block_ids, kind='stable')
+    return block_ids[order], dest_codes[order], list(dest_codes_map.keys())
+
+
+def lookup_dests(dest_index, blocks):
+    """
+        {blkid: dest_key} for the blocks (list of blkids) that are in dest_index (see make_dest_index); for a block that's in
+        the map more than once, the last one (as json.load would give)
+    """
+    block_ids, dest_codes, dests = dest_index
+    if len(blocks) == 0 or len(block_ids) == 0:
+        return {}
+    keys = np.array([block.encode() for block in blocks])
+    found = np.searchsorted(block_ids, keys, side='right') - 1
+    ok = (found >= 0) & (block_ids[np.maximum(found, 0)] == keys)
+    codes = dest_codes[found[ok]].tolist()
+    return {block: dests[code] for block, code in zip([block for block, in_map in zip(blocks, ok.tolist()) if in_map], codes)}
+
+
+def stream_block_props(accs, block_props_path, dest_indexes, srcIsGeojson=False, engine="dict", batch_size=10000):
+    """
+        Adds the blocks of the file at block_props_path into each accumulator of accs (as add_block_props_multi), reading them incrementally
+        (see json_stream.iter_items) in batches of batch_size blocks; each batch gets its own block ==> dest map from the acc's dest_indexes entry
+        block_props_path can also be the block data itself, in memory
+    """
+    if isinstance(block_props_path, str):
+        items = json_stream.iter_items(block_props_path, "features" if srcIsGeojson else None)
+    else:
+        items = enumerate(block_props_path["features"]) if srcIsGeojson else block_props_path.items()
+    blocks = []
+    rows = []
+    for key, value in tqdm(items):
+        if srcIsGeojson:
+            value = value["properties"]
+            key = value["GEOID"]
+        blocks.append(key)
+        rows.append(value)
+        if len(blocks) >= batch_size:
+            add_block_batch(accs, dest_indexes, blocks, rows, engine)
+            blocks = []
+            rows = []
+    add_block_batch(accs, dest_indexes, blocks, rows, engine)
+
+
+def add_block_batch(accs, dest_indexes, blocks, rows, engine="dict"):
+    if len(blocks) == 0:
+        return
+    for acc, dest_index in zip(accs, dest_indexes):
+        acc["dest_block_map"] = lookup_dests(dest_index, blocks)
+    add_blocks(accs, blocks, rows, engine, progress=False)
+
+
+def make_aggregated_props(block_props_path, dest_block_map_path, dest_key, ok_to_agg, srcIsGeojson=False, engine="dict", stream=False):
+    """
+        block_props: block fields to be aggregated {blkid: {field1: value1, ...}}  [if not SrcIsGeojson]
+        dest_block_map: map of block to containing larger geo (e.g. precinct) {blkid: dest_key} (or {blkid: [dest_key]})
+        engine: "dict" or "crosswalk" (see add_block_props), same result
+        stream: True ==> neither file is loaded whole: the dest map becomes a compact sorted block id array (make_dest_index)
+            and the blocks are read and aggregated a batch at a time (stream_block_props), so memory goes with the number of dests
+
+        Return geojson with empty geometry and all of the aggregated properties {..., features: [{properties: {dest_key: id, field1: value1, ...}, ...]}
+    """
+    return make_aggregated_props_multi(block_props_path, [(dest_block_map_path, dest_key)], ok_to_agg, srcIsGeojson, engine, stream)[0]
+
+
+def make_aggregated_props_multi(block_props_path, targets, ok_to_agg, srcIsGeojson=False, engine="dict", stream=False):
+    """
+        make_aggregated_props for many dest geographies (precincts, counties, districts, ...) with one read and scan of the block data
+        targets: list of (dest_block_map_path, dest_key)
+        block_props_path and the dest_block_map_paths can also be the block data and maps themselves, already in memory;
+            then there's nothing to stream, and they're used as they are
+        A dest_block_map_path can also be a compact dest index (see make_dest_index, block_registry.make_dest_index) if they all are;
+            then the blocks are looked up in the indexes a batch at a time, as when streaming
+        Returns a list of geojsons, one for each target
+    """
+    indexed = all(isinstance(path, tuple) for path, dest_key in targets)
+    stream = stream and isinstance(block_props_path, str) and all(isinstance(path, str) for path, dest_key in targets)
+    log.dprint("Build map {dest_key: {field1: value1, ...}" + (" (streaming)" if stream else "") + " for: ", [dest_key for path, dest_key in targets])
+    print("Build map {dest_key: {field1: value1, ...}")
+    if stream or indexed:
+        accs = [make_accumulator({}, dest_key, ok_to_agg) for path, dest_key in targets]
+        stream_block_props(accs, block_props_path, [path if indexed else make_dest_index(path) for path, dest_key in targets], srcIsGeojson, engine)
+    else:
+        block_props = json_stream.load(block_props_path)
+        accs = [make_accumulator(json_stream.load(dest_block_map_path), dest_key, ok_to_agg) for dest_block_map_path, dest_key in targets]
+        add_block_props_multi(accs, block_props, srcIsGeojson, engine)
+    return [make_feature_collection(acc) for acc in accs]
@@ -0,0 +1,91 @@
+# Largest remainder (Hamilton) apportionment with NumPy
+#
+# Apportions whole props (columns of values) over the blocks of a precinct -- or of many precincts at once -- as 2-D arrays:
+# each block gets floor(value * pct), then the blocks with the largest remainders get 1 more until the precinct's value is used up.
+# The top remainders are found by partial selection (np.partition) rather than sorting, and ties go to the earlier block,
+# so the result is the same as disaggregate.distribute_value gives one (precinct, prop) at a time.
+#
+
+import numpy as np
+
+def segment_sums(entry_values, indptr):
+    """
+    Sums of the rows of entry_values (entries x cols) over each segment (entries indptr[s]:indptr[s+1]); exact for integer-valued floats
+    """
+    cum = np.vstack([np.zeros((1, entry_values.shape[1])), np.cumsum(entry_values, axis=0)])
+    return cum[indptr[1:]] - cum[indptr[:-1]]
+
+def top_remainders(rem, indptr, counts, extra):
+    """
+    rem: remainders (entries x cols); extra: number of entries of each segment that get 1 more (segments x cols)
+    Returns bool (entries x cols): True for the extra largest remainders of each segment (ties: earlier entry first).
+    Segments of the same length are handled together: np.partition finds the extra-th largest remainder (the threshold),
+    then entries above it are in, and entries equal to it are in, in order, until the segment's extra is reached.
+    """
+    bonus = np.zeros(rem.shape, dtype=bool)
+    for length in np.unique(counts).tolist():
+        if length == 0:
+            continue
+        segs = np.flatnonzero(counts == length)
+        seg_extra = np.clip(extra[segs], 0, length)                 # (segs x cols)
+        if not seg_extra.any():
+            continue
+        idx = indptr[segs][:, None] + np.arange(length)             # (segs x length)
+        seg_rem = rem[idx]                                          # (segs x length x cols)
+        choose = (seg_extra > 0) & (seg_extra < length)
+        sel = np.broadcast_to((seg_extra >= length)[:, None, :], seg_rem.shape).copy()
+        if choose.any():
+            kth_pos = length - np.clip(seg_extra, 1, length)         # ascending position of the extra-th largest
+            part = np.partition(seg_rem, np.unique(kth_pos[choose]), axis=1)
+            threshold = np.take_along_axis(part, kth_pos[:, None, :], axis=1)
+            above = seg_rem > threshold
+            tied = seg_rem == threshold
+            need = seg_extra - above.sum(axis=1)
+            chosen = above | (tied & (np.cumsum(tied, axis=1) <= need[:, None, :]))
+            sel |= chosen & choose[:, None, :]
+        bonus[idx] = sel
+    return bonus
+
+def largest_remainder_segments(pcts, indptr, values, chunk_elements=1 << 23):
+    """
+    Apportions values (int, segments x props) over segments of entries with pcts: segment s (e.g. a precinct) owns entries
+    (e.g. its blocks) pcts[indptr[s]:indptr[s+1]].
+    Returns (result, lacking): result (int64, entries x props) sums to values over each segment, and lacking (int64, segments x props)
+    is what couldn't be given out (only when a segment's pcts sum to less than 1); props are done chunk_elements at a time
+    """
+    pcts = np.asarray(pcts, dtype=np.float64)
+    indptr = np.asarray(indptr, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    counts = np.diff(indptr)
+    segs = np.repeat(np.arange(len(counts)), counts)
+    result = np.zeros((len(pcts), values.shape[1]), dtype=np.int64)
+    lacking = np.zeros(values.shape, dtype=np.int64)
+    chunk = max(1, chunk_elements // max(1, len(pcts)))
+    for start in range(0, values.shape[1], chunk):
+        chunk_values = values[:, start:start + chunk]
+        exact = pcts[:, None] * chunk_values[segs]
+        whole = np.floor(exact)
+        extra = chunk_values - segment_sums(whole, indptr).astype(np.int64)
+        bonus = top_remainders(exact - whole, indptr, counts, extra)
+        result[:, start:start + chunk] = whole.astype(np.int64) + bonus
+        lacking[:, start:start + chunk] = np.maximum(extra - counts[:, None], 0)
+    return result, lacking
+
+def largest_remainder(pcts, values):
+    """
+    Apportions each of values (ints, one per prop) over the blocks of one precinct, with pcts (one per block)
+    Returns (result, lacking): result (int64, blocks x props) and lacking (int64, per prop) as for largest_remainder_segments
+    """
+    result, lacking = largest_remainder_segments(pcts, [0, len(pcts)], np.asarray(values, dtype=np.int64).reshape(1, -1))
+    return result, lacking[0]
+
+def weight_groups(props, prop_weights=None, weight_columns=()):
+    """
+    Groups props (list of names) by the weight column they're apportioned with: {column: [prop index, ...], ...}
+    prop_weights {prop: column}; props without a column, or whose column isn't in weight_columns, are in group None (the default pcts)
+    """
+    groups = {}
+    for p, prop in enumerate(props):
+        column = prop_weights.get(prop) if prop_weights else None
+        groups.setdefault(column if column in weight_columns else None, []).append(p)
+    return groups
@@ -3,13 +3,19 @@
 # 2019
 #
 import pandas as pd
+import numpy as np
 from tqdm import tqdm
 
 import geopandas as gpd
+import shapely
+from shapely.geometry import box
+from shapely.prepared import prep
 import pprint
 import json
+from concurrent.futures import ProcessPoolExecutor
 
 from . import agg_logging as log
+from . import geo_cache
 
 # Special work for Florida
 flcounty_map = {
@@ -26,7 +32,18 @@ def cntyid(countyfp):
     return flcounty_map[countyfp]
 
 
-def make_target_source_allmap(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData):
+def is_interior(prepared_source, target_shape):
+    """
+    True if target_shape lies strictly inside the (prepared) source shape.
+    The target's bounding box is tried first, since it is a cheap test that settles most interior blocks.
+    """
+    try:
+        return prepared_source.contains_properly(box(*target_shape.bounds)) or prepared_source.contains_properly(target_shape)
+    except:
+        return False
+
+def make_target_source_allmap(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData, use_prepared=False, candidate_counts=None,
+                              geometry_repaired=False):
     """
     Function returns a map (dictionary) representing the mapping of target poly to source polys
     
@@ -36,6 +53,11 @@ def make_target_source_allmap(source, target, source_key, target_key, use_index_
         consisting of larger polygons
     target: GeoPandas GeoDataFrame
         consisting of smaller polygons typically expected to be contained in larger ones
+    use_prepared: True ==> targets strictly inside a prepared source shape get 1.0 without computing the intersection
+    candidate_counts: (pandas Series indexed like source) number of candidate targets of each source, when target is only part
+        of the targets (see make_target_source_allmap_sharded); a source gets 1.0 without intersecting only if it has a single candidate overall
+    geometry_repaired: True ==> source and target geometry already went thru geo_cache.repair_geometries: a target without area gets -1
+        (instead of the contains/overlaps fallback); an intersection that still throws gets the fallback, as without repair
 
     Outputs
     -------
@@ -59,19 +81,21 @@ def make_target_source_allmap(source, target, source_key, target_key, use_index_
     source_keys_in_set = set({})
     count_intersect_plus_failures = 0   # count if intersection throws exception and contains or overlaps throws, too
     count_intersect_failures = 0
+    count_interior = 0
     for i in tqdm(source.index):
         source_row_shape = source.loc[i, 'geometry']
         source_row_key = i if use_index_for_source_key else str(source.loc[i, source_key])
         source_key_set.add(source_row_key)
         if not hasattr(source_row_shape, 'bounds'):
             continue
+        prepared_shape = prep(source_row_shape) if use_prepared else None
 
         possible_matches = [target.index[m] for m in list(si.intersection(source_row_shape.bounds))]
         
         if len(possible_matches) == 0:
             match = None
             
-        elif len(possible_matches) == 1:
+        elif len(possible_matches) == 1 and (candidate_counts is None or candidate_counts[i] == 1):
             match = possible_matches[0]
             contains_map[target.loc[match, target_key]].append((source_row_key, 1.0))
             source_keys_in_set.add(source_row_key)
@@ -82,6 +106,15 @@ def make_target_source_allmap(source, target, source_key, target_key, use_index_
                 target_shape = target.loc[j, 'geometry']
                 target_loc_key = target.loc[j, target_key]
                 source_prec = None #source_prec = source.loc[source_row_key, 'PRECINCT']  # For matching precinct debugging
+                if prepared_shape != None and is_interior(prepared_shape, target_shape):
+                    count_interior += 1
+                    source_keys_in_set.add(source_row_key)
+                    contains_map[target_loc_key].append((source_row_key, 1.0, source_prec))
+                    continue
+                if geometry_repaired and not (target_shape.area > 0):
+                    source_keys_in_set.add(source_row_key)
+                    contains_map[target_loc_key].append((source_row_key, -1, source_prec))
+                    continue
                 try:
                     pct_in = source_row_shape.intersection(target_shape).area / target_shape.area
                     source_keys_in_set.add(source_row_key)
@@ -119,6 +152,7 @@ def make_target_source_allmap(source, target, source_key, target_key, use_index_
                 source_keys_not_in_map.add(srckey)
     log.dprint("Source keys not in map: ", len(source_keys_not_in_map))
 
+    # See assign_nearest_sources (nearest_fallback option of make_target_source_map) for a bulk version of this second pass
     if False: #  state == "FL" and (not isDemographicData):
         print("Begin Second Pass")
         source_keys_assigned_pass_2 = 0
@@ -140,23 +174,400 @@ def make_target_source_allmap(source, target, source_key, target_key, use_index_
 
     log.dprint("Intersect threw except count: ", count_intersect_failures)
     log.dprint("Intersect and Contains/Overlaps both threw except count: ", count_intersect_plus_failures)
+    if use_prepared:
+        log.dprint("Interior (no intersection needed) count: ", count_interior)
     log.dprint("Possible match count: ", count_in_possible_matches, "\n")
     return contains_map, source_key_set
 
-def make_target_source_map(larger_path, smaller_path, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, source_is_block_group=False):
+def overlap_fallback(source_shape, target_shape):
     """
-    Given two file paths to larger (precinct) and smaller (block) geometry, opens files and calls
-        make_target_source_allmap to produce tuple (contains_map, source_key_set)  (geometry files can be geojson or shapefile)
-    larger_key is a string key uniquely identifying the rows in larger_path
-    smaller_key is a string key uniquely identifying the rows in smaller_path
+    Overlap value used when intersecting two shapes throws (usually invalid geometry):
+        1.0 if source contains target, 0.5 if they overlap, -1 otherwise (or None if those throw, too)
+    """
+    try:
+        if source_shape.contains(target_shape):
+            return 1.0
+        elif source_shape.overlaps(target_shape):
+            return 0.5
+        else:
+            return -1
+    except:
+        return None
 
-    Then walk thru contains_map (whose values are arrays of {<smaller_key>: %overlap}), building final map of smaller_key: larger_key.
+def intersect_pairs(source_geoms, target_geoms, target_areas):
+    """
+    Vectorized overlap % of each (source, target) pair: area of intersection / area of target
+    Returns (pcts, intersected) where intersected is False for the pairs whose intersection failed (their pct is -1);
+    the pct of a target without area is NaN or inf
+    """
+    try:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pcts = shapely.area(shapely.intersection(source_geoms, target_geoms)) / target_areas
+        return pcts, np.ones(len(source_geoms), dtype=bool)
+    except:
+        # Some pair has bad geometry (even repaired geometry can make GEOS throw); work out which, pair by pair
+        pcts = np.full(len(source_geoms), -1.0)
+        intersected = np.zeros(len(source_geoms), dtype=bool)
+        for k in range(len(source_geoms)):
+            try:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    pcts[k] = np.float64(source_geoms[k].intersection(target_geoms[k]).area) / target_areas[k]
+                intersected[k] = True
+            except:
+                pass
+        return pcts, intersected
 
-    Note: if a block overlaps more than 1 precinct, it is assigned to the one with the greatest precentage overlap
+def interior_pairs(source_geoms, target_geoms):
+    """
+    Vectorized is_interior: True where the target (first its bounding box, then the shape itself) lies strictly inside the source.
+    Source geometries should already be prepared (shapely.prepare).
+    """
+    try:
+        boxes = shapely.box(*shapely.bounds(target_geoms).T)
+        interior = shapely.contains_properly(source_geoms, boxes)
+        rest = np.flatnonzero(~interior)
+        interior[rest] = shapely.contains_properly(source_geoms[rest], target_geoms[rest])
+        return interior
+    except:
+        return np.array([is_interior(source_shape, target_shape) for source_shape, target_shape in zip(source_geoms, target_geoms)], dtype=bool)
+
+def make_block_group_shapes(target, target_key, blkgrp_path=None, blkgrp_key=None):
+    """
+    Returns GeoDataFrame of block group shapes with the block group key (first 12 chars of block GEOID) in column 'blkgrp'
+    Read from blkgrp_path (keyed by blkgrp_key) when given, otherwise made by dissolving the blocks in target
+    """
+    if blkgrp_path != None:
+        blkgrp_shapes = geo_cache.read_columns(blkgrp_path, [blkgrp_key])
+        if blkgrp_shapes.crs and target.crs:
+            blkgrp_shapes = blkgrp_shapes.to_crs(target.crs)
+        blkgrp_shapes['blkgrp'] = blkgrp_shapes[blkgrp_key].astype(str)
+        return blkgrp_shapes[['blkgrp', 'geometry']]
+
+    print("Making map: Dissolve blocks into block groups")
+    blkgrp_shapes = target[[target_key, 'geometry']].copy()
+    blkgrp_shapes['blkgrp'] = blkgrp_shapes[target_key].str[0:12]
+    return blkgrp_shapes[['blkgrp', 'geometry']].dissolve(by='blkgrp').reset_index()
+
+def make_block_group_containers(source, blkgrp_shapes):
+    """
+    Returns {blkgrp: source position} for every block group that lies within exactly one source shape
+    (Assumes source shapes don't overlap each other, so no other source can have area in common with that block group)
+    """
+    bg_pos, src_pos = source.sindex.query(blkgrp_shapes.geometry.values, predicate="within")
+    within_counts = np.bincount(bg_pos, minlength=len(blkgrp_shapes.index))
+    blkgrp_keys = blkgrp_shapes['blkgrp'].tolist()
+    return {blkgrp_keys[b]: s for b, s in zip(bg_pos.tolist(), src_pos.tolist()) if within_counts[b] == 1}
+
+def make_target_source_allmap_bulk(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData, use_prepared=False, blkgrp_shapes=None, candidate_counts=None, target_areas=None,
+                                   geometry_repaired=False, chunk_size=100000):
+    """
+    Same result as make_target_source_allmap, but instead of a Python loop over the sources:
+        -- one bulk spatial index query produces all (source, target) candidate pairs as index arrays
+        -- overlap areas of all candidate pairs are computed with vectorized geometry operations (in chunks of chunk_size pairs)
+        -- contains_map is built from the resulting arrays
+    use_prepared: True ==> targets strictly inside a prepared source shape get 1.0 without computing the intersection
+    blkgrp_shapes: (see make_block_group_shapes) if given, block groups are tested against the sources first; blocks whose
+        block group lies within a single source get 1.0 for that source (-1 for the others) without any block-level geometry test
+    candidate_counts: as for make_target_source_allmap; when given (a shard), sources without blocks aren't logged here, since they may
+        have them in other shards (make_target_source_allmap_sharded logs them for the whole state)
+    target_areas: areas of the target shapes, if already computed (e.g. by an earlier map of the same targets)
+    geometry_repaired: as for make_target_source_allmap
+
+    Outputs
+    -------
+    dict with keys = target.<target_key> and values = [(source.<source_key>, <area %>, None)]
+    """
+    source_geoms = source.geometry.values
+    target_geoms = target.geometry.values
+    target_keys = target[target_key].tolist()
+    source_keys = np.empty(len(source.index), dtype=object)
+    source_keys[:] = source.index.tolist() if use_index_for_source_key else [str(key) for key in source[source_key].tolist()]
+    source_key_set = set(source_keys.tolist())
+
+    print("Making map: Initialize source/target overlap map")
+    contains_map = {key: [] for key in target_keys}  # {<target_key> : [(<source_key>, <%area>, None),...]}
+
+    print("Making map: Bulk query source/target candidate pairs")
+    src_idx, tgt_idx = target.sindex.query(source_geoms)
+    order = np.argsort(src_idx, kind="stable")   # keep the per-source order the loop version produces
+    src_idx = src_idx[order]
+    tgt_idx = tgt_idx[order]
+
+    # A source with a single candidate target gets 1.0, as in the loop version; the rest need the intersection area
+    shard_candidate_counts = np.bincount(src_idx, minlength=len(source_geoms))
+    all_candidate_counts = shard_candidate_counts if candidate_counts is None else candidate_counts.to_numpy()
+    pcts = np.ones(len(src_idx))
+    multi = np.flatnonzero(all_candidate_counts[src_idx] > 1)
+    count_in_possible_matches = len(multi)
+    if blkgrp_shapes is not None:
+        print("Making map: Intersect source and block group geometries")
+        blkgrp_containers = make_block_group_containers(source, blkgrp_shapes)
+        target_containers = np.array([blkgrp_containers.get(key[0:12], -1) for key in target_keys], dtype=np.int64)
+        pair_containers = target_containers[tgt_idx[multi]]
+        in_contained_blkgrp = pair_containers >= 0
+        pcts[multi[in_contained_blkgrp]] = np.where(src_idx[multi[in_contained_blkgrp]] == pair_containers[in_contained_blkgrp], 1.0, -1)
+        multi = multi[~in_contained_blkgrp]
+        log.dprint("Block groups within a single source: ", len(blkgrp_containers), " of ", len(blkgrp_shapes.index))
+        log.dprint("Blocks in those block groups: ", int((target_containers >= 0).sum()), " of ", len(target_keys))
+    if target_areas is None:
+        target_areas = shapely.area(target_geoms)
+    if use_prepared:
+        shapely.prepare(source_geoms)
+
+    print("Making map: Intersect source and target geometries")
+    count_intersect_plus_failures = 0
+    count_intersect_failures = 0
+    count_interior = 0
+    for start in tqdm(range(0, len(multi), chunk_size)):
+        pairs = multi[start:start + chunk_size]
+        chunk_src = source_geoms[src_idx[pairs]]
+        chunk_tgt = target_geoms[tgt_idx[pairs]]
+        chunk_areas = target_areas[tgt_idx[pairs]]
+        chunk_pcts = np.ones(len(pairs))
+        ok = np.ones(len(pairs), dtype=bool)
+        boundary = np.arange(len(pairs))
+        if use_prepared:
+            # Only blocks that aren't interior to the source need the (expensive) intersection
+            interior = interior_pairs(chunk_src, chunk_tgt)
+            count_interior += int(interior.sum())
+            boundary = np.flatnonzero(~interior)
+        chunk_pcts[boundary], ok[boundary] = intersect_pairs(chunk_src[boundary], chunk_tgt[boundary], chunk_areas[boundary])
+        without_area = np.zeros(len(pairs), dtype=bool)
+        without_area[boundary] = ~(chunk_areas[boundary] > 0)
+        if geometry_repaired:
+            chunk_pcts[ok & without_area] = -1
+        else:
+            ok &= ~without_area
+
+        # Same treatment the loop version gives to a failed intersection (or, without repair, a zero-area target)
+        for k in np.flatnonzero(~ok):
+            count_intersect_failures += 1
+            fallback = overlap_fallback(chunk_src[k], chunk_tgt[k])
+            if fallback == None:
+                log.dprint("Contains or Overlaps failed after Intersection failed")
+                count_intersect_plus_failures += 1
+                chunk_pcts[k] = np.nan
+            else:
+                chunk_pcts[k] = fallback
+        pcts[pairs] = np.where(np.isnan(chunk_pcts) | (chunk_pcts > 0), chunk_pcts, -1)
+
+    # Pairs where both intersection and contains/overlaps failed don't go in the map
+    keep = ~np.isnan(pcts)
+    pair_source_keys = source_keys[src_idx[keep]].tolist()
+    pair_target_keys = [target_keys[t] for t in tgt_idx[keep].tolist()]
+    for srckey, targkey, pct in zip(pair_source_keys, pair_target_keys, pcts[keep].tolist()):
+        contains_map[targkey].append((srckey, pct, None))
+
+    if candidate_counts is None:
+        log_sources_not_in_map(source_keys, shard_candidate_counts)
+
+    log.dprint("Intersect threw except count: ", count_intersect_failures)
+    log.dprint("Intersect and Contains/Overlaps both threw except count: ", count_intersect_plus_failures)
+    if use_prepared:
+        log.dprint("Interior (no intersection needed) count: ", count_interior)
+    log.dprint("Possible match count: ", count_in_possible_matches, "\n")
+    return contains_map, source_key_set
+
+def log_sources_not_in_map(source_keys, candidate_counts):
+    """
+    Logs the sources (source_keys, array) that no block maps to: the ones without any candidate blocks (candidate_counts, by source)
+    """
+    source_keys_in_set = set(source_keys[np.flatnonzero(candidate_counts)].tolist())
+    source_keys_not_in_map = set(source_keys.tolist()) - source_keys_in_set
+    for srckey in source_keys_not_in_map:
+        log.dprint("No blocks map to source: ", srckey)
+    log.dprint("Source keys not in map: ", len(source_keys_not_in_map))
+
+def make_allmap(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData, bulk_query=False, use_prepared=False, blkgrp_shapes=None, candidate_counts=None, target_areas=None,
+                geometry_repaired=False):
+    """
+    Calls the make_target_source_allmap engine that goes with the options (the bulk engine is required for blkgrp_shapes)
+    """
+    if bulk_query or blkgrp_shapes is not None:
+        return make_target_source_allmap_bulk(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData,
+                                              use_prepared=use_prepared, blkgrp_shapes=blkgrp_shapes, candidate_counts=candidate_counts, target_areas=target_areas,
+                                              geometry_repaired=geometry_repaired)
+    return make_target_source_allmap(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData,
+                                     use_prepared=use_prepared, candidate_counts=candidate_counts, geometry_repaired=geometry_repaired)
+
+def map_shard(shard):
+    """
+    Process pool worker for make_target_source_allmap_sharded: shard is (args, kwargs) for make_allmap; returns the shard's contains_map
+    The worker's log output is flushed after each shard (a pool worker exits without flushing its inherited log file)
     """
-    #load in shapefiles 
-    larger_shapes = gpd.read_file(larger_path)
-    smaller_shapes = gpd.read_file(smaller_path)
+    args, kwargs = shard
+    try:
+        return make_allmap(*args, **kwargs)[0]
+    finally:
+        log.flush()
+
+def make_target_source_allmap_sharded(source, target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData, workers,
+                                      bulk_query=False, use_prepared=False, blkgrp_shapes=None, geometry_repaired=False):
+    """
+    Same result as make_allmap, but the targets (blocks) are split by county (GEOID[2:5]) into shards that are mapped in a pool of worker processes.
+    Each shard gets the sources whose bounding boxes meet the county's (slightly buffered) bounding box, so every candidate pair lands in
+    exactly one shard, and the overall candidate counts, so single-candidate sources are treated as they are for the whole state.
+    Returns tuple (contains_map, source_key_set) for the whole state.
+    """
+    source_geoms = source.geometry.values
+    src_idx, tgt_idx = target.sindex.query(source_geoms)
+    candidate_counts = pd.Series(np.bincount(src_idx, minlength=len(source_geoms)), index=source.index)
+    source_keys = np.empty(len(source.index), dtype=object)
+    source_keys[:] = source.index.tolist() if use_index_for_source_key else [str(key) for key in source[source_key].tolist()]
+    source_key_set = set(source_keys.tolist())
+
+    print("Making map: Split blocks into county shards")
+    shards = []
+    counties = target[target_key].str[2:5]
+    for county, county_target in target.groupby(counties, sort=False):
+        minx, miny, maxx, maxy = county_target.total_bounds
+        margin = 0.001 * max(maxx - minx, maxy - miny)
+        shard_pos = np.sort(source.sindex.query(box(minx - margin, miny - margin, maxx + margin, maxy + margin)))
+        shard_blkgrp_shapes = None if blkgrp_shapes is None else blkgrp_shapes[blkgrp_shapes['blkgrp'].str[2:5] == county]
+        shards.append(((source.iloc[shard_pos], county_target, source_key, target_key, use_index_for_source_key, state, year, isDemographicData),
+                       {"bulk_query": bulk_query, "use_prepared": use_prepared, "blkgrp_shapes": shard_blkgrp_shapes,
+                        "candidate_counts": candidate_counts.iloc[shard_pos], "geometry_repaired": geometry_repaired}))
+    shards.sort(key=lambda shard: len(shard[0][1].index), reverse=True)      # biggest counties first
+    log.dprint("County shards: ", len(shards), ", workers: ", workers)
+
+    print("Making map: Map county shards")
+    log.flush()     # so the workers don't inherit (and repeat) unwritten log output
+    contains_map = {key: [] for key in target[target_key].tolist()}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for shard_map in tqdm(executor.map(map_shard, shards), total=len(shards)):
+            contains_map.update(shard_map)
+    log_sources_not_in_map(source_keys, candidate_counts.to_numpy())
+    return contains_map, source_key_set
+
+def first_nearest(nearest_result):
+    """
+    From a nearest query result [input positions, tree positions] that includes ties, keeps the lowest tree position for each input
+    """
+    input_pos, tree_pos = nearest_result
+    order = np.lexsort((tree_pos, input_pos))
+    input_pos, first = np.unique(input_pos[order], return_index=True)
+    return input_pos, tree_pos[order][first]
+
+def assign_nearest_sources(contains_map, source, target, source_key, target_key, use_index_for_source_key, max_distance=None, same_county=False):
+    """
+    Assigns every target (block) that overlaps no source to its nearest source (appending (srckey, 0, None) to its empty contains_map list),
+    with one bulk nearest query on a spatial index of the sources
+    max_distance: if given, blocks farther than this (in CRS units) from every source stay unassigned
+    same_county: True ==> only sources in the block's county (GEOID[2:5]) are candidates; a source is in the counties of the blocks it overlaps
+    Returns count of blocks assigned
+    """
+    target_keys = target[target_key].tolist()
+    orphans = np.array([t for t, key in enumerate(target_keys) if len(contains_map[key]) == 0], dtype=np.int64)
+    if len(orphans) == 0:
+        return 0
+    source_keys = source.index.tolist() if use_index_for_source_key else [str(key) for key in source[source_key].tolist()]
+    source_geoms = source.geometry.values
+    orphan_geoms = target.geometry.values[orphans]
+
+    print("Making map: Assign unassigned blocks to nearest source")
+    if not same_county:
+        orphan_idx, src_pos = first_nearest(source.sindex.nearest(orphan_geoms, return_all=True, max_distance=max_distance))
+        nearest_pairs = zip(orphans[orphan_idx].tolist(), src_pos.tolist())
+    else:
+        county_sources = {}     # {countyfp: set(source position)}
+        source_pos = {srckey: pos for pos, srckey in enumerate(source_keys)}
+        for key, items in contains_map.items():
+            for item in items:
+                if item[1] > 0:
+                    county_sources.setdefault(key[2:5], set()).add(source_pos[item[0]])
+        orphan_counties = np.array([target_keys[t][2:5] for t in orphans.tolist()])
+        nearest_pairs = []
+        for county in tqdm(np.unique(orphan_counties).tolist()):
+            if not (county in county_sources):
+                continue
+            in_county = np.flatnonzero(orphan_counties == county)
+            candidates = np.array(sorted(county_sources[county]), dtype=np.int64)
+            orphan_idx, candidate_idx = first_nearest(shapely.STRtree(source_geoms[candidates]).query_nearest(orphan_geoms[in_county], max_distance=max_distance, all_matches=True))
+            nearest_pairs.extend(zip(orphans[in_county[orphan_idx]].tolist(), candidates[candidate_idx].tolist()))
+
+    count_assigned = 0
+    for t, s in nearest_pairs:
+        contains_map[target_keys[t]].append((source_keys[s], 0, None))
+        count_assigned += 1
+    log.dprint("Blocks without any source: ", len(orphans), ", assigned to nearest source: ", count_assigned)
+    return count_assigned
+
+def write_overlap_table(overlap_path, contains_map, source_key_set, metadata=None):
+    """
+    Writes the full (block, source, pct) overlap table from make_target_source_allmap as a compressed numpy (.npz) file:
+        -- block_keys: target keys; block_ordinals index into this
+        -- source_keys: dictionary of source keys (every key in source_key_set); source_codes index into this
+        -- block_ordinals (int32), source_codes (int32), pcts (float64): one row per (block, source) overlap, in contains_map order
+        (pcts are kept at full precision, so a map rebuilt from the table picks the same source on a near tie as make_final_map does from geometry)
+        -- metadata: JSON string of metadata (a dict; e.g. the options and input file hashes the table was made with), if given
+    """
+    block_keys = list(contains_map.keys())
+    source_keys = list(source_key_set)
+    source_codes_map = {srckey: code for code, srckey in enumerate(source_keys)}
+    block_ordinals = []
+    source_codes = []
+    pcts = []
+    for ordinal, items in enumerate(contains_map.values()):
+        for item in items:
+            block_ordinals.append(ordinal)
+            source_codes.append(source_codes_map[item[0]])
+            pcts.append(item[1])
+
+    log.dprint("Writing overlap table: ", overlap_path, " (", len(pcts), " overlaps)")
+    with open(overlap_path, 'wb') as outf:
+        np.savez_compressed(outf, block_keys=np.array(block_keys), source_keys=np.array(source_keys),
+                            block_ordinals=np.array(block_ordinals, dtype=np.int32), source_codes=np.array(source_codes, dtype=np.int32),
+                            pcts=np.array(pcts, dtype=np.float64), metadata=np.array(json.dumps(metadata if metadata != None else {})))
+
+def read_overlap_metadata(overlap_path):
+    """
+    Metadata dict written with the table at overlap_path (see write_overlap_table); {} for a table written without any
+    """
+    with np.load(overlap_path) as table:
+        return json.loads(str(table["metadata"])) if "metadata" in table.files else {}
+
+def read_overlap_table(overlap_path):
+    """
+    Reads a table written by write_overlap_table back into the tuple (contains_map, source_key_set) that make_target_source_allmap returns
+    """
+    with np.load(overlap_path) as table:
+        block_keys = table["block_keys"].tolist()
+        source_keys = table["source_keys"].tolist()
+        block_ordinals = table["block_ordinals"].tolist()
+        source_codes = table["source_codes"].tolist()
+        pcts = table["pcts"].tolist()
+
+    contains_map = {key: [] for key in block_keys}
+    for ordinal, code, pct in zip(block_ordinals, source_codes, pcts):
+        contains_map[block_keys[ordinal]].append((source_keys[code], pct))
+    return contains_map, set(source_keys)
+
+def load_shapes(larger_path, smaller_path, larger_key, smaller_key, use_index_for_larger_key, cache_dir=None, smaller_shapes=None, repair=False, bbox=None):
+    """
+    Reads larger (precinct) and smaller (block) geometry files, converting the larger to the smaller's CRS
+    Only the key columns and geometry are read (see geo_cache.read_columns)
+    cache_dir: if given, both are read thru geo_cache (only key column and geometry, repaired and reprojected, cached as GeoParquet)
+    smaller_shapes: already loaded smaller shapes (then smaller_path isn't read again)
+    repair: True ==> invalid geometry of both is repaired up front (see geo_cache.repair_geometries; the geo_cache does this when it reads
+        a file, and with repair checks cached copies again)
+    bbox: (minx, miny, maxx, maxy) in the smaller file's CRS ==> only shapes meeting that box are read
+        (not applied to the larger file when use_index_for_larger_key, since its index is the key)
+    Returns tuple (larger_shapes, smaller_shapes)
+    """
+    larger_columns = [] if use_index_for_larger_key else [larger_key]
+    larger_bbox = None if use_index_for_larger_key else bbox
+    if cache_dir != None:
+        if smaller_shapes is None:
+            smaller_shapes = geo_cache.read_geo(smaller_path, [smaller_key], cache_dir=cache_dir, bbox=bbox, repair=repair)
+        larger_shapes = geo_cache.read_geo(larger_path, larger_columns, crs=smaller_shapes.crs, cache_dir=cache_dir, bbox=larger_bbox, bbox_crs=smaller_shapes.crs, repair=repair)
+        log.dprint("Larger CRS: ", larger_shapes.crs)
+        log.dprint("Smaller CRS: ", smaller_shapes.crs)
+        return larger_shapes, smaller_shapes
+
+    smaller_loaded = smaller_shapes is None
+    if smaller_loaded:
+        smaller_shapes = geo_cache.read_columns(smaller_path, [smaller_key], bbox)
+    larger_shapes = geo_cache.read_columns(larger_path, larger_columns, larger_bbox, smaller_shapes.crs)
 
     if larger_shapes.crs and smaller_shapes.crs: 
         print("Larger CRS: ", larger_shapes.crs)
@@ -172,8 +583,105 @@ def make_target_source_map(larger_path, smaller_path, larger_key, smaller_key, u
         if not (smaller_shapes.crs):
             print("Smaller CRS unknown")
             log.dprint("Smaller CRS unknown")
-    res_tuple = make_target_source_allmap(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData)
+    if repair:
+        print("Repairing invalid geometry")
+        geo_cache.repair_geometries(larger_shapes, None if use_index_for_larger_key else larger_key, larger_path)
+        if smaller_loaded:
+            geo_cache.repair_geometries(smaller_shapes, smaller_key, smaller_path)
+    return larger_shapes, smaller_shapes
+
+def make_target_source_map(larger_path, smaller_path, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, source_is_block_group=False, bulk_query=False, use_prepared=False, overlap_path=None,
+                           hierarchical=False, blkgrp_path=None, blkgrp_key=None, workers=1, cache_dir=None,
+                           nearest_fallback=False, nearest_max_distance=None, nearest_same_county=False, repair_geometry=False, bbox=None, overlap_metadata=None):
+    """
+    Given two file paths to larger (precinct) and smaller (block) geometry, opens files and calls
+        make_target_source_allmap to produce tuple (contains_map, source_key_set)  (geometry files can be geojson or shapefile)
+    larger_key is a string key uniquely identifying the rows in larger_path
+    smaller_key is a string key uniquely identifying the rows in smaller_path
+    bulk_query: True ==> use make_target_source_allmap_bulk (one spatial index query, vectorized intersections) to build the same map
+    use_prepared: True ==> blocks strictly inside a (prepared) precinct are assigned 1.0 without computing the intersection
+    overlap_path: if given (and not hierarchical), the full overlap table is also written there, with overlap_metadata (see write_overlap_table)
+    hierarchical: True ==> (uses make_target_source_allmap_bulk) intersect the larger shapes with block groups first, and only test the
+        blocks of block groups that straddle larger shapes; block group shapes come from blkgrp_path/blkgrp_key or are dissolved from the blocks
+    workers: > 1 ==> split the blocks into county shards that are mapped in that many worker processes (see make_target_source_allmap_sharded)
+    cache_dir: if given, geometry is loaded thru the geo_cache there (see load_shapes)
+    nearest_fallback: True ==> blocks that overlap nothing are assigned to the nearest larger shape, optionally within nearest_max_distance
+        and (nearest_same_county) in the block's county, instead of to '' (see assign_nearest_sources)
+    repair_geometry: True ==> invalid geometry is repaired once up front (see load_shapes), so intersections rarely fail; one that does
+        still falls back to contains/overlaps (and is skipped if that fails, too), with or without repair
+    bbox: (minx, miny, maxx, maxy) in the smaller file's CRS ==> only map the shapes meeting that box (see load_shapes)
+
+    Then walk thru contains_map (whose values are arrays of {<smaller_key>: %overlap}), building final map of smaller_key: larger_key.
+
+    Note: if a block overlaps more than 1 precinct, it is assigned to the one with the greatest precentage overlap
+    """
+    larger_shapes, smaller_shapes = load_shapes(larger_path, smaller_path, larger_key, smaller_key, use_index_for_larger_key, cache_dir, repair=repair_geometry, bbox=bbox)
+    blkgrp_shapes = make_block_group_shapes(smaller_shapes, smaller_key, blkgrp_path, blkgrp_key) if hierarchical else None
+    return map_shapes(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, source_is_block_group,
+                      overlap_path=overlap_path, bulk_query=bulk_query, use_prepared=use_prepared, blkgrp_shapes=blkgrp_shapes, workers=workers,
+                      nearest_fallback=nearest_fallback, nearest_max_distance=nearest_max_distance, nearest_same_county=nearest_same_county,
+                      geometry_repaired=repair_geometry, overlap_metadata=overlap_metadata)
+
+def make_target_source_maps(larger_list, smaller_path, smaller_key, state, year, isDemographicData, bulk_query=False, use_prepared=False,
+                            hierarchical=False, blkgrp_path=None, blkgrp_key=None, workers=1, cache_dir=None,
+                            nearest_fallback=False, nearest_max_distance=None, nearest_same_county=False, repair_geometry=False, bbox=None):
+    """
+    Like make_target_source_map for several larger geometries (e.g. source and dest precincts) mapped from the same smaller (block) geometry:
+    the blocks are read once, and their spatial index, areas and block group shapes are shared by all of the maps
+    larger_list: [(larger_path, larger_key, use_index_for_larger_key, source_is_block_group, overlap_path, overlap_metadata), ...]
+    Returns list of final maps, in the order of larger_list
+    """
+    final_maps = []
+    smaller_shapes = None
+    for larger_path, larger_key, use_index_for_larger_key, source_is_block_group, overlap_path, overlap_metadata in larger_list:
+        larger_shapes, smaller_shapes = load_shapes(larger_path, smaller_path, larger_key, smaller_key, use_index_for_larger_key, cache_dir, smaller_shapes, repair_geometry, bbox)
+        if len(final_maps) == 0:
+            smaller_areas = shapely.area(smaller_shapes.geometry.values)
+            blkgrp_shapes = make_block_group_shapes(smaller_shapes, smaller_key, blkgrp_path, blkgrp_key) if hierarchical else None
+        final_maps.append(map_shapes(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, source_is_block_group,
+                                     overlap_path=overlap_path, bulk_query=bulk_query, use_prepared=use_prepared, blkgrp_shapes=blkgrp_shapes, workers=workers,
+                                     target_areas=smaller_areas, nearest_fallback=nearest_fallback, nearest_max_distance=nearest_max_distance,
+                                     nearest_same_county=nearest_same_county, geometry_repaired=repair_geometry, overlap_metadata=overlap_metadata))
+    return final_maps
+
+def map_shapes(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, source_is_block_group=False,
+               overlap_path=None, bulk_query=False, use_prepared=False, blkgrp_shapes=None, workers=1, target_areas=None,
+               nearest_fallback=False, nearest_max_distance=None, nearest_same_county=False, geometry_repaired=False, overlap_metadata=None):
+    """
+    The geometry work of make_target_source_map, for shapes that are already loaded: builds the overlap map with the engine that goes with
+    the options, assigns unassigned blocks to their nearest source (if nearest_fallback, see assign_nearest_sources), writes the
+    overlap table (if overlap_path, with overlap_metadata; not with blkgrp_shapes, see make_target_source_allmap_bulk), and returns the final map
+    """
+    if workers > 1:
+        res_tuple = make_target_source_allmap_sharded(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData, workers,
+                                                      bulk_query=bulk_query, use_prepared=use_prepared, blkgrp_shapes=blkgrp_shapes,
+                                                      geometry_repaired=geometry_repaired)
+    else:
+        res_tuple = make_allmap(larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, state, year, isDemographicData,
+                                bulk_query=bulk_query, use_prepared=use_prepared, blkgrp_shapes=blkgrp_shapes, target_areas=target_areas,
+                                geometry_repaired=geometry_repaired)
+    if nearest_fallback:
+        assign_nearest_sources(res_tuple[0], larger_shapes, smaller_shapes, larger_key, smaller_key, use_index_for_larger_key, nearest_max_distance, nearest_same_county)
+    if overlap_path != None and blkgrp_shapes is not None:
+        # Blocks of contained block groups only have 1.0 / -1 in the map, not their overlaps
+        log.dprint("Overlap table not written in hierarchical mode: ", overlap_path)
+    elif overlap_path != None:
+        write_overlap_table(overlap_path, res_tuple[0], res_tuple[1], overlap_metadata)
+
+    return make_final_map(res_tuple, source_is_block_group)
 
+def make_target_source_map_from_overlap(overlap_path, source_is_block_group=False):
+    """
+    Builds the final map of smaller_key: larger_key from an overlap table written by an earlier make_target_source_map,
+    without reading or intersecting any geometry
+    """
+    log.dprint("Reading overlap table: ", overlap_path)
+    return make_final_map(read_overlap_table(overlap_path), source_is_block_group)
+
+def make_final_map(res_tuple, source_is_block_group=False):
+    """
+    Walk thru contains_map of res_tuple (contains_map, source_key_set), building final map of smaller_key: [larger_key]
+    """
     print("Build target ==> source map")
     final_map = {}      # {res.key: [<largest of res.value>]}
     extras_map = {}     # {srckey: set(blkkey)}
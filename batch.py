@@ -0,0 +1,208 @@
+# Batch runner: process_state for many states (and years / configs) in a pool of worker processes
+#
+# A batch is every state in a list crossed with a list of (year, destyear, config) jobs, run with the same steps.
+# Jobs are started longest first, so the big states (CA, TX, ...) don't start last and hold up the end of the batch:
+# by their time in an earlier batch (kept in a history file), or else by the size of their input files.
+# Each job runs in a worker process (forked where the platform has fork, so a main script needs no __main__ guard there),
+# with its own process_state log file, and workers can be held to a memory limit (address space, in GB), so one big state
+# fails with a MemoryError instead of taking the host down. Workers are reused, so run_job resets the per-job state
+# (peak memory count; log.close ends the log file) for each job.
+# A summary of the jobs (time, peak memory, status, log) is printed and logged at the end.
+#
+
+import os
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import agg_logging as log
+from . import disagg_agg as da
+from . import manifest
+from . import statecodes
+
+def make_jobs(states, job_list):
+    """
+    Batch jobs, (state, year, destyear, config), of each state with each (year, destyear, config) in job_list
+    """
+    return [(state, year, destyear, config) for state in states for year, destyear, config in job_list]
+
+def job_name(job, steps):
+    state, year, destyear, config = job
+    return state + "_" + os.path.splitext(da.make_logfile_name(steps, year, destyear, config))[0]
+
+def job_paths(root_paths, job):
+    state, year, destyear, config = job
+    isDemographicData = config["isDemographicData"] if "isDemographicData" in config else False
+    isCVAP = config["isCVAP"] if "isCVAP" in config else False
+    isACS = config["isACS"] if "isACS" in config else False
+    return da.prepare.get_paths(root_paths, state, not isDemographicData, year, isCVAP, destyear, isACS)
+
+def job_input_size(root_paths, job, steps):
+    """
+    Total size (bytes) of the job's input files that exist (files the steps read, see disagg_agg.step_files)
+    """
+    paths = job_paths(root_paths, job)
+    inputs = set()
+    for step in steps:
+        inputs.update(da.step_files(step, paths, job[3])[0])
+    stats = [manifest.file_stat(path) for path in inputs]
+    return sum(stat[0] for stat in stats if stat != None)
+
+def load_history(history_path):
+    """
+    {job name: seconds} of earlier batches (see run_batch), empty if there's no history_path
+    """
+    if history_path != None and os.path.exists(history_path):
+        with open(history_path) as json_file:
+            return json.load(json_file)
+    return {}
+
+def estimate_times(root_paths, jobs, steps, history):
+    """
+    Estimated time of each job, to order them longest first: the time of its last successful run if it's in history;
+    otherwise its input size (scaled to seconds by the jobs that have both, if any)
+    """
+    names = [job_name(job, steps) for job in jobs]
+    sizes = [job_input_size(root_paths, job, steps) for job in jobs]
+    timed = [(history[name], size) for name, size in zip(names, sizes) if name in history and size > 0]
+    seconds_per_byte = sum(seconds for seconds, size in timed) / sum(size for seconds, size in timed) if len(timed) > 0 else 1
+    return [history[name] if name in history else size * seconds_per_byte for name, size in zip(names, sizes)]
+
+def limit_memory(memory_limit):
+    """
+    Process pool initializer: caps the worker's address space at memory_limit GB (where the resource module has it; not on Windows)
+    """
+    if memory_limit == None:
+        return
+    try:
+        import resource
+    except ImportError:
+        return
+    limit = int(memory_limit * (1 << 30))
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def run_job(job_args):
+    """
+    Process pool worker for run_batch: job_args is (root_paths, job, steps, state_codes); runs process_state for the job.
+    Returns (status, seconds, peak memory in MB, log path); status is "ok" or the error (also written to the job's log)
+    """
+    root_paths, job, steps, state_codes = job_args
+    state, year, destyear, config = job
+    reset_peak_memory()
+    start = time.time()
+    log_path = None
+    status = "ok"
+    try:
+        log_path = job_paths(root_paths, job)["working_path"] + da.make_logfile_name(steps, year, destyear, config)
+        da.process_state(root_paths, state, steps, state_codes, year, destyear, config)
+    except Exception as e:
+        status = error_status(e)
+        log.dprint("Batch job failed: ", state, " ", year, " to ", destyear)
+        log.dprint(traceback.format_exc())
+    finally:
+        log.close()
+    return status, time.time() - start, peak_memory_mb(), log_path
+
+def error_status(e):
+    """ Status of a failed job: the error, first line only (the traceback is in the job's log) """
+    lines = str(e).splitlines()
+    return type(e).__name__ + (": " + lines[0] if len(lines) > 0 else "")
+
+def reset_peak_memory():
+    """
+    Resets the peak resident memory count of this process (Linux only), so a reused worker reports the peak of its current job
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as outf:
+            outf.write("5")
+    except OSError:
+        pass
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB: since reset_peak_memory on Linux, else since the process started
+    (None where the resource module isn't available)
+    """
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / (1 << 10))      # KB
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20 if os.uname().sysname == "Darwin" else 1 << 10))       # bytes on macOS, KB on Linux
+
+def run_batch(root_paths, states, job_list, steps, workers=1, memory_limit=None, history_path=None, log_path=None, state_codes=None):
+    """
+    Runs process_state(root_paths, state, steps, state_codes, year, destyear, config) for each state with each (year, destyear, config)
+    of job_list, in up to workers worker processes, longest jobs first (see estimate_times).
+    The workers are forked where the platform has fork; elsewhere (Windows) they're spawned, which imports the main script again
+    in each worker, so a script that calls run_batch there needs an if __name__ == "__main__": guard.
+    memory_limit: GB of address space per worker (None ==> no limit); a job that needs more fails with a MemoryError, the others go on
+    history_path: json file of job times: read for the job order, and updated with the times of the jobs that succeed
+    log_path: batch log file (the jobs log to their own process_state log files, in their working_path)
+    Returns the summary: [{"job", "state", "year", "destyear", "status", "seconds", "peak_mb", "log"}, ...] in job order
+    """
+    if state_codes == None:
+        state_codes = statecodes.make_state_codes()
+    if log_path != None:
+        log.set_output(log_path, "Disagg/Agg Batch Logging")
+    jobs = make_jobs(states, job_list)
+    history = load_history(history_path)
+    estimates = estimate_times(root_paths, jobs, steps, history)
+    order = sorted(range(len(jobs)), key=lambda j: estimates[j], reverse=True)
+    log.dprint("Batch: ", len(jobs), " jobs, steps: ", steps, ", workers: ", workers, ", memory limit (GB): ", memory_limit)
+    for j in order:
+        log.dprint("\t", job_name(jobs[j], steps), ": estimate ", round(estimates[j], 1))
+
+    summary = [None] * len(jobs)
+    log.flush()     # so forked workers don't inherit (and repeat) unwritten log output
+    mp_context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=limit_memory, initargs=(memory_limit,)) as executor:
+        futures = {executor.submit(run_job, (root_paths, jobs[j], steps, state_codes)): j for j in order}
+        for future in as_completed(futures):
+            j = futures[future]
+            state, year, destyear, config = jobs[j]
+            try:
+                status, seconds, peak_mb, job_log_path = future.result()
+            except Exception as e:         # the worker died (e.g. killed for memory)
+                status, seconds, peak_mb, job_log_path = error_status(e), None, None, None
+            summary[j] = {"job": job_name(jobs[j], steps), "state": state, "year": year, "destyear": destyear, "status": status,
+                          "seconds": None if seconds == None else round(seconds, 1), "peak_mb": peak_mb, "log": job_log_path}
+            report("Batch job ", summary[j]["job"], ": ", status)
+            if status == "ok":
+                history[summary[j]["job"]] = seconds
+
+    if history_path != None:
+        with open(history_path, "w") as outf:
+            json.dump(history, outf, indent=1)
+    print_summary(summary)
+    if log_path != None:
+        log.close()
+    return summary
+
+def print_summary(summary):
+    """
+    Summary table of a batch (see run_batch), to stdout and the log
+    """
+    columns = ("job", "status", "seconds", "peak_mb", "log")
+    rows = [columns] + [tuple("" if row[column] == None else str(row[column]) for column in columns) for row in summary]
+    widths = [max(len(row[c]) for row in rows) for c in range(len(columns))]
+    for row in rows:
+        report("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    report("Batch: ", len(summary), " jobs, failed: ", sum(1 for row in summary if row["status"] != "ok"))
+
+def report(*args):
+    """
+    Prints args, and logs them too if there's a batch log
+    """
+    print(*args)
+    if log.out_file != None:
+        log.dprint(*args)
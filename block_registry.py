@@ -0,0 +1,229 @@
+# Block registry: compact, array forms of the per-block maps passed between steps
+#
+# Block ids (15 character GEOIDs) are repeated as dict keys in the block pop map, both block maps and the block data, and precinct keys
+# are repeated strings in the block maps. The registry gives each block of a state a dense int32 ordinal (its GEOIDs kept once,
+# as a bytes array), and the maps become arrays by ordinal:
+#   block map {blkid: [key, ...], ...} ==> {"blocks": int32 ordinals, "codes": int32 codes, "keys": [key, ...]} (one entry per block and key,
+#       in map order, codes dictionary-encoded into keys)
+#   block weights {blkid: weight, ...} or {blkid: {column: weight, ...}, ...} ==> {"columns": None or [column, ...],
+#       "values": int32 (if all weights are) or float64 by ordinal (x columns), "present": bool by ordinal}
+# A few bytes per block instead of a dict entry with its own strings (and list), and lookups are array indexing.
+# The steps work on these arrays: disaggregation gets its precinct ==> block pcts as CSR segments (make_prec_segments) and
+# aggregation looks up dests by block ordinal (make_dest_codes); block ids are only decoded for what gets written.
+#
+
+import numpy as np
+
+from . import agg_logging as log
+
+def make_registry(blocks=()):
+    """
+    Registry {"ids": bytes array of the block ids by ordinal, "order": ordinals sorted by id (for lookups)}, with blocks registered
+    """
+    registry = {"ids": np.array([], dtype=bytes), "order": np.array([], dtype=np.int32)}
+    register(registry, blocks)
+    return registry
+
+def as_ids(blocks):
+    return np.array(list(blocks), dtype=bytes)
+
+def lookup(registry, blocks):
+    """
+    Ordinals (int32) of blocks (list of blkids); -1 ==> not registered
+    """
+    ids = registry["ids"]
+    keys = as_ids(blocks)
+    if len(ids) == 0 or len(keys) == 0:
+        return np.full(len(keys), -1, dtype=np.int32)
+    found = np.minimum(np.searchsorted(ids, keys, sorter=registry["order"]), len(ids) - 1)
+    ordinals = registry["order"][found]
+    return np.where(ids[ordinals] == keys, ordinals, -1).astype(np.int32)
+
+def register(registry, blocks):
+    """
+    Ordinals (int32) of blocks, registering the ones that aren't yet (new blocks get the next ordinals; existing ordinals don't change)
+    """
+    blocks = list(blocks)
+    ordinals = lookup(registry, blocks)
+    new = np.flatnonzero(ordinals < 0)
+    if len(new) > 0:
+        new_ids, first = np.unique(as_ids([blocks[b] for b in new.tolist()]), return_index=True)
+        new_ids = new_ids[np.argsort(first)]        # in order of first appearance
+        registry["ids"] = np.concatenate([registry["ids"], new_ids])
+        registry["order"] = np.argsort(registry["ids"], kind='stable').astype(np.int32)
+        ordinals[new] = lookup(registry, [blocks[b] for b in new.tolist()])
+    return ordinals
+
+def block_ids(registry, ordinals):
+    """
+    Block ids (list of str) of ordinals
+    """
+    return np.char.decode(registry["ids"][ordinals]).tolist()
+
+def encode_block_map(registry, block_map):
+    """
+    Block map {blkid: [key, ...], ...} (or {blkid: key, ...}) ==> {"blocks", "codes", "keys", "lists"} (see above); its blocks get registered
+    "lists": True ==> the map's values are lists, as area_contains writes them (for decode_block_map); a block with an empty list has no entries
+    """
+    keys = {}
+    blocks = []
+    codes = []
+    lists = True
+    for block, value in block_map.items():
+        if not isinstance(value, list):
+            value = [value]
+            lists = False
+        for key in value:
+            blocks.append(block)
+            codes.append(keys.setdefault(key, len(keys)))
+    encoded = {"blocks": register(registry, blocks), "codes": np.array(codes, dtype=np.int32), "keys": list(keys.keys()), "lists": lists}
+    log.dprint("Encoded block map: ", len(block_map), " blocks, ", len(keys), " keys, ", nbytes(encoded), " bytes")
+    return encoded
+
+def decode_block_map(registry, encoded):
+    """
+    The block map {blkid: [key, ...], ...} (or {blkid: key, ...}) of encoded (see encode_block_map)
+    """
+    block_map = {}
+    keys = encoded["keys"]
+    for block, code in zip(block_ids(registry, encoded["blocks"]), encoded["codes"].tolist()):
+        if encoded["lists"]:
+            block_map.setdefault(block, []).append(keys[code])
+        else:
+            block_map[block] = keys[code]
+    return block_map
+
+def make_dest_index(registry, encoded):
+    """
+    Block ==> dest lookup of encoded (see encode_block_map) as aggregate.make_dest_index makes it from a file:
+    (block ids sorted, int32 dest code of each, dests); a block's dest is its first key (as crosswalk.block_dest)
+    """
+    ordinals, first = np.unique(encoded["blocks"], return_index=True)
+    ids = registry["ids"][ordinals]
+    order = np.argsort(ids, kind='stable')
+    return ids[order], encoded["codes"][first][order], encoded["keys"]
+
+def make_dest_codes(registry, encoded):
+    """
+    Block ==> dest lookup of encoded (see encode_block_map) by block ordinal: (dest code of each ordinal of the registry, int32,
+    -1 ==> not in the map; dests); a block's dest is its first key (as crosswalk.block_dest)
+    """
+    ordinals, first = np.unique(encoded["blocks"], return_index=True)
+    codes = np.full(len(registry["ids"]), -1, dtype=np.int32)
+    codes[ordinals] = encoded["codes"][first]
+    return codes, encoded["keys"]
+
+def decode_dest_codes(registry, dest_codes):
+    """
+    {blkid: dest_key, ...} of dest_codes (see make_dest_codes), for what needs a dict
+    """
+    ordinals = np.flatnonzero(dest_codes[0] >= 0)
+    dests = dest_codes[1]
+    return {block: dests[code] for block, code in zip(block_ids(registry, ordinals), dest_codes[0][ordinals].tolist())}
+
+def lookup_dest_codes(registry, dest_codes, blocks=None, ordinals=None):
+    """
+    Dest codes (int32, -1 ==> not in the map) of blocks (list of blkids), or of their ordinals if given, in dest_codes (see make_dest_codes)
+    """
+    if ordinals is None:
+        ordinals = lookup(registry, blocks)
+    codes = np.full(len(ordinals), -1, dtype=np.int32)
+    known = (ordinals >= 0) & (ordinals < len(dest_codes[0]))
+    codes[known] = dest_codes[0][ordinals[known]]
+    return codes
+
+def encode_block_weights(registry, block_pop_map):
+    """
+    Block weights {blkid: weight, ...} or multi-column {blkid: {column: weight, ...}, ...} (see disaggregate.read_block_weights)
+    ==> {"columns", "values", "present"} (see above; a block without a column gets 0); its blocks get registered
+    """
+    ordinals = register(registry, block_pop_map.keys())
+    rows = list(block_pop_map.values())
+    columns = None
+    if isinstance(next(iter(rows), None), dict):
+        columns = list(dict.fromkeys(column for row in rows for column in row.keys()))
+        values = np.zeros((len(registry["ids"]), len(columns)))
+        for c, column in enumerate(columns):
+            values[ordinals, c] = [row.get(column, 0) for row in rows]
+    else:
+        values = np.zeros(len(registry["ids"]))
+        values[ordinals] = rows
+    if np.all(np.mod(values, 1) == 0) and np.all(np.abs(values) < 2 ** 31):
+        values = values.astype(np.int32)     # population counts: half the size (weight_values gives float64 again)
+    present = np.zeros(len(registry["ids"]), dtype=bool)
+    present[ordinals] = True
+    weights = {"columns": columns, "values": values, "present": present}
+    log.dprint("Encoded block weights: ", len(block_pop_map), " blocks, columns: ", columns, ", ", nbytes(weights), " bytes")
+    return weights
+
+def weight_values(weights, ordinals, columns=(None,)):
+    """
+    Weights (float64, len(ordinals) x len(columns)) of the blocks of ordinals (-1 or unweighted ==> 0); column None ==> the single column
+    """
+    values = np.zeros((len(ordinals), len(columns)))
+    known = (ordinals >= 0) & (ordinals < len(weights["present"]))
+    known[known] = weights["present"][ordinals[known]]
+    for c, column in enumerate(columns):
+        if weights["columns"] == None:
+            values[known, c] = weights["values"][ordinals[known]]
+        elif column in weights["columns"]:
+            values[known, c] = weights["values"][ordinals[known], weights["columns"].index(column)]
+    return values, known
+
+def make_prec_segments(registry, encoded, weights, columns=(None,)):
+    """
+    disaggregate.make_prec_pct_map from encoded forms, as CSR segments: encoded block map (of blocks to precincts), weights by ordinal
+    (see encode_block_weights) ==> (prec_keys, indptr, blocks, pcts): the blocks (int32 ordinals) of precinct prec_keys[i] are
+    blocks[indptr[i]:indptr[i + 1]], with their pcts (float64, entries x columns); same precinct and block order, sums and pcts
+    """
+    keys = encoded["keys"]
+    keep = np.ones(len(encoded["codes"]), dtype=bool)
+    if "" in keys:
+        keep = encoded["codes"] != keys.index("")
+    entries = np.flatnonzero(keep)
+    # A block counts once in a precinct (the first time), and precincts and their blocks go in order of first appearance
+    pairs = encoded["codes"][entries].astype(np.int64) * max(1, len(registry["ids"])) + encoded["blocks"][entries]
+    entries = entries[np.sort(np.unique(pairs, return_index=True)[1])]
+    blocks = encoded["blocks"][entries]
+    precs = encoded["codes"][entries]
+    prec_order = np.full(len(keys), -1, dtype=np.int64)
+    first_precs = precs[np.sort(np.unique(precs, return_index=True)[1])]
+    prec_order[first_precs] = np.arange(len(first_precs))
+    order = np.argsort(prec_order[precs], kind='stable')
+    blocks = blocks[order]
+    precs = prec_order[precs[order]]
+
+    values, known = weight_values(weights, blocks, columns)
+    if not known.all():
+        for blk_id in block_ids(registry, blocks[~known]):
+            log.dprint("Block not in block_pop_map: ", blk_id)
+    starts = np.searchsorted(precs, np.arange(len(first_precs)))
+    indptr = np.append(starts, len(precs)).astype(np.int64)
+
+    pcts = np.zeros((len(blocks), len(columns)))
+    for c in range(len(columns)):
+        sums = np.bincount(precs, weights=values[:, c], minlength=len(first_precs))
+        pcts[:, c] = np.where(known, values[:, c] / np.where(sums[precs] > 0, sums[precs], 1), 0)
+        pcts[sums[precs] <= 0, c] = 0
+        pcts[starts[sums <= 0], c] = 1      # All blocks have zero pop, but pick one in case prec has data
+    return [keys[prec] for prec in first_precs.tolist()], indptr, blocks, pcts
+
+def segment_pct_maps(registry, prec_keys, indptr, blocks, pcts):
+    """
+    The dict forms [{prec: {blk: pct, ...}, ...}, ...] (one per column) of segments (see make_prec_segments), for what needs them
+    (the dict engine's "datasets" rows)
+    """
+    blk_ids = block_ids(registry, blocks)
+    starts = indptr[:-1].tolist()
+    ends = indptr[1:].tolist()
+    pct_maps = []
+    for c in range(pcts.shape[1]):
+        pct_list = pcts[:, c].tolist()
+        pct_maps.append({prec: dict(zip(blk_ids[start:end], pct_list[start:end])) for prec, start, end in zip(prec_keys, starts, ends)})
+    return pct_maps
+
+def nbytes(encoded):
+    """
+    Bytes of the arrays of an encoded map or weights (or a registry)
+    """
+    return sum(value.nbytes for value in encoded.values() if isinstance(value, np.ndarray))
@@ -0,0 +1,384 @@
+# Sparse crosswalk engine for disaggregation and aggregation
+#
+# Blocks are numbered (integer ordinals), and
+#   -- precinct ==> block weights (pct of precinct population in each block) are a CSR matrix, precincts x blocks
+#   -- block ==> dest assignments are a CSR matrix of ones, dests x blocks
+#   (with compact maps, the weights come straight from block_registry's CSR segments and dests by block ordinal; see disaggregate_segments)
+# so disaggregation is a batched weights-times-values product (rounded to integers with apportion.largest_remainder_segments)
+# and aggregation is a sparse reduction of the block values, instead of loops over nested dicts.
+# Results (and totals) are the same as the dict versions: disaggregate.make_prec_blk_key_map + make_final_blk_map, aggregate.handle_field,
+# down to the order of the props in each block and dest (see first_seen_orders), so the output files are byte for byte the same
+#
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from . import agg_logging as log
+from . import apportion
+from . import block_registry
+
+def make_weight_matrix(prec_blk_pct_map, prec_keys):
+    """
+    Returns (weights, block_keys):
+        weights: CSR matrix, one row per prec in prec_keys, of the pcts in prec_blk_pct_map {prec: {blk: pct, ...}, ...}
+        block_keys: block of each column (ordinal), in order of first appearance
+    Entries of a row keep the order of the prec's blocks (which decides ties in the rounding), and zero pcts are kept as entries
+    """
+    block_ordinals = {}
+    indptr = [0]
+    indices = []
+    data = []
+    for prec in prec_keys:
+        for blk, pct in prec_blk_pct_map[prec].items():
+            indices.append(block_ordinals.setdefault(blk, len(block_ordinals)))
+            data.append(pct)
+        indptr.append(len(indices))
+    weights = sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+                                shape=(len(prec_keys), len(block_ordinals)))
+    return weights, list(block_ordinals.keys())
+
+def make_value_matrix(rows, ok_to_agg):
+    """
+    rows: list of source rows {prop: value, ...}
+    Returns (props, values, present): props that can be disaggregated (ok_to_agg name, integer value), in order of first appearance,
+        values (int64, rows x props) and present (bool, rows x props: prop is in the row)
+    """
+    prop_cols = {}
+    cant_disagg_set = {}
+    ok_keys = {}        # ok_to_agg of each key name, so it's called once per name
+    entries = []
+    for r, row in enumerate(rows):
+        for key, value in row.items():
+            if not (key in ok_keys):
+                ok_keys[key] = ok_to_agg(key)
+            if ok_keys[key]:
+                try:
+                    entries.append((r, prop_cols.setdefault(key, len(prop_cols)), int(value)))
+                except:
+                    if not (key in cant_disagg_set):
+                        print("Can't disagg key: ", key)
+                        cant_disagg_set[key] = True
+    values = np.zeros((len(rows), len(prop_cols)), dtype=np.int64)
+    present = np.zeros((len(rows), len(prop_cols)), dtype=bool)
+    if len(entries) > 0:
+        r, c, v = (np.array(column) for column in zip(*entries))
+        values[r, c] = v
+        present[r, c] = True
+    return list(prop_cols.keys()), values, present
+
+def row_layouts(rows, props):
+    """
+    Key order of each of rows (list of {prop: value, ...}): returns (layouts, ranks): the layout of each row (int64, rows with the same keys
+    in the same order share one) and ranks (int64, layouts x props): position of each prop of props in a row of the layout (-1 ==> not in it)
+    """
+    layout_ids = {}
+    layouts = np.array([layout_ids.setdefault(tuple(row), len(layout_ids)) for row in rows], dtype=np.int64)
+    prop_cols = {prop: c for c, prop in enumerate(props)}
+    ranks = np.full((len(layout_ids), len(props)), -1, dtype=np.int64)
+    for layout, keys in enumerate(layout_ids.keys()):
+        for position, key in enumerate(keys):
+            if key in prop_cols:
+                ranks[layout, prop_cols[key]] = position
+    return layouts, ranks
+
+def first_seen_orders(unit_dests, unit_present, unit_layouts, layout_ranks, dest_present):
+    """
+    Order the dict versions put the props (columns) of each dest in: a dest gets a prop when the first unit (block row, in order) that has it
+    comes in, and the props one unit brings go in its row's order
+    unit_dests: dest of each unit (-1 ==> none); unit_present (units x props): unit has the prop; unit_layouts, layout_ranks: see row_layouts;
+    dest_present (dests x props): dest has the prop
+    Returns (dest_orders, orders): orders is a list of prop orders (tuples of column indexes), dest_orders (int64) the one of each dest.
+    Usually a dest's props all come with its first unit, in that unit's layout; only the other dests are worked out one by one
+    """
+    num_dests, num_props = dest_present.shape
+    order_ids = {(): 0}
+    layout_order_ids = []
+    for ranks in layout_ranks:
+        cols = np.flatnonzero(ranks >= 0)
+        layout_order_ids.append(order_ids.setdefault(tuple(cols[np.argsort(ranks[cols], kind='stable')].tolist()), len(order_ids)))
+    layout_order_ids = np.array(layout_order_ids, dtype=np.int64)
+    dest_orders = np.zeros(num_dests, dtype=np.int64)
+
+    mapped = np.flatnonzero(unit_dests >= 0)
+    dests, first = np.unique(unit_dests[mapped], return_index=True)
+    if len(dests) > 0:
+        first_units = mapped[first]
+        layouts = unit_layouts[first_units]
+        base = unit_present[first_units]
+        same = (dest_present[dests] == base).all(axis=1) & (base == (layout_ranks[layouts] >= 0)).all(axis=1)
+        dest_orders[dests[same]] = layout_order_ids[layouts[same]]
+        rest = dests[~same]
+        if len(rest) > 0:
+            # First unit of each (dest, prop) of the other dests, then their props by (first unit, position in its row)
+            rest_pos = np.full(num_dests, -1, dtype=np.int64)
+            rest_pos[rest] = np.arange(len(rest))
+            rest_units = mapped[rest_pos[unit_dests[mapped]] >= 0]
+            no_unit = len(unit_dests)
+            firsts = np.full((len(rest), num_props), no_unit, dtype=np.int64)
+            for c in range(num_props):
+                units = rest_units[unit_present[rest_units, c]]
+                np.minimum.at(firsts[:, c], rest_pos[unit_dests[units]], units)
+            for r, dest in enumerate(rest.tolist()):
+                cols = np.flatnonzero(firsts[r] < no_unit)
+                units = firsts[r, cols]
+                order = tuple(cols[np.lexsort((layout_ranks[unit_layouts[units], cols], units))].tolist())
+                dest_orders[dest] = order_ids.setdefault(order, len(order_ids))
+    return dest_orders, list(order_ids.keys())
+
+def disaggregate_blocks(prec_blk_pct_map, source_props_map, ok_to_agg, weight_maps=None, prop_weights=None):
+    """
+    Disaggregates source_props_map {prec: {prop: val, ...}, ...} to blocks with the weights of prec_blk_pct_map {prec: {blk: pct, ...}, ...}
+    weight_maps {column: prec_blk_pct_map, ...} (same precs and blocks, other weights) and prop_weights {prop: column}: props with a column
+        there are apportioned with that column's pcts instead (see disaggregate.make_prec_pct_maps)
+    Returns (block_keys, props, block_values, block_present, units): block values (int64, blocks x props) and present (bool: one of the
+        block's precincts has the prop); units: (block of each (prec, block) entry, in the order the dict version adds them, its present props,
+        its layout and the layout ranks), for the order of the props (see first_seen_orders)
+    (Rows with "datasets" aren't handled here; see disaggregate.disaggregate_precs)
+    """
+    prec_keys = found_precs(prec_blk_pct_map.keys(), source_props_map)
+    weights, block_keys = make_weight_matrix(prec_blk_pct_map, prec_keys)
+    column_pcts = {column: make_weight_matrix(weight_map, prec_keys)[0].data for column, weight_map in (weight_maps or {}).items()}
+    return (block_keys,) + disaggregate_weights(prec_keys, weights, column_pcts, source_props_map, ok_to_agg, prop_weights)
+
+def disaggregate_segments(prec_keys, indptr, blocks, pcts, columns, source_props_map, ok_to_agg, prop_weights=None):
+    """
+    disaggregate_blocks with the pcts as CSR segments, as block_registry.make_prec_segments makes them from the compact maps:
+    the blocks (int ordinals) of precinct prec_keys[i] are blocks[indptr[i]:indptr[i + 1]], pcts (entries x columns) of each of columns
+    (the first is the default weight; prop_weights {prop: column} for the others)
+    Returns (block_ordinals, props, block_values, block_present, units): block_ordinals is the ordinal of each block (row of block_values),
+        in the order disaggregate_blocks would have its block_keys; the rest as disaggregate_blocks
+    """
+    found = set(found_precs(prec_keys, source_props_map))
+    keep = np.array([prec in found for prec in prec_keys], dtype=bool)
+    lengths = np.diff(indptr)[keep]
+    entries = np.repeat(keep, np.diff(indptr))
+    blocks = blocks[entries]
+    # Blocks are numbered in order of first appearance (as make_weight_matrix does)
+    block_ordinals, first, indices = np.unique(blocks, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    weights = sparse.csr_matrix((pcts[entries, 0], rank[indices.ravel()], np.append(0, np.cumsum(lengths)).astype(np.int64)),
+                                shape=(len(lengths), len(block_ordinals)))
+    column_pcts = {column: pcts[entries, c] for c, column in enumerate(columns) if c > 0}
+    return (block_ordinals[order],) + disaggregate_weights([prec for prec, kept in zip(prec_keys, keep.tolist()) if kept], weights, column_pcts,
+                                                           source_props_map, ok_to_agg, prop_weights)
+
+def found_precs(prec_keys, source_props_map):
+    """
+    The precincts of prec_keys that have source props (logging the others)
+    """
+    found = []
+    for srprec in prec_keys:
+        if srprec in source_props_map:
+            found.append(srprec)
+        else:
+            log.dprint("Prec Key not found: ", srprec)
+    return found
+
+def disaggregate_weights(prec_keys, weights, column_pcts, source_props_map, ok_to_agg, prop_weights=None):
+    """
+    The disaggregation of disaggregate_blocks: weights is the CSR matrix (prec_keys x blocks) of the default pcts (see make_weight_matrix),
+    column_pcts {column: pcts (of weights' entries), ...} the other weight columns
+    Returns (props, block_values, block_present, units) (see disaggregate_blocks)
+    """
+    prec_rows = [source_props_map[srprec] for srprec in prec_keys]
+    props, values, present = make_value_matrix(prec_rows, ok_to_agg)
+    log.dprint("Crosswalk: precincts: ", weights.shape[0], ", blocks: ", weights.shape[1], ", entries: ", weights.nnz, ", props: ", len(props))
+
+    pp = log.pretty_printer()
+    log.dprint("Props totals from Distributing")
+    pp.pprint(dict(zip(props, np.where(present, values, 0).sum(axis=0).tolist())))
+
+    left_out_precs = set(source_props_map.keys()) - set(prec_keys)
+    if len(left_out_precs):
+        log.dprint(f'Left out precs: {left_out_precs}')
+        log.dprint("Props totals left out from Distributing")
+        ppc = log.pretty_printer_compact()
+        left_out_props, left_out_values, left_out_present = make_value_matrix([source_props_map[srprec] for srprec in left_out_precs], ok_to_agg)
+        for srprec, has_nonzero in zip(left_out_precs, (left_out_values != 0).any(axis=1).tolist()):
+            if has_nonzero:
+                ppc.pprint(source_props_map[srprec])
+        pp.pprint(dict(zip(left_out_props, left_out_values.sum(axis=0).tolist())))
+
+    log.dprint("Build block to fields map (disaggregate)")
+    print("Build block to fields map (disaggregate)")
+    rows = np.repeat(np.arange(weights.shape[0]), np.diff(weights.indptr))
+    entry_values = np.zeros((weights.nnz, len(props)), dtype=np.int64)
+    lacking = np.zeros(values.shape, dtype=np.int64)
+    for column, cols in apportion.weight_groups(props, prop_weights, column_pcts).items():
+        pcts = weights.data if column == None else column_pcts[column]
+        entry_values[:, cols], lacking[:, cols] = apportion.largest_remainder_segments(pcts, weights.indptr, values[:, cols])
+    for r, c in np.argwhere(lacking > 0).tolist():
+        print("Distribution lacking:", prec_keys[r], props[c], int(lacking[r, c]), sep=" ")
+    # Sum the entries of each block (a block can get values from > 1 precinct)
+    entries_to_blocks = sparse.csr_matrix((np.ones(weights.nnz, dtype=np.int64), (weights.indices, np.arange(weights.nnz))),
+                                          shape=(weights.shape[1], weights.nnz))
+    block_values = entries_to_blocks @ entry_values
+    entry_present = present[rows]
+    block_present = (entries_to_blocks @ entry_present.astype(np.int64)) > 0
+    prec_layouts, layout_ranks = row_layouts(prec_rows, props)
+
+    log.dprint("Props totals")
+    pp.pprint(dict(zip(props, block_values.sum(axis=0).tolist())))
+    return props, block_values, block_present, (weights.indices, entry_present, prec_layouts[rows], layout_ranks)
+
+def make_final_blk_map(prec_blk_pct_map, source_props_map, ok_to_agg, weight_maps=None, prop_weights=None):
+    """
+    Crosswalk version of disaggregate.make_final_blk_map(log, disaggregate.make_prec_blk_key_map(...)):
+    same final block map {blkid: {prop1: val1, ...}, ...}
+    """
+    return make_block_value_map(*disaggregate_blocks(prec_blk_pct_map, source_props_map, ok_to_agg, weight_maps, prop_weights))
+
+def make_block_value_map(block_keys, props, block_values, block_present, units):
+    """
+    Final block map {blkid: {prop1: val1, ...}, ...} of what disaggregate_blocks returns, with the props of each block in the dict version's order
+    """
+    unit_blocks, unit_present, unit_layouts, layout_ranks = units
+    block_orders, orders = first_seen_orders(unit_blocks, unit_present, unit_layouts, layout_ranks, block_present)
+    final_blk_map = dict.fromkeys(block_keys)   # {blkid: {prop1: val1, prop2: val2, ...}, ...}, in block order
+    for o, order in enumerate(orders):
+        blocks = np.flatnonzero(block_orders == o)
+        names = [props[c] for c in order]
+        for b, row in zip(blocks.tolist(), block_values[np.ix_(blocks, list(order))].tolist()):
+            final_blk_map[block_keys[b]] = dict(zip(names, row))
+    return final_blk_map
+
+def block_dest(dest_block_map, block):
+    """
+    Dest of block in dest_block_map ({blkid: dest_key} or, as area_contains writes it, {blkid: [dest_key]}); None if not in the map
+    """
+    dest = dest_block_map.get(block)
+    return dest[0] if isinstance(dest, list) else dest
+
+def make_block_frame(block_keys, block_rows, dest_key, ok_to_agg):
+    """
+    block_rows: {prop: value} of each block of block_keys
+    Returns (props, values, present, is_int): the props that aggregate (ok_to_agg name, not dest_key), their values (float64, blocks x props,
+        missing and non-number values are 0), present (bool: block has a number for the prop), and is_int (prop has only integer values)
+    """
+    frame = pd.DataFrame.from_records(block_rows, index=block_keys)
+    props = [prop for prop in frame.columns if prop != dest_key and ok_to_agg(prop)]
+    values = np.zeros((len(block_keys), len(props)))
+    present = np.zeros((len(block_keys), len(props)), dtype=bool)
+    is_int = []
+    for c, prop in enumerate(props):
+        column = frame[prop]
+        number = np.ones(len(block_keys), dtype=bool)
+        if not pd.api.types.is_numeric_dtype(column.dtype):
+            # Only real numbers aggregate (as in handle_field, where "12" is a non number prop)
+            number = np.array([isinstance(v, (int, float)) for v in column.tolist()], dtype=bool)
+            if not number.all() and column.notna().any():
+                log.dprint("Non number prop: ", prop)
+            column = pd.to_numeric(column.where(number), errors='coerce')
+        if column.hasnans:
+            # A NaN value counts as 0 (as in handle_field), so only blocks without the prop at all are missing
+            number &= np.array([prop in row for row in block_rows], dtype=bool)
+        present[:, c] = number
+        values[:, c] = column.fillna(0).to_numpy(dtype=np.float64)
+        is_int.append(bool(np.all(np.mod(values[:, c], 1) == 0)))
+    return props, values, present, is_int
+
+def make_assignment_matrix(dest_block_map, block_keys, block_codes=None):
+    """
+    Returns (assignment, dest_keys, dest_codes): CSR matrix of ones, dests x blocks (block_keys), with dests in order of first appearance,
+    and the blocks that aren't in dest_block_map left out; dest_codes: dest of each block (int64, index into dest_keys, -1 ==> not in the map)
+    block_codes: the blocks' codes in a compact dest map (dest_block_map is then (codes by ordinal, dests); see block_registry.make_dest_codes)
+    """
+    if block_codes is None:
+        dest_ordinals = {}
+        dest_codes = np.full(len(block_keys), -1, dtype=np.int64)
+        for b, block in enumerate(block_keys):
+            dest = block_dest(dest_block_map, block)
+            if dest != None:
+                dest_codes[b] = dest_ordinals.setdefault(dest, len(dest_ordinals))
+        dest_keys = list(dest_ordinals.keys())
+    else:
+        mapped = np.flatnonzero(block_codes >= 0)
+        codes, first, inverse = np.unique(block_codes[mapped], return_index=True, return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        dest_codes = np.full(len(block_codes), -1, dtype=np.int64)
+        dest_codes[mapped] = rank[inverse.ravel()]
+        dests = dest_block_map[1]
+        dest_keys = [dests[code] for code in codes[order].tolist()]
+    mapped = np.flatnonzero(dest_codes >= 0)
+    assignment = sparse.csr_matrix((np.ones(len(mapped)), (dest_codes[mapped], mapped)), shape=(len(dest_keys), len(dest_codes)))
+    return assignment, dest_keys, dest_codes
+
+def as_number(value, is_int):
+    return int(round(value)) if is_int else value
+
+def add_block_values(acc, block_keys, props, values, present, is_int, units=None, block_ordinals=None):
+    """
+    Crosswalk version of aggregate.add_block for all blocks at once: adds values (blocks x props; present: block has the prop,
+    is_int: prop has only integer values) of the blocks of block_keys into accumulator acc (see aggregate.make_accumulator),
+    with a sparse reduction (dests x blocks assignment matrix times block values)
+    units: (block of each unit, unit present, unit layouts, layout ranks): the rows the dict version adds, in order, for the order of
+        the props of each dest (see first_seen_orders); None ==> one unit per block, with its props in props order
+    block_ordinals: the blocks as ordinals of the registry of a compact acc (instead of block_keys, which can be None then)
+    """
+    dest_key = acc["dest_key"]
+    dest_block_map = acc["dest_block_map"]
+    registry = acc["registry"]
+    block_codes = None
+    if registry != None:
+        block_codes = block_registry.lookup_dest_codes(registry, dest_block_map, block_keys, block_ordinals)
+        unmapped = np.flatnonzero(block_codes < 0)
+        unmapped_keys = [block_keys[b] for b in unmapped.tolist()] if block_ordinals is None else block_registry.block_ids(registry, block_ordinals[unmapped])
+    else:
+        unmapped = [b for b, block in enumerate(block_keys) if not (block in dest_block_map)]
+        unmapped_keys = [block_keys[b] for b in unmapped]
+    tot_col = props.index("TOT") if "TOT" in props else None
+    for b, block in zip(list(unmapped), unmapped_keys):
+        tot = as_number(values[b, tot_col], is_int[tot_col]) if tot_col != None and present[b, tot_col] else 0
+        log.dprint("blk not in map: " + block + ", Tot: " + str(tot))
+
+    assignment, dest_keys, dest_codes = make_assignment_matrix(dest_block_map, block_keys, block_codes)
+    dest_values = assignment @ values
+    dest_present = (assignment @ present.astype(np.float64)) > 0
+    if units == None:
+        units = (np.arange(len(block_keys)), present, np.zeros(len(block_keys), dtype=np.int64), np.arange(len(props)).reshape(1, -1))
+    unit_blocks, unit_present, unit_layouts, layout_ranks = units
+    dest_orders, orders = first_seen_orders(dest_codes[unit_blocks], unit_present, unit_layouts, layout_ranks, dest_present)
+    mapped = np.asarray(assignment.sum(axis=0)).ravel() > 0
+
+    totals = values[mapped].sum(axis=0).tolist()
+    counts = present[mapped].sum(axis=0).tolist()
+    for c, prop in enumerate(props):
+        if counts[c] > 0 and prop != dest_key:
+            total = as_number(totals[c], is_int[c])
+            acc["props_total"][prop] = acc["props_total"][prop] + total if prop in acc["props_total"] else total
+            acc["props_count"][prop] = acc["props_count"][prop] + counts[c] if prop in acc["props_count"] else counts[c]
+
+    result_props = acc["result_props"]
+    for d, vtd in enumerate(dest_keys):
+        if not (vtd in result_props):
+            result_props[vtd] = {dest_key: vtd}
+        dest_props = result_props[vtd]
+        for c in orders[dest_orders[d]]:
+            prop = props[c]
+            if prop != dest_key:
+                value = as_number(float(dest_values[d, c]), is_int[c])
+                dest_props[prop] = dest_props[prop] + value if prop in dest_props else value
+
+def add_block_rows(acc, block_keys, block_rows):
+    """
+    Crosswalk version of the aggregate.add_block loop: adds blocks of block_keys, with their {prop: value} in block_rows
+    (a block can appear more than once, as in a geojson), into accumulator acc (see aggregate.make_accumulator)
+    """
+    add_block_rows_multi([acc], block_keys, block_rows)
+
+def add_block_rows_multi(accs, block_keys, block_rows):
+    """
+    add_block_rows into each accumulator of accs (one per dest geography), building the block values once for all of them
+    """
+    dest_keys = set(acc["dest_key"] for acc in accs)
+    props, values, present, is_int = make_block_frame(block_keys, block_rows, dest_keys.pop() if len(dest_keys) == 1 else None, accs[0]["ok_to_agg"])
+    layouts, ranks = row_layouts(block_rows, props)
+    for acc in accs:
+        keep = [c for c, prop in enumerate(props) if prop != acc["dest_key"]]
+        add_block_values(acc, block_keys, [props[c] for c in keep], values[:, keep], present[:, keep], [is_int[c] for c in keep],
+                         (np.arange(len(block_keys)), present[:, keep], layouts, ranks[:, keep]))
@@ -8,6 +8,9 @@ import pprint
 import json
 import os
 import csv
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # *** Dependent modules that are part of the same repository
 from . import statecodes                   # Maps two-letter state codes to two-digit Census state codes
@@ -16,6 +19,9 @@ from . import disaggregate as disagg
 from . import aggregate as agg
 from . import disagg_agg_verify as verify
 from . import agg_logging as log
+from . import manifest
+from . import json_stream
+from . import block_registry
 
 # *** Dependent module that must be supplied by the user
 #   prepare.prepare(state) is a hook to do any file moving/copying/unzipping/preprocessing
@@ -29,14 +35,7 @@ def ok_to_agg(prop, value=0):
     """
     Filter out props that we know we shouldn't aggregate
     """
-    if (prop.lower()[0:4] != 'name' and prop.lower()[0:6] != 'county' and prop.lower()[0:8] != 'precinct' and prop.lower() != 'id' and
-            prop.lower() != 'objectid' and prop.lower()[0:4] != 'area' and prop.lower() != 'pct' and prop.lower() != 'district' and
-            prop.lower()[0:4] != 'fips' and prop.lower()[0:3] != 'cty' and prop.lower()[0:4] != 'ward' and prop.lower()[0:5] != 'geoid' and
-            prop.lower() != 'blkgrp' and prop.lower()[0:6] != 'logrec' and prop.lower() != 'state' and prop.lower() != 'sumlevel' and
-            prop.lower() != 'tract' and prop.lower()[0:7] != 'correct' and prop.lower() != 'vtd_name' and prop.lower()[0:5] != 'vtdst' and
-            prop.lower() != 'prec_id' and prop.lower() != 'enr_desc' and prop.lower().endswith('_fips') != True and
-            prop.lower()[0:5] != 'state' and prop.lower() != 'p16' and prop.lower() != 'p18' and prop.lower() != 'geometry' and
-            prop.lower() != 'srprec' and prop.lower() != 'srprec_key' and prop.lower() != 'geo_type'):
+    if ok_to_agg_name(prop):
         # Now make sure it's numeric
         try:
             intval = int(value)
@@ -45,21 +44,253 @@ def ok_to_agg(prop, value=0):
             return False
     return False
 
+@lru_cache(maxsize=None)
+def ok_to_agg_name(prop):
+    """
+    The name rules of ok_to_agg, evaluated once per prop name
+    """
+    name = prop.lower()
+    return (name[0:4] != 'name' and name[0:6] != 'county' and name[0:8] != 'precinct' and name != 'id' and
+            name != 'objectid' and name[0:4] != 'area' and name != 'pct' and name != 'district' and
+            name[0:4] != 'fips' and name[0:3] != 'cty' and name[0:4] != 'ward' and name[0:5] != 'geoid' and
+            name != 'blkgrp' and name[0:6] != 'logrec' and name != 'state' and name != 'sumlevel' and
+            name != 'tract' and name[0:7] != 'correct' and name != 'vtd_name' and name[0:5] != 'vtdst' and
+            name != 'prec_id' and name != 'enr_desc' and name.endswith('_fips') != True and
+            name[0:5] != 'state' and name != 'p16' and name != 'p18' and name != 'geometry' and
+            name != 'srprec' and name != 'srprec_key' and name != 'geo_type')
+
+
+def get_map_options(config, paths):
+    """
+    Options from config (and paths) that are passed along to area_contains.make_target_source_map
+    -- bulkQuery: True ==> one bulk spatial index query and vectorized intersections instead of the per-source loop
+    -- preparedFastPath: True ==> blocks strictly inside a prepared precinct shape skip the intersection
+    -- hierarchicalMap: True ==> precincts are intersected with block groups first; only blocks of straddling block groups are tested
+        (block group shapes from paths["blkgrp_geo_path"] keyed by paths["blkgrp_key"] if present, else dissolved from the blocks)
+    -- mapWorkers: > 1 ==> blocks are split into county shards that are mapped in that many worker processes
+    -- geoCache: True ==> geometry is read thru a GeoParquet cache (reprojected, repaired, key column only) in paths["working_path"] + "geo_cache/"
+    -- nearestFallback: True ==> blocks that overlap nothing go to the nearest larger shape
+        (optionally no farther than nearestMaxDistance, in CRS units, and only in the block's county if nearestSameCounty)
+    -- repairGeometry: True ==> invalid geometry is repaired once when it's read (an intersection that still fails gets the usual fallback)
+    -- mapBbox: [minx, miny, maxx, maxy] in the block geometry's CRS ==> only geometry meeting that box is read and mapped
+    """
+    return {
+        "bulk_query": config["bulkQuery"] if "bulkQuery" in config else False,
+        "use_prepared": config["preparedFastPath"] if "preparedFastPath" in config else False,
+        "hierarchical": config["hierarchicalMap"] if "hierarchicalMap" in config else False,
+        "blkgrp_path": paths["blkgrp_geo_path"] if "blkgrp_geo_path" in paths else None,
+        "blkgrp_key": paths["blkgrp_key"] if "blkgrp_key" in paths else "GEOID",
+        "workers": config["mapWorkers"] if "mapWorkers" in config else 1,
+        "cache_dir": (paths["working_path"] + "geo_cache/") if ("geoCache" in config and config["geoCache"]) else None,
+        "nearest_fallback": config["nearestFallback"] if "nearestFallback" in config else False,
+        "nearest_max_distance": config["nearestMaxDistance"] if "nearestMaxDistance" in config else None,
+        "nearest_same_county": config["nearestSameCounty"] if "nearestSameCounty" in config else False,
+        "repair_geometry": config["repairGeometry"] if "repairGeometry" in config else False,
+        "bbox": tuple(config["mapBbox"]) if "mapBbox" in config else None
+    }
+
+
+def get_weight_options(config, paths):
+    """
+    Options from config (and paths) for the block weights that steps 3, 5 and 8 disaggregate with (see disaggregate.make_prec_pct_maps)
+    -- paths["block_weight_path"]: multi-column block weight table (JSON {blkid: {column: weight, ...}, ...} or csv) used instead of block_pop_path
+    -- weightRules: {prop name regex: weight column, ...} ==> props matching a regex (first match wins) are apportioned with that column (a column not in the table
+        is logged and the default column used instead)
+    -- defaultWeight: weight column for all other props (default "TOT"; must be in the table)
+    """
+    return {
+        "weight_path": paths["block_weight_path"] if "block_weight_path" in paths else None,
+        "weight_rules": tuple(config["weightRules"].items()) if "weightRules" in config else None,
+        "default_weight": config["defaultWeight"] if "defaultWeight" in config else None
+    }
+
+
+def load_json(path, pipeline=None):
+    """
+    The json file at path; pipeline: {path: object} of pipeline mode (see run_steps) ==> what a step made (or loaded) comes from pipeline,
+    without reading (or parsing) the file again, and a file that's read is kept there for the steps that follow
+    """
+    if pipeline != None and path in pipeline:
+        return pipeline[path]
+    result = json_stream.load(path)
+    if pipeline != None:
+        pipeline[path] = result
+    return result
+
 
-def make_block_map(state, stateCode, large_geo_path, large_geo_key, block_geo_path, block_key, block2geo_path, year, isDemographicData, use_index_for_large_key=False, sourceIsBlkGrp=False):
+def write_json(result, path, pipeline=None, checkpoint=True):
+    """
+    Writes result to path as json; in pipeline mode (see load_json) it's handed to the following steps in pipeline,
+    and only written if checkpoint
+    """
+    if pipeline != None:
+        pipeline[path] = result
+    if pipeline == None or checkpoint:
+        with open(path, 'w') as outf:
+            json.dump(result, outf, ensure_ascii=False)
+
+
+def in_pipeline(path, pipeline=None):
+    """
+    What a step made for path, if it's in pipeline, else path (for functions that take either, and read the file themselves)
+    """
+    return pipeline[path] if pipeline != None and path in pipeline else path
+
+
+def read_block_weights(block_pop_path, weight_options=None, pipeline=None, registry=None):
+    """
+    Block weights for disaggregation: weight_options["weight_path"] (if given) else block_pop_path
+    pipeline: see load_json; the weights are read once for all of the steps
+    registry: block registry ==> the weights are encoded, as arrays by block ordinal (see block_registry.encode_block_weights)
+    """
+    weight_path = weight_options["weight_path"] if weight_options != None and weight_options["weight_path"] != None else block_pop_path
+    key = weight_path if registry == None else (weight_path, "encoded")
+    if pipeline != None and key in pipeline:
+        return pipeline[key]
+    block_pop_map = disagg.read_block_weights(weight_path)
+    if registry != None:
+        block_pop_map = block_registry.encode_block_weights(registry, block_pop_map)
+    if pipeline != None:
+        pipeline[key] = block_pop_map
+    return block_pop_map
+
+
+def load_block_map(block2geo_path, pipeline=None, registry=None):
+    """
+    Block map {blkid: [key], ...} at block2geo_path (or from pipeline, see load_json)
+    registry: block registry ==> the map is encoded, as int32 arrays of block ordinals and key codes (see block_registry.encode_block_map)
+    """
+    if pipeline != None and block2geo_path in pipeline:
+        return pipeline[block2geo_path]
+    block_map = json_stream.load(block2geo_path)
+    if registry != None:
+        block_map = block_registry.encode_block_map(registry, block_map)
+    if pipeline != None:
+        pipeline[block2geo_path] = block_map
+    return block_map
+
+
+def weight_kwargs(weight_options):
+    return {} if weight_options == None else {"weight_rules": weight_options["weight_rules"], "default_weight": weight_options["default_weight"]}
+
+
+def overlap_table_path(block2geo_path):
+    """
+    Path of the full overlap table that goes with a block map (block_to_X_map.json ==> block_to_X_map_overlap.npz)
+    """
+    return os.path.splitext(block2geo_path)[0] + "_overlap.npz"
+
+
+def make_block_map(state, stateCode, large_geo_path, large_geo_key, block_geo_path, block_key, block2geo_path, year, isDemographicData, use_index_for_large_key=False, sourceIsBlkGrp=False, map_options=None, saveOverlap=False,
+                   force=False, pipeline=None, checkpoint=True, registry=None, remake=False):
     """
     Invokes area_contains: takes larger (precinct) geometry, smaller (block) geometry, and produces smaller ==> larger mapping (JSON)
+    map_options: keyword options for area_contains.make_target_source_map (see get_map_options)
+    saveOverlap: True ==> also keep the full overlap table (see overlap_table_path); when that table was made with the same keys and map
+        options from geometry files with the same contents (see overlap_table_metadata), the block map is rebuilt from it without any geometry work
+    force: True ==> the map is made from geometry even if the file times say it (or the overlap table) is current
+    remake: True ==> the map is made even if the file times say it's current, from the overlap table if that's current (the manifest decided
+        the step runs; see run_steps_with_manifest)
+    pipeline, checkpoint: pipeline mode (see write_json); registry: block registry ==> the map is handed on encoded (see write_block_map)
     """
-    if os.path.exists(block2geo_path) and os.path.getmtime(block2geo_path) > os.path.getmtime(large_geo_path):
+    if not (force or remake) and block_map_is_current(block2geo_path, large_geo_path):
         log.dprint("Block map already exists: ", block2geo_path)
         return
 
-    log.dprint('Making block map:\n\t(', large_geo_path, ',', block_geo_path, ') ==>\n\t\t', block2geo_path) 
-    block_map = ac.make_target_source_map(large_geo_path, block_geo_path, large_geo_key, block_key, use_index_for_large_key, state, year, isDemographicData, sourceIsBlkGrp)
+    overlap_path = overlap_table_path(block2geo_path) if saveOverlap else None
+    overlap_metadata = overlap_table_metadata(overlap_path, large_geo_path, large_geo_key, block_geo_path, block_key, use_index_for_large_key, map_options)
+    if not force and overlap_table_is_current(overlap_path, overlap_metadata):
+        log.dprint('Making block map from overlap table:\n\t', overlap_path, ' ==>\n\t\t', block2geo_path)
+        block_map = ac.make_target_source_map_from_overlap(overlap_path, sourceIsBlkGrp)
+    else:
+        log.dprint('Making block map:\n\t(', large_geo_path, ',', block_geo_path, ') ==>\n\t\t', block2geo_path) 
+        block_map = ac.make_target_source_map(large_geo_path, block_geo_path, large_geo_key, block_key, use_index_for_large_key, state, year, isDemographicData, sourceIsBlkGrp, overlap_path=overlap_path,
+                                              overlap_metadata=overlap_metadata, **(map_options or {}))
 
-    log.dprint('Writing block map\n')
-    with open(block2geo_path, 'w') as outf:
-        json.dump(block_map, outf, ensure_ascii=False)
+    write_block_map(block_map, block2geo_path, pipeline, checkpoint, registry)
+
+
+def make_block_maps(state, stateCode, large_geo_list, block_geo_path, block_key, year, isDemographicData, map_options=None, saveOverlap=False, force=False,
+                    pipeline=None, checkpoints=(), registry=None, remake=False):
+    """
+    Like make_block_map for several larger geometries (e.g. source and dest precincts) at once: the block geometry is read once,
+    and its spatial index and areas are shared by all of the maps
+    large_geo_list: [(large_geo_path, large_geo_key, block2geo_path, use_index_for_large_key, sourceIsBlkGrp), ...]
+    pipeline: pipeline mode (see write_json); checkpoints: the block2geo_paths to write in pipeline mode; registry, force, remake: see make_block_map
+    """
+    larger_list = []
+    block2geo_paths = []
+    for large_geo_path, large_geo_key, block2geo_path, use_index_for_large_key, sourceIsBlkGrp in large_geo_list:
+        if not force and not remake and block_map_is_current(block2geo_path, large_geo_path):
+            log.dprint("Block map already exists: ", block2geo_path)
+            continue
+        overlap_path = overlap_table_path(block2geo_path) if saveOverlap else None
+        overlap_metadata = overlap_table_metadata(overlap_path, large_geo_path, large_geo_key, block_geo_path, block_key, use_index_for_large_key, map_options)
+        if not force and overlap_table_is_current(overlap_path, overlap_metadata):
+            # Nothing that needs the block geometry
+            make_block_map(state, stateCode, large_geo_path, large_geo_key, block_geo_path, block_key, block2geo_path, year, isDemographicData, use_index_for_large_key, sourceIsBlkGrp, map_options, saveOverlap,
+                           pipeline=pipeline, checkpoint=block2geo_path in checkpoints, registry=registry, remake=remake)
+        else:
+            log.dprint('Making block map:\n\t(', large_geo_path, ',', block_geo_path, ') ==>\n\t\t', block2geo_path) 
+            larger_list.append((large_geo_path, large_geo_key, use_index_for_large_key, sourceIsBlkGrp, overlap_path, overlap_metadata))
+            block2geo_paths.append(block2geo_path)
+
+    if len(larger_list) > 0:
+        block_maps = ac.make_target_source_maps(larger_list, block_geo_path, block_key, state, year, isDemographicData, **(map_options or {}))
+        for block_map, block2geo_path in zip(block_maps, block2geo_paths):
+            write_block_map(block_map, block2geo_path, pipeline, block2geo_path in checkpoints, registry)
+
+
+def block_map_is_current(block2geo_path, large_geo_path):
+    return os.path.exists(block2geo_path) and os.path.getmtime(block2geo_path) > os.path.getmtime(large_geo_path)
+
+
+def overlap_table_metadata(overlap_path, large_geo_path, large_geo_key, block_geo_path, block_key, use_index_for_large_key, map_options):
+    """
+    Metadata kept with the overlap table at overlap_path (None if there's no table): {"params": hash of the keys and map options the table is
+    made with, "files": {path: {"stat": ..., "sha1": ...}}} for the geometry files it's made from (the block group geometry, too, if hierarchical).
+    The map options leave out mapWorkers (shards make the same table) and where the geo cache is (but not whether there is one).
+    As in the manifest, a file is only hashed again if its size or mtime changed since the table at overlap_path was written.
+    """
+    if overlap_path == None:
+        return None
+    options = dict(map_options or {})
+    options.pop("workers", None)
+    options["cache_dir"] = "cache_dir" in options and options["cache_dir"] != None
+    params = {"large_geo_key": large_geo_key, "block_key": block_key, "use_index_for_large_key": use_index_for_large_key, "map_options": options}
+    input_paths = [large_geo_path, block_geo_path]
+    if options.get("hierarchical") and options.get("blkgrp_path") != None:
+        input_paths.append(options["blkgrp_path"])
+
+    table_metadata = ac.read_overlap_metadata(overlap_path) if os.path.exists(overlap_path) else {}
+    known_files = {"files": dict(table_metadata["files"]) if "files" in table_metadata else {}}
+    manifest.file_hashes(known_files, input_paths)
+    return {"params": manifest.params_hash(params), "files": {path: known_files["files"][path] for path in input_paths if path in known_files["files"]}}
+
+
+def overlap_table_is_current(overlap_path, overlap_metadata):
+    """
+    True ==> the overlap table at overlap_path was made with the params and from the file contents of overlap_metadata (see overlap_table_metadata)
+    Tables written without metadata are never current.
+    """
+    if overlap_path == None or not os.path.exists(overlap_path):
+        return False
+    table_metadata = ac.read_overlap_metadata(overlap_path)
+    if not ("params" in table_metadata and "files" in table_metadata) or table_metadata["params"] != overlap_metadata["params"]:
+        return False
+    table_hashes = {path: known["sha1"] for path, known in table_metadata["files"].items()}
+    return table_hashes == {path: known["sha1"] for path, known in overlap_metadata["files"].items()}
+
+
+def write_block_map(block_map, block2geo_path, pipeline=None, checkpoint=True, registry=None):
+    """
+    Writes block_map (see write_json); registry: block registry ==> it's handed on in pipeline encoded (see block_registry.encode_block_map)
+    """
+    if pipeline == None or checkpoint:
+        log.dprint('Writing block map: ', block2geo_path, '\n')
+        write_json(block_map, block2geo_path)
+    if pipeline != None:
+        pipeline[block2geo_path] = block_map if registry == None else block_registry.encode_block_map(registry, block_map)
 
 """
 TBD: when CA has all of their 2024 data, we need to felsh out this function. We should make the block2src map from the sr2blk map that they publish.
@@ -73,21 +304,30 @@ def make_block_map_from_map(state, stateCode, source_path, source_key, block2sou
         json.dump(final_map, block2bg_file, ensure_ascii=False)
 """
 
-def makeTrivialBlock2BG(state, block_pop_path, block2source_map_path):
+def makeTrivialBlock2Source(state, year, destyear, block_pop_path, block2source_map_path, acs_root, force=False, pipeline=None, checkpoint=True, registry=None):
+    """
+    Source is block groups (sourceIsBlkGrp) and year >= destyear: block ==> block group map comes from the block ids, not geometry
+    pipeline, checkpoint: pipeline mode (see write_json); registry: see write_block_map
+    """
+    if force or not os.path.exists(block2source_map_path):
+        if state == "CT" and year >= 2022 and destyear == 2020:
+            makeTrivialBlock2BG_CT(state, year, block_pop_path, block2source_map_path, acs_root, pipeline, checkpoint, registry)
+        else:
+            makeTrivialBlock2BG(state, block_pop_path, block2source_map_path, pipeline, checkpoint, registry)
+
+def makeTrivialBlock2BG(state, block_pop_path, block2source_map_path, pipeline=None, checkpoint=True, registry=None):
     final_map = {}
-    with open(block_pop_path) as block_pop_json:
-        block_pop_map = json.load(block_pop_json)
-        for block in block_pop_map.keys():
-            final_map[block] = [block[0:12]]
-    with open(block2source_map_path, "w") as block2bg_file:
-        json.dump(final_map, block2bg_file, ensure_ascii=False)
+    block_pop_map = load_json(block_pop_path, pipeline)
+    for block in block_pop_map.keys():
+        final_map[block] = [block[0:12]]
+    write_block_map(final_map, block2source_map_path, pipeline, checkpoint, registry)
 
-def makeTrivialBlock2BG_CT(state, year, block_pop_path, block2source_map_path, acs_root):
+def makeTrivialBlock2BG_CT(state, year, block_pop_path, block2source_map_path, acs_root, pipeline=None, checkpoint=True, registry=None):
     cvap_path = f'{acs_root}ct_cvap_{str(year)}_2020_b.csv'
 
     final_map = {}
-    with open(block_pop_path) as block_pop_json, open(cvap_path) as cvap_csv_file:
-        block_pop_map = json.load(block_pop_json)
+    block_pop_map = load_json(block_pop_path, pipeline)
+    with open(cvap_path) as cvap_csv_file:
         cvap_csv_data = csv.DictReader(cvap_csv_file, delimiter=',')
 
         for row in tqdm(cvap_csv_data):
@@ -98,51 +338,116 @@ def makeTrivialBlock2BG_CT(state, year, block_pop_path, block2source_map_path, a
         #        final_map[block] = [inv_cross_map[block[0:12]]]
         #    else:
         #        print("BG not found in cross map:", block[0:12])
-    with open(block2source_map_path, "w") as block2bg_file:
-        json.dump(final_map, block2bg_file, ensure_ascii=False)
+    write_block_map(final_map, block2source_map_path, pipeline, checkpoint, registry)
 
 
-def disaggregate_data(state, stateCode, large_data_path, large_key, block2geo_path, block_key, block_pop_path, block_data_from_geo_path, use_index_for_large_key=False, isDemographicData=False, source_year=None, listpropsonly=False, sourceIsCsv=False):
+def disaggregate_data(state, stateCode, large_data_path, large_key, block2geo_path, block_key, block_pop_path, block_data_from_geo_path, use_index_for_large_key=False, isDemographicData=False, source_year=None, listpropsonly=False, sourceIsCsv=False, engine="dict", weight_options=None,
+                      pipeline=None, checkpoint=True, registry=None):
     """
     Invokes disaggregate: takes larger (precinct) data, block population map, smaller-larger mapping, and produces smaller (block) data (JSON)
+    engine: "dict" or "crosswalk" (sparse matrices; see disaggregate.disaggregate_precs)
+    weight_options: block weight table and per-prop weight rules (see get_weight_options); None ==> every prop by block_pop_path
+    pipeline, checkpoint: pipeline mode (see load_json, write_json)
+    registry: block registry ==> the block map and weights are used encoded (see load_block_map, read_block_weights)
     """
     log.dprint('Making block_data_from_geo:\n\t(', large_data_path, ',', block_pop_path, ',', block2geo_path, ') ==>\n\t\t', block_data_from_geo_path)
 
-    with open(block_pop_path) as block_pop_json:
-        block_pop_map = json.load(block_pop_json)
+    block_pop_map = read_block_weights(block_pop_path, weight_options, pipeline, registry)
 
     # Option here to supply different disaggregation algorithm for isDemographicData == True
-    final_blk_map = disagg.make_block_props_map(log, large_data_path, block2geo_path, block_pop_map, large_key, use_index_for_large_key, ok_to_agg, state, source_year, listpropsonly, sourceIsCsv=sourceIsCsv)
+    final_blk_map = disagg.make_block_props_map(log, large_data_path, load_block_map(block2geo_path, pipeline, registry), block_pop_map, large_key, use_index_for_large_key, ok_to_agg, state, source_year, listpropsonly, sourceIsCsv=sourceIsCsv, engine=engine,
+                                                registry=registry, **weight_kwargs(weight_options))
 
     if final_blk_map:
-        log.dprint('Writing block_data_from_geo\n')
-        with open(block_data_from_geo_path, 'w') as outf:
-            json.dump(final_blk_map, outf, ensure_ascii=False)
+        log.dprint('Writing block_data_from_geo\n' if pipeline == None or checkpoint else 'Block data from geo in memory\n')
+        write_json(final_blk_map, block_data_from_geo_path, pipeline, checkpoint)
 
 
-def disaggregate_data_ca(state, stateCode, large_data_path, block2geo_path, block_key, block_data_from_geo_path, source_year=None, listpropsonly=False):
+def disaggregate_data_ca(state, stateCode, large_data_path, block2geo_path, block_key, block_data_from_geo_path, source_year=None, listpropsonly=False, engine="dict",
+                         pipeline=None, checkpoint=True):
     """
     Invokes disaggregate: takes larger (precinct) data, block population map, smaller-larger mapping, and produces smaller (block) data (JSON)
+    pipeline, checkpoint: pipeline mode (see write_json)
     """
     log.dprint('Making block_data_from_geo:\n\t(', large_data_path, ',', block2geo_path, ') ==>\n\t\t', block_data_from_geo_path)
 
-    final_blk_map = disagg.make_block_props_map_ca(log, large_data_path, block2geo_path, ok_to_agg, source_year, listpropsonly)
+    final_blk_map = disagg.make_block_props_map_ca(log, large_data_path, block2geo_path, ok_to_agg, source_year, listpropsonly, engine)
 
     if final_blk_map:
-        log.dprint('Writing block_data_from_geo\n')
-        with open(block_data_from_geo_path, 'w') as outf:
-            json.dump(final_blk_map, outf, ensure_ascii=False)
+        log.dprint('Writing block_data_from_geo\n' if pipeline == None or checkpoint else 'Block data from geo in memory\n')
+        write_json(final_blk_map, block_data_from_geo_path, pipeline, checkpoint)
 
 
-def aggregate_source2dest(state, stateCode, block_data_path, block2geo_path, large_geo_key, dest_data_path, srcIsGeojson=False):
+def aggregate_source2dest(state, stateCode, block_data_path, block2geo_path, large_geo_key, dest_data_path, srcIsGeojson=False, engine="dict", stream=False):
     """
     Invokes aggregate: takes smaller (block) data, smaller-larger mapping, and produces larger (precinct) data (GEOJSON)
+    engine: "dict" or "crosswalk" (sparse reduction; see aggregate.make_aggregated_props)
+    stream: True ==> the block data and map are read incrementally instead of loaded whole (see aggregate.make_aggregated_props)
     """
-    log.dprint ('Making dest_data:\n\t(', block_data_path, ',', block2geo_path, ') ==>\n\t\t', dest_data_path)
-    aggregated_props = agg.make_aggregated_props(block_data_path, block2geo_path, large_geo_key, ok_to_agg, srcIsGeojson)
+    aggregate_source2dests(state, stateCode, block_data_path, [(block2geo_path, large_geo_key, dest_data_path)], srcIsGeojson, engine, stream)
+
+
+def aggregate_source2dests(state, stateCode, block_data_path, targets, srcIsGeojson=False, engine="dict", stream=False, pipeline=None, registry=None):
+    """
+    aggregate_source2dest for many larger geographies (precincts, counties, districts, block groups, ...) with one read of the block data
+    targets: list of (block2geo_path, large_geo_key, dest_data_path); each target gets its own dest data (GEOJSON)
+    pipeline: pipeline mode (see load_json): block data and maps that are in memory are used as they are; the dest data is always written
+    registry: block registry ==> the maps become compact dest indexes (encoded maps from pipeline, else read incrementally from the file;
+        see aggregate.make_dest_index), and the blocks are looked up in them a batch at a time
+    """
+    for block2geo_path, large_geo_key, dest_data_path in targets:
+        log.dprint ('Making dest_data:\n\t(', block_data_path, ',', block2geo_path, ') ==>\n\t\t', dest_data_path)
+    if registry != None:
+        dest_maps = [block_registry.make_dest_index(registry, pipeline[block2geo_path]) if pipeline != None and block2geo_path in pipeline else agg.make_dest_index(block2geo_path)
+                     for block2geo_path, large_geo_key, dest_data_path in targets]
+    else:
+        dest_maps = [in_pipeline(block2geo_path, pipeline) for block2geo_path, large_geo_key, dest_data_path in targets]
+    all_aggregated_props = agg.make_aggregated_props_multi(in_pipeline(block_data_path, pipeline), [(dest_map, large_geo_key) for dest_map, (block2geo_path, large_geo_key, dest_data_path) in zip(dest_maps, targets)],
+                                                           ok_to_agg, srcIsGeojson, engine, stream)
+    for (block2geo_path, large_geo_key, dest_data_path), aggregated_props in zip(targets, all_aggregated_props):
+        log.dprint('Writing dest data: ', dest_data_path, '\n')
+        write_json(aggregated_props, dest_data_path, pipeline)
+
+
+def disaggregate_aggregate(state, stateCode, large_data_path, large_key, block2geo_path, block_pop_path, block2dest_path, dest_key, agg_data_path,
+                           use_index_for_large_key=False, source_year=None, listpropsonly=False, sourceIsCsv=False, engine="dict", block_data_path=None, isCA=False, weight_options=None,
+                           pipeline=None, registry=None):
+    """
+    Steps 3 and 4 in one: disaggregates larger (precinct) data to blocks and aggregates the blocks straight into dest data (GEOJSON),
+    without writing (and reading back) the block data
+    block_data_path: if given, the block data (JSON) is written, too
+    isCA: True ==> large_data_path and block2geo_path are California's SRPREC csv files (see disaggregate_data_ca)
+    weight_options: as for disaggregate_data
+    pipeline: pipeline mode (see load_json, write_json); the block data (if block_data_path) and dest data are written
+    registry: block registry ==> the block maps and weights are used encoded (see disaggregate_data), and the blocks go into the dests
+        by block ordinal (see block_registry.make_dest_codes; for isCA, whose blocks come from its csv files, the map is decoded)
+    """
+    log.dprint('Making dest_data:\n\t(', large_data_path, ',', block_pop_path, ',', block2geo_path, ',', block2dest_path, ') ==>\n\t\t', agg_data_path)
+
+    if registry != None and not isCA:
+        acc = agg.make_accumulator(block_registry.make_dest_codes(registry, load_block_map(block2dest_path, pipeline, registry)), dest_key, ok_to_agg, registry)
+    elif registry != None:
+        acc = agg.make_accumulator(block_registry.decode_block_map(registry, load_block_map(block2dest_path, pipeline, registry)), dest_key, ok_to_agg)
+    else:
+        acc = agg.make_accumulator(load_json(block2dest_path, pipeline), dest_key, ok_to_agg)
+    sink = acc if block_data_path == None else None
+
+    if isCA:
+        final_blk_map = disagg.make_block_props_map_ca(log, large_data_path, block2geo_path, ok_to_agg, source_year, listpropsonly, engine, sink)
+    else:
+        block_pop_map = read_block_weights(block_pop_path, weight_options, pipeline, registry)
+        final_blk_map = disagg.make_block_props_map(log, large_data_path, load_block_map(block2geo_path, pipeline, registry), block_pop_map, large_key, use_index_for_large_key, ok_to_agg, state, source_year, listpropsonly, sourceIsCsv=sourceIsCsv, engine=engine, sink=sink,
+                                                    registry=registry, **weight_kwargs(weight_options))
+    if listpropsonly:
+        return
+
+    if block_data_path != None:
+        log.dprint('Writing block_data_from_geo: ', block_data_path, '\n')
+        write_json(final_blk_map, block_data_path, pipeline)
+        agg.add_block_props(acc, final_blk_map, engine=engine)
+
     log.dprint('Writing dest data\n')
-    with open(dest_data_path, 'w') as outf:
-        json.dump(aggregated_props, outf, ensure_ascii=False)
+    write_json(agg.make_feature_collection(acc), agg_data_path, pipeline)
 
 
 def process_state(root_paths, state, steps, state_codes, year, destyear, config): 
@@ -174,12 +479,50 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
               [Requires: source_data_path, block2source_map_path, block_pop_path]
         -- 4: aggregate (to agg_data_from_source_path) 
               [Requires: block_data_from_source_path, block2dest_map_path]
+              (optional paths["agg_targets"]: list of (block map path, key, output path) of more geographies to aggregate to in the same pass,
+               e.g. counties or districts)
         -- 5: disaggregate (to block_data_from_dest_path)           [Use this to get block data from the dest_geo/data]
               [Requires: dest_data_path, block2dest_map_path, block_pop_path]
         -- 6: verify 
               [Requires: source_data_path, agg_data_from_source_path]
+        -- 7: steps 1 and 2 together, reading the block geometry (and building its spatial index) once for both maps
+              [Requires: source_geo_path, dest_geo_path, block_geo_path]
+        -- 8: steps 3 and 4 together: disaggregated block values go straight into the dest totals (block data file only if writeBlockData)
+              [Requires: source_data_path, block2source_map_path, block_pop_path, block2dest_map_path, agg_data_from_source_path]
     -- sourceIsBlkGrp: True ==> source_geo is block group geometry (allowing us to use that if blocks don't fall in any block group)
     -- isDemographicData: True ==> could use specific demographic population values to disaggregate, if available
+    -- bulkQuery: True ==> steps 1 and 2 build the map with one bulk spatial index query and vectorized intersections
+    -- preparedFastPath: True ==> steps 1 and 2 skip the intersection for blocks strictly inside a precinct
+    -- saveOverlap: True ==> steps 1 and 2 also write the full (block, source, pct) overlap table next to the block map, and later runs remake
+         the map from it while the keys, map options and geometry file contents are the same (not with hierarchicalMap, which doesn't compute
+         the overlaps of blocks in block groups within a single precinct)
+    -- hierarchicalMap: True ==> steps 1 and 2 only test blocks individually in block groups that straddle precincts
+         (optional paths["blkgrp_geo_path"] / paths["blkgrp_key"] give block group shapes; otherwise they're dissolved from the blocks)
+    -- mapWorkers: N ==> steps 1 and 2 map county shards of the blocks in N worker processes
+    -- geoCache: True ==> steps 1 and 2 keep reprojected, repaired geometry (key column only) as GeoParquet in working_path + "geo_cache/"
+    -- nearestFallback: True ==> steps 1 and 2 assign blocks that overlap nothing to the nearest precinct
+         (nearestMaxDistance: limit in CRS units; nearestSameCounty: True ==> only precincts in the block's county)
+    -- repairGeometry: True ==> steps 1 and 2 repair invalid geometry up front (logging what was repaired), so intersection errors are rare
+    -- mapBbox: [minx, miny, maxx, maxy] in block CRS ==> steps 1 and 2 only read (and map) geometry meeting that box
+    -- crosswalkEngine: True ==> steps 3, 4, 5 and 8 use sparse block matrices (crosswalk module) instead of nested dicts; same results
+    -- writeBlockData: True ==> step 8 also writes block_data_from_source_path
+    -- useManifest: True ==> steps are skipped when their inputs (by content hash) and params are unchanged since they last ran and their
+         outputs are still as written, and block maps are remade on a real change rather than by file times (see run_steps_with_manifest)
+    -- stepWorkers: N > 1 ==> steps that don't depend on each other (by the files they read and write, e.g. 1 and 2, 3 and 5) run at the same time,
+         in up to N worker processes, each logging to its own file; step times are logged (see run_steps_concurrently)
+    -- inMemory: True ==> pipeline mode: the steps hand their maps and data to the steps that follow in memory, instead of writing files
+         and parsing them again (and files like block_pop_path are read once for all steps). Only the dest data (agg_data_from_source_path,
+         agg_targets) is written, plus the checkpoints: list of paths keys (e.g. ["block2source_map_path", "block_data_from_source_path"])
+         of the maps and block data to write as well. Takes the place of useManifest and stepWorkers
+    -- compactMaps: True ==> block maps and block weights are used (and, with inMemory, handed between steps) in compact form: block ids become
+         int32 ordinals of the state's block registry, and maps int32 arrays of dictionary-encoded keys (see block_registry); same results.
+         Steps 3, 5 and 8 disaggregate on the arrays (block pcts as CSR segments, with either engine) and step 8 finds dests by block ordinal
+    -- verifyTolerance: step 6 flags fields whose source and aggregated totals differ by this much or more (default 1),
+         unless verifyRelTolerance is given and the relative diff is within it
+    -- streamAggregate: True ==> step 4 reads the block data and block map incrementally, so its memory goes with the number of dests, not blocks
+    -- weightRules: {prop name regex: weight column, ...}, defaultWeight: column ==> steps 3, 5 and 8 apportion each prop with its own
+         block weight column (e.g. votes by VAP, CVAP props by CVAP, population by TOT), all in one run; the weights are a multi-column
+         table in paths["block_weight_path"] (if present) or block_pop_path (see get_weight_options)
 
     Produces files (paths must be specified by prepare module):
     -- block2source_map_path (ex: block_to_<sourceid>_map_<stateCode>.json)
@@ -189,13 +532,224 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
     -- agg_data_from_source_path (ex: <destid>_from_<sourceid>_<stateCode>.json)
     """
 
+    isDemographicData = config["isDemographicData"] if "isDemographicData" in config else False
+    isCVAP = config["isCVAP"] if "isCVAP" in config else False
+    isACS = config["isACS"] if "isACS" in config else False
+    useManifest = config["useManifest"] if "useManifest" in config else False
+    stepWorkers = config["stepWorkers"] if "stepWorkers" in config else 1
+    inMemory = config["inMemory"] if "inMemory" in config else False
+
+    paths = prepare.get_paths(root_paths, state, not isDemographicData, year, isCVAP, destyear, isACS)
+    working_path = paths["working_path"]
+
+    logfile_name = make_logfile_name(steps, year, destyear, config)
+    print("Setting logging output to ", working_path + logfile_name)
+    log.set_output(working_path + logfile_name, "Disagg/Agg Logging")
+ 
+    if inMemory:
+        if useManifest or stepWorkers > 1:
+            log.dprint("inMemory: steps run in this process, in order; useManifest and stepWorkers not used")
+        run_steps(root_paths, state, steps, state_codes, year, destyear, config)
+    elif stepWorkers > 1 and len(steps) > 1:
+        run_steps_concurrently(root_paths, state, steps, state_codes, year, destyear, config, paths, stepWorkers, working_path + logfile_name, useManifest)
+    elif useManifest:
+        run_steps_with_manifest(root_paths, state, steps, state_codes, year, destyear, config, paths)
+    else:
+        run_steps(root_paths, state, steps, state_codes, year, destyear, config)
+
+
+def make_logfile_name(steps, year, destyear, config):
+    """
+    Name of process_state's log file (in working_path) for steps, years and config
+    """
+    isDemographicData = config["isDemographicData"] if "isDemographicData" in config else False
+    isCVAP = config["isCVAP"] if "isCVAP" in config else False
+    listpropsonly = config["listpropsonly"] if "listpropsonly" in config else False
+    return "output" + "_".join(str(step) for step in steps) + "_" + str(year) + "to" + str(destyear) + ("" if isDemographicData else "_elec") + ("_cvap" if isCVAP else "") + ("_listprops" if listpropsonly else "_fulldisagg") + ".log"
+
+
+# Config entries that don't change what the steps produce (only how), so they're not part of a step's manifest params.
+# (Not geoCache or preparedFastPath: the cache repairs geometry, and the prepared path records interior blocks as 1.0 -- both change the maps)
+runtime_config = ("useManifest", "stepWorkers", "inMemory", "checkpoints", "compactMaps", "mapWorkers", "crosswalkEngine", "streamAggregate", "bulkQuery")
+
+
+def step_files(step, paths, config):
+    """
+    (inputs, outputs): the files step reads and writes (as in process_state's Requires lists), from paths (prepare.get_paths); None paths left out
+    """
+    sourceIsBlkGrp = config["sourceIsBlkGrp"] if "sourceIsBlkGrp" in config else False
+    writeBlockData = config["writeBlockData"] if "writeBlockData" in config else False
+    map_inputs = [paths["block_geo_path"], paths["blkgrp_geo_path"] if "blkgrp_geo_path" in paths else None]
+    weight_path = paths["block_weight_path"] if "block_weight_path" in paths else None
+    agg_targets = paths["agg_targets"] if "agg_targets" in paths else []
+    source_map_inputs = [paths["source_geo_path"]] + map_inputs + ([paths["block_pop_path"]] if sourceIsBlkGrp else [])
+    files = {
+        1: (source_map_inputs, [paths["block2source_map_path"]]),
+        2: ([paths["dest_geo_path"]] + map_inputs, [paths["block2dest_map_path"]]),
+        7: (source_map_inputs + [paths["dest_geo_path"]], [paths["block2source_map_path"], paths["block2dest_map_path"]]),
+        3: ([paths["source_data_path"], paths["block2source_map_path"], paths["block_pop_path"], weight_path], [paths["block_data_from_source_path"]]),
+        4: ([paths["block_data_from_source_path"], paths["block2dest_map_path"]] + [target[0] for target in agg_targets],
+            [paths["agg_data_from_source_path"]] + [target[2] for target in agg_targets]),
+        5: ([paths["dest_data_path"], paths["block2dest_map_path"], paths["block_pop_path"], weight_path], [paths["block_data_from_dest_path"]]),
+        6: ([paths["source_data_path"], paths["agg_data_from_source_path"]], []),
+        8: ([paths["source_data_path"], paths["block2source_map_path"], paths["block_pop_path"], weight_path, paths["block2dest_map_path"]],
+            [paths["agg_data_from_source_path"]] + ([paths["block_data_from_source_path"]] if writeBlockData else []))
+    }
+    inputs, outputs = files[step]
+    return list(dict.fromkeys(path for path in inputs if path != None)), [path for path in outputs if path != None]
+
+
+def check_manifest(step_manifest, step, paths, config, state, year, destyear):
+    """
+    Returns (current, input_hashes, outputs, params) for step: current ==> up to date in step_manifest (see run_steps_with_manifest)
+    """
+    inputs, outputs = step_files(step, paths, config)
+    params = {"step": step, "state": state, "year": year, "destyear": destyear, "config": {key: value for key, value in config.items() if not (key in runtime_config)}}
+    input_hashes = manifest.file_hashes(step_manifest, inputs)
+    return len(outputs) > 0 and manifest.is_current(step_manifest, step, input_hashes, outputs, params), input_hashes, outputs, params
+
+
+def log_skipped(step):
+    log.dprint("*******************************************")
+    log.dprint("****** ", step, ": up to date (manifest), skipped *****")
+    print("Step ", step, " up to date (manifest), skipped")
+
+
+def record_step(step_manifest, manifest_path, step, input_hashes, outputs, params):
+    if len(outputs) > 0 and manifest.record(step_manifest, step, input_hashes, outputs, params):
+        log.dprint("Manifest: step ", step, " recorded")
+    manifest.save(step_manifest, manifest_path)
+
+
+def run_steps_with_manifest(root_paths, state, steps, state_codes, year, destyear, config, paths, force=False):
+    """
+    Runs steps, skipping the ones that are up to date in the content-hash manifest (working_path + "manifest.json"; see the manifest module):
+    same input file contents, same params (state, years, config but runtime_config) and outputs unchanged since they were written.
+    The manifest only decides whether a step runs: a step that does run remakes its block maps even if the file times say they're current,
+    but as run_steps would otherwise (e.g. from a current overlap table, with saveOverlap; a table made with other map options or from other
+    geometry isn't current, see overlap_table_metadata), unless force (see run_steps). It's recorded in the manifest.
+    Steps without outputs (6: verify) always run.
+    """
+    manifest_path = paths["working_path"] + "manifest.json"
+    step_manifest = manifest.load(manifest_path)
+    for step in steps:
+        current, input_hashes, outputs, params = check_manifest(step_manifest, step, paths, config, state, year, destyear)
+        if current:
+            log_skipped(step)
+            continue
+        run_steps(root_paths, state, [step], state_codes, year, destyear, config, force=force, remake_maps=True)
+        record_step(step_manifest, manifest_path, step, input_hashes, outputs, params)
+
+
+def step_dependencies(steps, paths, config):
+    """
+    Step dependency graph from the files each step reads and writes (see step_files): {i: {j, ...}, ...} (indexes into steps),
+    step i waits for the earlier steps j that write a file it reads or writes, or that read a file it writes.
+    E.g. for [1, 2, 3, 5]: 3 waits for 1, 5 for 2, and 1 and 2 don't wait at all
+    """
+    files = [step_files(step, paths, config) for step in steps]
+    dependencies = {}
+    for i, (inputs, outputs) in enumerate(files):
+        dependencies[i] = set()
+        for j in range(i):
+            earlier_inputs, earlier_outputs = files[j]
+            if set(earlier_outputs) & (set(inputs) | set(outputs)) or set(earlier_inputs) & set(outputs):
+                dependencies[i].add(j)
+    return dependencies
+
+
+def run_step_process(job):
+    """
+    Process pool worker for run_steps_concurrently: job is (run_steps args, run_steps keyword args, step log path); runs one step
+    with its own log file. Returns the seconds it took
+    """
+    args, kwargs, step_log_path = job
+    step_start = time.time()
+    log.set_output(step_log_path, "Disagg/Agg Logging: step " + str(args[2][0]))
+    try:
+        run_steps(*args, **kwargs)
+    finally:
+        log.close()
+    return time.time() - step_start
+
+
+def run_steps_concurrently(root_paths, state, steps, state_codes, year, destyear, config, paths, workers, log_path, use_manifest=False, force=False):
+    """
+    Runs steps in up to workers worker processes at once: each step starts as soon as the steps it depends on are done (see step_dependencies),
+    so independent steps (e.g. 1 and 2, or 3 and 5) run in parallel. Each step logs to its own file (log_path + _step<N>.log);
+    the times of the steps are logged (and printed) here.
+    use_manifest: as run_steps_with_manifest, with the manifest checked and recorded here, as each step comes up and finishes;
+        so a step that runs remakes its block maps even if the file times say they're current (remake_maps, see run_steps)
+    force: see run_steps
+    """
+    dependencies = step_dependencies(steps, paths, config)
+    log.dprint("Step dependencies: ", {steps[i]: [steps[j] for j in sorted(deps)] for i, deps in dependencies.items()}, ", workers: ", workers)
+    manifest_path = paths["working_path"] + "manifest.json"
+    step_manifest = manifest.load(manifest_path) if use_manifest else None
+
+    done = set()
+    started = set()
+    running = {}
+    step_times = {}
+    log.flush()     # so the workers don't inherit (and repeat) unwritten log output
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(done) < len(steps):
+            for i, step in enumerate(steps):
+                if i in started or not dependencies[i] <= done:
+                    continue
+                started.add(i)
+                if use_manifest:
+                    current, input_hashes, outputs, params = check_manifest(step_manifest, step, paths, config, state, year, destyear)
+                    if current:
+                        log_skipped(step)
+                        done.add(i)
+                        continue
+                else:
+                    input_hashes, outputs, params = None, None, None
+                step_log_path = os.path.splitext(log_path)[0] + "_step" + str(step) + ".log"
+                log.dprint("****** ", step, ": started, log: ", step_log_path)
+                log.flush()
+                job = ((root_paths, state, [step], state_codes, year, destyear, config), {"force": force, "remake_maps": use_manifest}, step_log_path)
+                future = executor.submit(run_step_process, job)
+                running[future] = (i, input_hashes, outputs, params)
+            if len(running) == 0:
+                continue        # (steps were skipped; look for more that are ready)
+            finished, pending = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, input_hashes, outputs, params = running.pop(future)
+                step_times[steps[i]] = future.result()
+                log.dprint("****** ", steps[i], ": done in ", round(step_times[steps[i]], 1), " s")
+                print("Step ", steps[i], " done in ", round(step_times[steps[i]], 1), " s")
+                if use_manifest:
+                    record_step(step_manifest, manifest_path, steps[i], input_hashes, outputs, params)
+                done.add(i)
+
+    pp = log.pretty_printer()
+    log.dprint("Step times (s)")
+    pp.pprint({step: round(seconds, 1) for step, seconds in step_times.items()})
+
+
+def run_steps(root_paths, state, steps, state_codes, year, destyear, config, force=False, remake_maps=False):
+    """
+    Runs steps in order (see process_state); force: True ==> steps 1, 2 and 7 remake block maps from geometry even if the file times say
+    they (or the overlap tables) are current
+    remake_maps: True ==> steps 1, 2 and 7 remake block maps even if the file times say they're current, from a current overlap table if there is one
+    """
     sourceIsBlkGrp = config["sourceIsBlkGrp"] if "sourceIsBlkGrp" in config else False
     sourceIsCsv = config["sourceIsCsv"] if "sourceIsCsv" in config else False
     isDemographicData = config["isDemographicData"] if "isDemographicData" in config else False
     isCVAP = config["isCVAP"] if "isCVAP" in config else False
     isACS = config["isACS"] if "isACS" in config else False
     listpropsonly = config["listpropsonly"] if "listpropsonly" in config else False
-
+    saveOverlap = config["saveOverlap"] if "saveOverlap" in config else False
+    engine = "crosswalk" if ("crosswalkEngine" in config and config["crosswalkEngine"]) else "dict"
+    writeBlockData = config["writeBlockData"] if "writeBlockData" in config else False
+    streamAggregate = config["streamAggregate"] if "streamAggregate" in config else False
+    verifyTolerance = config["verifyTolerance"] if "verifyTolerance" in config else 1
+    verifyRelTolerance = config["verifyRelTolerance"] if "verifyRelTolerance" in config else None
+    inMemory = config["inMemory"] if "inMemory" in config else False
+    checkpoints = config["checkpoints"] if "checkpoints" in config else []
+    compactMaps = config["compactMaps"] if "compactMaps" in config else False
 
     stateCode = state_codes[state]      #  2-digit state census code
     source_key, dest_key, block_key, use_index_for_source_key = prepare.get_keys(state, not isDemographicData, year, destyear)
@@ -213,28 +767,31 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
     block_data_from_dest_path = paths["block_data_from_dest_path"]
     agg_data_from_source_path = paths["agg_data_from_source_path"]
     working_path = paths["working_path"]
+    map_options = get_map_options(config, paths)
+    weight_options = get_weight_options(config, paths)
+
+    # Pipeline mode: {path: object} of the maps and data the steps make (and the files they read), handed on to the steps that follow
+    pipeline = {} if inMemory else None
+    checkpoint_paths = [paths[key] for key in checkpoints if key in paths and paths[key] != None]
+    # Compact maps: the state's block registry (block ids ==> int32 ordinals) for the encoded block maps and weights
+    registry = block_registry.make_registry() if compactMaps else None
 
-    logfile_name = "output" + "_".join(str(step) for step in steps) + "_" + str(year) + "to" + str(destyear) + ("" if isDemographicData else "_elec") + ("_cvap" if isCVAP else "") + ("_listprops" if listpropsonly else "_fulldisagg") + ".log"
-    print("Setting logging output to ", working_path + logfile_name)
-    log.set_output(working_path + logfile_name, "Disagg/Agg Logging")
- 
     for step in steps:
+        step_start = time.time()
 
         if (step == 1):
             log.dprint("*******************************************")
             log.dprint("****** 1: Make map between geometries, if not already done *****")
             if ((source_geo_path != None or sourceIsBlkGrp) and block_geo_path != None and block2source_map_path != None):
                 if sourceIsBlkGrp and year >= destyear:
-                    if not os.path.exists(block2source_map_path):
-                        if state == "CT" and year >= 2022 and destyear == 2020:
-                            makeTrivialBlock2BG_CT(state, year, block_pop_path, block2source_map_path, paths["acs_root"])
-                        else:
-                            makeTrivialBlock2BG(state, block_pop_path, block2source_map_path)
+                    makeTrivialBlock2Source(state, year, destyear, block_pop_path, block2source_map_path, paths["acs_root"] if "acs_root" in paths else None, force or remake_maps,
+                                            pipeline, block2source_map_path in checkpoint_paths, registry)
                 else:
                     #if (state == "CA" and year == 2024):    TBD CA 2024
                     #    make_block_map_from_map(state, stateCode, source_geo_path, source_key, block2source_map_path)
-                    if must_update_block_map(block2source_map_path, source_geo_path):
-                        make_block_map(state, stateCode, source_geo_path, source_key, block_geo_path, block_key, block2source_map_path, year, isDemographicData, use_index_for_source_key, sourceIsBlkGrp)
+                    if force or remake_maps or must_update_block_map(block2source_map_path, source_geo_path):
+                        make_block_map(state, stateCode, source_geo_path, source_key, block_geo_path, block_key, block2source_map_path, year, isDemographicData, use_index_for_source_key, sourceIsBlkGrp, map_options, saveOverlap, force,
+                                       pipeline, block2source_map_path in checkpoint_paths, registry, remake_maps)
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tSource geo: ", source_geo_path)
@@ -245,23 +802,50 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
             log.dprint("*******************************************")
             log.dprint("****** 2: Make map between geometries *****")
             if (dest_geo_path != None and block_geo_path != None and block2dest_map_path != None):
-                make_block_map(state, stateCode, dest_geo_path, dest_key, block_geo_path, block_key, block2dest_map_path, year, isDemographicData)
+                make_block_map(state, stateCode, dest_geo_path, dest_key, block_geo_path, block_key, block2dest_map_path, year, isDemographicData, map_options=map_options, saveOverlap=saveOverlap, force=force,
+                               pipeline=pipeline, checkpoint=block2dest_map_path in checkpoint_paths, registry=registry, remake=remake_maps)
+            else:
+                log.dprint("Required input missing:")
+                log.dprint("\tDest geo: ", dest_geo_path)
+                log.dprint("\tBlock geo: ", block_geo_path)
+                log.dprint("\tOutput path: ", block2dest_map_path)
+
+        elif (step == 7):
+            log.dprint("*******************************************")
+            log.dprint("****** 7: Make maps between geometries (1 and 2) in one pass *****")
+            large_geo_list = []
+            if ((source_geo_path != None or sourceIsBlkGrp) and block_geo_path != None and block2source_map_path != None):
+                if sourceIsBlkGrp and year >= destyear:
+                    makeTrivialBlock2Source(state, year, destyear, block_pop_path, block2source_map_path, paths["acs_root"] if "acs_root" in paths else None, force or remake_maps,
+                                            pipeline, block2source_map_path in checkpoint_paths, registry)
+                elif force or remake_maps or must_update_block_map(block2source_map_path, source_geo_path):
+                    large_geo_list.append((source_geo_path, source_key, block2source_map_path, use_index_for_source_key, sourceIsBlkGrp))
+            else:
+                log.dprint("Required input missing:")
+                log.dprint("\tSource geo: ", source_geo_path)
+                log.dprint("\tBlock geo: ", block_geo_path)
+                log.dprint("\tOutput path: ", block2source_map_path)
+            if (dest_geo_path != None and block_geo_path != None and block2dest_map_path != None):
+                large_geo_list.append((dest_geo_path, dest_key, block2dest_map_path, False, False))
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tDest geo: ", dest_geo_path)
                 log.dprint("\tBlock geo: ", block_geo_path)
                 log.dprint("\tOutput path: ", block2dest_map_path)
+            make_block_maps(state, stateCode, large_geo_list, block_geo_path, block_key, year, isDemographicData, map_options, saveOverlap, force, pipeline, checkpoint_paths, registry, remake_maps)
 
         elif (step == 3):
             log.dprint("*******************************************")
             log.dprint("************* 3: Disaggregate *************")
             # CA 2024 TBD
             if (state == "CA" and destyear == 2020 and (year == 2018 or year == 2022) and source_data_path != None and block2source_map_path != None and not isDemographicData):
-                disaggregate_data_ca(state, stateCode, source_data_path, block2source_map_path, block_key, block_data_from_source_path, source_year=year, listpropsonly=listpropsonly)
+                disaggregate_data_ca(state, stateCode, source_data_path, block2source_map_path, block_key, block_data_from_source_path, source_year=year, listpropsonly=listpropsonly, engine=engine,
+                                     pipeline=pipeline, checkpoint=block_data_from_source_path in checkpoint_paths)
             elif (source_data_path != None and block2source_map_path != None and block_pop_path != None and block_data_from_source_path != None):
                 if state == "KY" and source_key == "VTD":
                     source_key = "GEOID10"    # Hack because we need VTD source_key for Step 1, but need it to be GEOID10 for this step; no other steps need it
-                disaggregate_data(state, stateCode, source_data_path, source_key, block2source_map_path, block_key, block_pop_path, block_data_from_source_path, use_index_for_source_key, isDemographicData, source_year=year, listpropsonly=listpropsonly, sourceIsCsv=sourceIsCsv)
+                disaggregate_data(state, stateCode, source_data_path, source_key, block2source_map_path, block_key, block_pop_path, block_data_from_source_path, use_index_for_source_key, isDemographicData, source_year=year, listpropsonly=listpropsonly, sourceIsCsv=sourceIsCsv, engine=engine, weight_options=weight_options,
+                                  pipeline=pipeline, checkpoint=block_data_from_source_path in checkpoint_paths, registry=registry)
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tSource data: ", source_data_path)
@@ -274,18 +858,40 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
             log.dprint("*************** 4: Aggregate **************")
             if (block_data_from_source_path != None and block2dest_map_path != None and agg_data_from_source_path != None):
                 is2020Census = (year == 2020 and destyear == 2020 and isDemographicData)
-                aggregate_source2dest(state, stateCode, block_data_from_source_path, block2dest_map_path, dest_key, agg_data_from_source_path, is2020Census or (year == 2010 and destyear == 2010))
+                targets = [(block2dest_map_path, dest_key, agg_data_from_source_path)] + [tuple(target) for target in (paths["agg_targets"] if "agg_targets" in paths else [])]
+                aggregate_source2dests(state, stateCode, block_data_from_source_path, targets, is2020Census or (year == 2010 and destyear == 2010), engine, streamAggregate, pipeline, registry)
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tBlock data: ", block_data_from_source_path)
                 log.dprint("\tBlock to dest map: ", block2dest_map_path)
                 log.dprint("\tOutput path: ", agg_data_from_source_path)
 
+        elif (step == 8):
+            log.dprint("*******************************************")
+            log.dprint("******** 8: Disaggregate and Aggregate ********")
+            block_data_path = block_data_from_source_path if writeBlockData else None
+            isCA = (state == "CA" and destyear == 2020 and (year == 2018 or year == 2022) and not isDemographicData)
+            if (source_data_path != None and block2source_map_path != None and (isCA or block_pop_path != None) and
+                    block2dest_map_path != None and agg_data_from_source_path != None):
+                if state == "KY" and source_key == "VTD":
+                    source_key = "GEOID10"    # Same hack as step 3
+                disaggregate_aggregate(state, stateCode, source_data_path, source_key, block2source_map_path, block_pop_path, block2dest_map_path, dest_key, agg_data_from_source_path,
+                                       use_index_for_source_key, source_year=year, listpropsonly=listpropsonly, sourceIsCsv=sourceIsCsv, engine=engine, block_data_path=block_data_path, isCA=isCA,
+                                       weight_options=weight_options, pipeline=pipeline, registry=registry)
+            else:
+                log.dprint("Required input missing:")
+                log.dprint("\tSource data: ", source_data_path)
+                log.dprint("\tBlock to source map: ", block2source_map_path)
+                log.dprint("\tBlock population: ", block_pop_path)
+                log.dprint("\tBlock to dest map: ", block2dest_map_path)
+                log.dprint("\tOutput path: ", agg_data_from_source_path)
+
         elif (step == 5):        
             log.dprint("*******************************************")
             log.dprint("************* 5: Disaggregate *************")
             if (dest_data_path != None and block2dest_map_path != None and block_pop_path != None and block_data_from_dest_path != None):
-                disaggregate_data(state, stateCode, dest_data_path, dest_key, block2dest_map_path, block_key, block_pop_path, block_data_from_dest_path)
+                disaggregate_data(state, stateCode, dest_data_path, dest_key, block2dest_map_path, block_key, block_pop_path, block_data_from_dest_path, engine=engine, weight_options=weight_options,
+                                  pipeline=pipeline, checkpoint=block_data_from_dest_path in checkpoint_paths, registry=registry)
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tDest data: ", dest_data_path)
@@ -297,11 +903,14 @@ def process_state(root_paths, state, steps, state_codes, year, destyear, config)
             if (source_data_path != None and agg_data_from_source_path != None):
                 log.dprint("*******************************************")
                 log.dprint("**************** 6: Verify ****************")
-                verify.verify_source_vs_aggregated(source_data_path, agg_data_from_source_path, ok_to_agg) #, block_data_from_source_path)
+                verify.verify_source_vs_aggregated(source_data_path, in_pipeline(agg_data_from_source_path, pipeline), ok_to_agg, #block_data_from_source_path,
+                                                   tolerance=verifyTolerance, rel_tolerance=verifyRelTolerance)
             else:
                 log.dprint("Required input missing:")
                 log.dprint("\tSource data: ", source_geo_path)
                 log.dprint("\tAggregated data: ", agg_data_from_source_path)
+
+        log.dprint("****** ", step, ": done in ", round(time.time() - step_start, 1), " s")
  
 def must_update_block_map(block2source_map_path, source_geo_path):
     if not os.path.exists(block2source_map_path):
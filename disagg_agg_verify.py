@@ -13,6 +13,7 @@ import math
 import numbers
 
 from . import agg_logging as log
+from . import json_stream
 
 def fmap(f, ds):
     if f == "Tot":
@@ -43,111 +44,119 @@ def fmap(f, ds):
         return "NATC" if ds == "D10F" else "NATC18"
 
 
-def verify_source_vs_aggregated(source_data_path, agg_data_from_source_path, ok_to_agg, block_data_path=None):
+def as_float(value):
+    """
+        float(value), or NaN if it isn't a number (the cell doesn't count in a total)
+    """
+    try:
+        return float(value)
+    except:
+        return math.nan
+
+
+def number_values(column):
+    """
+        Series column as float64, NaN where a cell isn't a number: one cast for number columns, float() of each cell only for other (object, string) columns
+    """
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return column.astype("float64")
+    return pd.Series([as_float(value) for value in column.tolist()], index=column.index, dtype="float64")
+
+
+def column_totals(frame, columns=None):
+    """
+        {column: total} of the number values (not NaN) of each of columns (None ==> all) of DataFrame frame; columns without any are left out
+        NOTE: NaN cells are skipped on every side now. The 2019 row loop skipped them only for the aggregated and block data; a NaN source
+        cell (missing value in a number column, or a NaN in datasets) made that field's source total NaN, so it showed up as a NaN diff.
+        Now the field is compared on the cells that have values, and a source column that's all NaN is left out instead of totalling NaN.
+    """
+    totals = {}
+    for column in (frame.columns if columns is None else columns):
+        values = number_values(frame[column])
+        if values.notna().any():
+            totals[column] = float(values.sum())
+    return totals
+
+
+def datasets_totals(datasets):
+    """
+        Totals of the D10F and D10T datasets of Series datasets (each cell a dict {"D10F": {"Tot": v, ...}, "D10T": {...}}, or its JSON text),
+        with the field names mapped by fmap (e.g. D10T Tot ==> TOT18)
+    """
+    cells = [json.loads(value) if isinstance(value, str) else value for value in datasets.tolist()]
+    totals = {}
+    for ds in ("D10F", "D10T"):
+        rows = [value[ds] if isinstance(value, dict) and ds in value else {} for value in cells]
+        frame = pd.DataFrame.from_records(rows)
+        frame.columns = frame.columns.map(lambda f: fmap(f, ds))
+        totals.update(column_totals(frame, [column for column in frame.columns if isinstance(column, str)]))     # (no fmap name ==> left out)
+    return totals
+
+
+def compare_totals(source_props_total, other_props_total, tolerance=1, rel_tolerance=None):
+    """
+        For each field in both: {field: {"source": total, "other": total, "diff": source - other, "rel_diff": diff / source (None if source is 0),
+        "ok": abs(diff) < tolerance, or abs(rel_diff) <= rel_tolerance if that's given}}
+    """
+    report = {}
+    for key, source_value in source_props_total.items():
+        if key in other_props_total:
+            other_value = other_props_total[key]
+            diff = source_value - other_value
+            rel_diff = diff / source_value if source_value != 0 else None
+            ok = abs(diff) < tolerance or (rel_tolerance != None and rel_diff != None and abs(rel_diff) <= rel_tolerance)
+            report[key] = {"source": source_value, "other": other_value, "diff": diff, "rel_diff": rel_diff, "ok": ok}
+    return report
+
+
+def log_report(title, report):
+    pp = log.pretty_printer()
+    log.dprint(title)
+    pp.pprint({key: field["diff"] for key, field in report.items()})
+    failed = {key: field for key, field in report.items() if not field["ok"]}
+    log.dprint(title, ": fields: ", len(report), ", over tolerance: ", len(failed))
+    if len(failed) > 0:
+        log.dprint("Over tolerance (source, other, abs diff, rel diff)")
+        pp.pprint({key: (field["source"], field["other"], abs(field["diff"]), field["rel_diff"]) for key, field in failed.items()})
+
+
+def verify_source_vs_aggregated(source_data_path, agg_data_from_source_path, ok_to_agg, block_data_path=None, tolerance=1, rel_tolerance=None):
     """
         Function totals each numeric field across source data rows, does the same across aggregated data rows,
         and then compares. The expectation is that the diff of each field between the original source (that got disaggregated) and resulting
-        aggregated data in the destination geometry, should have ABS value less than 1.
-        Results are printed to stdout.
+        aggregated data in the destination geometry, should have ABS value less than 1 (tolerance; or relative diff up to rel_tolerance, if given).
+        Totals are column sums (see column_totals); NaN values don't count, on either side (the source side used to total NaN).
+        Results (diffs, and fields over tolerance) are logged, and returned: {"agg": report, "block": report or None} (see compare_totals)
 
         Optionally, block data can be given and that is compared against the source as well. 
     """
 
     # Source and aggregated can be geojson or shapefiles; we're looking only at the data 
-    source_data = gpd.read_file(source_data_path)
-    agg_data = gpd.read_file(agg_data_from_source_path)
+    # (aggregated data and block data can also be the objects themselves, in memory)
+    source_data = gpd.read_file(source_data_path, ignore_geometry=True)
+    if isinstance(agg_data_from_source_path, str):
+        agg_data = gpd.read_file(agg_data_from_source_path, ignore_geometry=True)
+    else:
+        agg_data = pd.DataFrame.from_records([feature["properties"] for feature in agg_data_from_source_path["features"]])
 
     # Build map of total values for all number fields in source
-    source_keys = source_data.keys()
-    source_props_total = {}
-    for i in tqdm(source_data.index):
-        for key in source_keys:
-            try:
-                value = source_data.loc[i, key]
-                if key == "datasets":
-                    if "D10F" in value:
-                        d10f = value["D10F"]
-                        for f, v in d10f.items():
-                            fm = fmap(f, "D10F")
-                            if fm in source_props_total:
-                                source_props_total[fm] += float(v)
-                            else:
-                                source_props_total[fm] = float(v)
-                    if "D10T" in value:
-                        d10t = value["D10T"]
-                        for f, v in d10t.items():
-                            fm = fmap(f, "D10T")
-                            if fm in source_props_total:
-                                source_props_total[fm] += float(v)
-                            else:
-                                source_props_total[fm] = float(v)
-
-                elif ok_to_agg(key):
-                    num = float(value)
-                    if key in source_props_total:
-                        source_props_total[key] += num
-                    else:
-                        source_props_total[key] = num
-            except:
-                pass
-            
+    source_props_total = column_totals(source_data, [key for key in source_data.columns if key != "datasets" and ok_to_agg(key)])
+    if "datasets" in source_data.columns:
+        for key, total in datasets_totals(source_data["datasets"]).items():
+            source_props_total[key] = source_props_total[key] + total if key in source_props_total else total
+
     # Build map of total values for all number fields in agg
-    agg_keys = agg_data.keys()
-    agg_props_total = {}
-    for i in tqdm(agg_data.index):
-        for key in agg_keys:
-            try:
-                value = agg_data.loc[i, key]
-                num = float(value)
-                if math.isnan(num):
-                    #log.dprint("NaN: ", key)
-                    noop = 0
-                else:
-                    if key in agg_props_total:
-                        agg_props_total[key] += num
-                    else:
-                        agg_props_total[key] = num
-            except:
-                pass
+    agg_props_total = column_totals(agg_data)
 
     # Compare
-    diff_props = {}
-    for key, source_value in source_props_total.items():
-        if key in agg_props_total:
-            agg_value = agg_props_total[key]
-            diff_props[key] = source_value - agg_value
-    
-    pp = log.pretty_printer()
-    log.dprint("Source vs Aggregated")
-    pp.pprint(diff_props)
+    result = {"agg": compare_totals(source_props_total, agg_props_total, tolerance, rel_tolerance), "block": None}
+    log_report("Source vs Aggregated", result["agg"])
 
     if block_data_path != None:
         # Block data is of the form {blkid: {field1 : value1, ...}}
-        with open(block_data_path) as json_file:
-            block_data = json.load(json_file)
-
-        # Build map of total values for all number fields in agg
-        block_props_total = {}
-        for blkid, fields in tqdm(block_data.items()):
-            for field, value in fields.items():
-                try:
-                    num = float(value)
-                    if math.isnan(num):
-                        #log.dprint("NaN: ", key)
-                        noop = 0
-                    else:
-                        if field in block_props_total:
-                            block_props_total[field] += num
-                        else:
-                            block_props_total[field] = num
-                except:
-                    pass
-
-        diff_props_block = {}
-        for key, source_value in source_props_total.items():
-            if key in block_props_total:
-                block_value = block_props_total[key]
-                diff_props_block[key] = source_value - block_value
-        
-        log.dprint("Source vs Block")
-        pp.pprint(diff_props_block)
+        block_data = json_stream.load(block_data_path)
+        block_props_total = column_totals(pd.DataFrame.from_records(list(block_data.values())))
+
+        result["block"] = compare_totals(source_props_total, block_props_total, tolerance, rel_tolerance)
+        log_report("Source vs Block", result["block"])
+    return result
@@ -5,11 +5,21 @@
 
 
 import geopandas as gpd
+import pandas as pd
 import json
 import csv
 import math
+import re
+import numpy as np
 from tqdm import tqdm
 from fractions import Fraction
+from functools import lru_cache
+
+from . import crosswalk
+from . import apportion
+from . import aggregate
+from . import json_stream
+from . import block_registry
 
 # tracking
 track_counties = False
@@ -450,6 +460,235 @@ def filter_prop_key(cand_code, state, source_year, listpropsonly=False):
 
     return cand_code
 
+def is_int(value):
+    try:
+        intval = int(value)
+        return True
+    except:
+        return False
+
+@lru_cache(maxsize=None)
+def compile_column_plan(columns, ok_to_agg, state, source_year, listpropsonly, filter_keys=True, filter_first=False, skip_column=None):
+    """
+        Column plan for a source file with columns (tuple of names): {column: output key} for the columns that are kept; the rest are dropped.
+        The name rules are evaluated once per column name and dataset (state, source_year, listpropsonly), not for every cell:
+            ok_to_agg(name) and filter_prop_key (if filter_keys), with filter_prop_key first and ok_to_agg on its output if filter_first (as for CA)
+        skip_column: column that is never kept (the key column)
+        The value part of ok_to_agg (an int) is still up to the row loop (is_int on each cell), or to column_as_int for a whole column
+        Plans are cached, so the same columns of the same dataset (e.g. every row of a csv) compile once
+    """
+    plan = {}
+    for column in columns:
+        if column == skip_column:
+            continue
+        if filter_first:
+            prop_key = filter_prop_key(column, state, source_year, listpropsonly) if filter_keys else column
+            if prop_key != None and ok_to_agg(prop_key):
+                plan[column] = prop_key
+        elif ok_to_agg(column):
+            prop_key = filter_prop_key(column, state, source_year, listpropsonly) if filter_keys else column
+            if prop_key != None:
+                plan[column] = prop_key
+    return plan
+
+def column_as_int(column):
+    """
+        Casts a pandas Series to int, as int(value) of each cell would: returns (values, valid), int64 array and bool array (int(value) works)
+        Integer columns are all valid, bools are 0/1, floats are truncated (NaN/inf are not valid); other columns go cell by cell with is_int
+    """
+    if pd.api.types.is_bool_dtype(column.dtype) and not column.hasnans:
+        return column.to_numpy(dtype=np.int64), np.ones(len(column), dtype=bool)
+    if pd.api.types.is_integer_dtype(column.dtype):
+        valid = column.notna().to_numpy()
+        return column.fillna(0).to_numpy(dtype=np.int64), valid
+    if pd.api.types.is_float_dtype(column.dtype):
+        floats = column.to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = np.isfinite(floats)
+        return np.trunc(np.where(valid, floats, 0)).astype(np.int64), valid
+    cells = column.tolist()
+    valid = np.array([is_int(value) for value in cells], dtype=bool)
+    values = np.array([int(value) if ok else 0 for value, ok in zip(cells, valid.tolist())], dtype=np.int64)
+    return values, valid
+
+def read_source_props(source_props_path, source_key, use_index_for_source_key, ok_to_agg, state, source_year, listpropsonly):
+    """
+        Column-oriented read of a geojson or shapefile source: the props (without geometry) thru the column plan (see compile_column_plan),
+        cast to int arrays (see column_as_int), with columns mapped to the same prop key summed.
+        Returns (source_props_map, source_props_total, source_props_cnty_total), the same as the row loop would give:
+            source_props_map {srckey1: {prop1: val1, ...}, ...}, a prop in a row only if some column of it has an int value,
+            and for a srckey in > 1 row, the last row (totals count all rows)
+    """
+    source_props = gpd.read_file(source_props_path, ignore_geometry=True)
+    plan = compile_column_plan(tuple(source_props.columns), ok_to_agg, state, source_year, listpropsonly)
+    srckeys = source_props.index.tolist() if use_index_for_source_key else source_props[source_key].astype(str).tolist()
+
+    # Columns of each prop key, in plan order
+    prop_keys = {}
+    for position, (column, prop_key) in enumerate(plan.items()):
+        prop_keys.setdefault(prop_key, []).append((position, column))
+    props = list(prop_keys.keys())
+    srckey_set = set(srckeys)
+
+    n = len(srckeys)
+    values = np.zeros((n, len(props)), dtype=np.int64)
+    present = np.zeros((n, len(props)), dtype=bool)
+    first_position = np.zeros((n, len(props)), dtype=np.int64)    # plan position of the first int column of the prop (orders the row's props)
+    for p, columns in enumerate(prop_keys.values()):
+        for position, column in reversed(columns):
+            column_values, valid = column_as_int(source_props[column])
+            if column in srckey_set:
+                # (as in the row loop: a column named the same as the row's key isn't a prop of that row)
+                valid &= np.array([srckey != column for srckey in srckeys], dtype=bool)
+            values[:, p] += np.where(valid, column_values, 0)
+            present[:, p] |= valid
+            first_position[valid, p] = position
+
+    source_props_map = {}
+    all_present = present.all(axis=1).tolist()
+    value_rows = values.tolist()
+    multi_column = any(len(columns) > 1 for columns in prop_keys.values())
+    for r, srckey in enumerate(srckeys):
+        if all_present[r] and not multi_column:
+            source_props_map[srckey] = dict(zip(props, value_rows[r]))
+        else:
+            row_props = np.flatnonzero(present[r])
+            if multi_column:
+                row_props = row_props[np.argsort(first_position[r, row_props], kind='stable')]
+            source_props_map[srckey] = {props[p]: value_rows[r][p] for p in row_props.tolist()}
+
+    any_present = present.any(axis=0).tolist()
+    source_props_total = {prop: total for prop, total, has in zip(props, values.sum(axis=0).tolist(), any_present) if has}
+
+    source_props_cnty_total = {}
+    if track_counties and "COUNTYFP" in source_props.columns:
+        countyfps = source_props["COUNTYFP"].tolist()
+        countynames = source_props["CNTY_NAME"].tolist() if "CNTY_NAME" in source_props.columns else [None] * n
+        for r in np.flatnonzero(present.any(axis=1)).tolist():
+            countyfp = countyfps[r]
+            if countyfp != None and not (countyfp in source_props_cnty_total):
+                source_props_cnty_total[countyfp] = {"FP": countyfp, "Name": countynames[r] if countynames[r] != None else ''}
+        codes, counties = pd.factorize(pd.Series(countyfps, dtype=object), use_na_sentinel=False)
+        county_values = np.zeros((len(counties), len(props)), dtype=np.int64)
+        county_present = np.zeros((len(counties), len(props)), dtype=bool)
+        np.add.at(county_values, codes, values)
+        np.logical_or.at(county_present, codes, present)
+        for c, countyfp in enumerate(counties.tolist()):
+            if countyfp in source_props_cnty_total:
+                county_row = county_values[c].tolist()
+                for p in np.flatnonzero(county_present[c]).tolist():
+                    source_props_cnty_total[countyfp][props[p]] = county_row[p]
+    return source_props_map, source_props_total, source_props_cnty_total
+
+def read_block_weights(path):
+    """
+        Block weight table: JSON {blkid: weight, ...} (block_pop_map) or {blkid: {column: weight, ...}, ...},
+        or csv with the block id in the first column and one column per weight (e.g. GEOID20,TOT,VAP,CVAP)
+    """
+    if path.lower().endswith(".csv"):
+        with open(path) as csv_file:
+            rows = csv.reader(csv_file, delimiter=",")
+            columns = next(rows)[1:]
+            return {row[0]: {column: float(value) if value != "" else 0 for column, value in zip(columns, row[1:])} for row in rows}
+    with open(path) as json_file:
+        return json.load(json_file)
+
+@lru_cache(maxsize=None)
+def compile_weight_plan(props, weight_rules, default_weight):
+    """
+        {prop: weight column} for props (tuple of names): the column of the first (regex, column) of weight_rules whose regex matches
+        the start of the prop name, else default_weight
+    """
+    rules = [(re.compile(regex), column) for regex, column in weight_rules]
+    plan = {}
+    for prop in props:
+        plan[prop] = next((column for rule, column in rules if rule.match(prop)), default_weight)
+    return plan
+
+def make_prec_pct_map(log, prec_blks, block_pop_map, columns=(None,)):
+    """
+        prec_blks {prec: {blk: 0, ...}, ...} ==> [{prec: {blk: pct, ...}, ...}, ...], one per weight column of block_pop_map
+        (column None ==> block_pop_map is {blkid: weight, ...}); pct is the block's share of the precinct's weight.
+        If a precinct has no weight at all, its first block gets everything, in case the precinct has data
+    """
+    pct_maps = [{} for column in columns]
+    for prec, blks in prec_blks.items():
+        weights = []
+        for block in blks.keys():
+            if block in block_pop_map:
+                weight = block_pop_map[block]
+                weights.append([weight.get(column, 0) if isinstance(weight, dict) else weight for column in columns])
+            else:
+                log.dprint("Block not in block_pop_map: ", block)
+                weights.append([0] * len(columns))
+        for c in range(len(columns)):
+            sum_blks_pop = 0
+            for weight in weights:
+                sum_blks_pop += weight[c]
+            blk_pcts = dict.fromkeys(blks.keys(), 0)
+            if sum_blks_pop > 0:
+                for block, weight in zip(blks.keys(), weights):
+                    if block in block_pop_map:
+                        blk_pcts[block] = weight[c] / sum_blks_pop
+            else:
+                for block in blk_pcts.keys():
+                    blk_pcts[block] = 1     # All blocks have zero pop, but pick one in case prec has data
+                    break
+            pct_maps[c][prec] = blk_pcts
+    return pct_maps
+
+def make_prec_pct_maps(log, prec_blks, block_pop_map, source_props_map, weight_rules=None, default_weight=None):
+    """
+        Block pcts of each precinct of prec_blks {prec: {blk: 0, ...}, ...} for every weight the props of source_props_map need.
+        Returns (prec_blk_pct_map, weight_maps, prop_weights):
+            prec_blk_pct_map {prec: {blk: pct, ...}, ...} with the default weight,
+            weight_maps {column: prec_blk_pct_map, ...} for the other columns, and prop_weights {prop: column}
+        block_pop_map is either {blkid: population, ...} (one weight: weight_maps and prop_weights are None)
+            or a multi-column weight table {blkid: {column: weight, ...}, ...} (see read_block_weights); then each prop is apportioned
+            with the column of the first of weight_rules ((regex, column), ...) that matches its name, else default_weight (None ==> "TOT")
+        The weights of all the columns are computed in one pass over the precincts, so all props are disaggregated in one run
+    """
+    table_columns = weight_columns(block_pop_map)
+    columns, prop_weights = make_weight_columns(log, table_columns, source_props_map, weight_rules, default_weight)
+    pct_maps = make_prec_pct_map(log, prec_blks, block_pop_map, tuple(columns))
+    if prop_weights == None:
+        return pct_maps[0], None, None
+    return pct_maps[0], dict(zip(columns[1:], pct_maps[1:])), prop_weights
+
+def weight_columns(block_pop_map):
+    """
+        Columns of the block weight table block_pop_map (see read_block_weights), in order of first use; None if it's {blkid: weight, ...}
+    """
+    if not isinstance(next(iter(block_pop_map.values()), None), dict):
+        return None
+    return list(dict.fromkeys(column for weight in block_pop_map.values() for column in weight.keys()))
+
+def make_weight_columns(log, table_columns, source_props_map, weight_rules=None, default_weight=None):
+    """
+        The weight columns the props of source_props_map are apportioned with, and prop_weights {prop: column} (see make_prec_pct_maps):
+        ([None], None) if the block weights are a single column (table_columns None), else (the default column first, then the others
+        in order of first use). table_columns: the columns of the weight table.
+        A rule's column that isn't in the table (e.g. a typo in weightRules) is logged and its props use the default column instead;
+        a default column that isn't in the table is a ValueError (the props would all go to the first block of each precinct)
+    """
+    if table_columns == None:
+        if weight_rules:
+            log.dprint("Block weights have one column; weight rules not used")
+        return [None], None
+    default_weight = default_weight if default_weight != None else "TOT"
+    if not (default_weight in table_columns):
+        raise ValueError(f'Default weight column {default_weight!r} is not in the block weight table (columns: {list(table_columns)})')
+    rules = []
+    for regex, column in (weight_rules or ()):
+        if column in table_columns:
+            rules.append((regex, column))
+        else:
+            log.dprint("Weight rule column not in the block weight table: ", column, " (", regex, "); using ", default_weight)
+    props = tuple(dict.fromkeys(prop for row in source_props_map.values() for prop in row.keys()))
+    prop_weights = compile_weight_plan(props, tuple(rules), default_weight)
+    columns = [default_weight] + [column for column in dict.fromkeys(prop_weights.values()) if column != default_weight]
+    log.dprint("Block weight columns: ", columns, " (default: ", default_weight, ")")
+    return columns, prop_weights
+
 def make_block_props_map_old(log, source_props_path, block_map_path, block_pop_map, source_key, use_index_for_source_key, ok_to_agg):
     """
         source_props is geojson or shapefile
@@ -526,103 +765,87 @@ def make_block_props_map_old(log, source_props_path, block_map_path, block_pop_m
     return final_blk_map
     """
 
-def make_block_props_map(log, source_props_path, block_map_path, block_pop_map, source_key, use_index_for_source_key, ok_to_agg, state, source_year, listpropsonly, sourceIsCsv):
+def make_block_props_map(log, source_props_path, block_map_path, block_pop_map, source_key, use_index_for_source_key, ok_to_agg, state, source_year, listpropsonly, sourceIsCsv, engine="dict", sink=None,
+                         weight_rules=None, default_weight=None, registry=None):
     """
         source_props is geojson or shapefile
-        block_map {blkid: [source_key, ...], ...}
+        block_map {blkid: [source_key, ...], ...}; block_map_path is its json file, or the map itself (in memory)
         source_key is key field for source_props; value used to lookup in block_map; we always treat it as a string
         block_pop_map is either
             {blkid: population, ...} or
+            {blkid: {'TOT': 3.0, 'VAP': 2.0, 'CVAP': 1.0, ...}, ...} (multi-column weights, see make_prec_pct_maps)
         use_index_for_source_key: True ==> Use geopandas index as key
+        weight_rules ((prop regex, weight column), ...), default_weight: which column each prop is apportioned with, for multi-column weights
+        engine: "dict" or "crosswalk" (see disaggregate_precs)
+        sink: aggregate accumulator (see aggregate.make_accumulator) ==> block values go straight into it, and nothing is returned
+        registry: block registry ==> block_map_path is the encoded block map and block_pop_map the encoded weights (see block_registry);
+            the block pcts come straight from their arrays, as CSR segments, and are disaggregated on them (see disaggregate_segments)
     """
-    with open(block_map_path) as json_file:
-        block_map = json.load(json_file)
+    block_map = json_stream.load(block_map_path)
 
-        source_props_total = {}
-        source_props_cnty_total = {}
-        # Build source props map {srckey1: {prop1: val1, ...}, ...}
-        source_props_map = {}
-        if (sourceIsCsv):
-            with open(source_props_path) as source_csv_file:
-                source_rows = csv.DictReader(source_csv_file, delimiter=",")
-                for row in tqdm(source_rows):
-                    srprec = ""
-                    if source_key in row:
-                        srprec = row[source_key]
-                        source_props_map[srprec] = {}
-                        for prop_key, prop_value in row.items():
-                            if prop_key != source_key and ok_to_agg(prop_key, prop_value):
-                                source_props_map[srprec][prop_key] = prop_value
-                                sum_props(source_props_total, prop_key, prop_value)
-                    else:
-                        print("Blkprops csv: No key", end="\n")
-                        continue
-        else:
-            source_props = gpd.read_file(source_props_path)
-            for i in source_props.index:
-                source_props_item = source_props.loc[i]
-                srckey = i if use_index_for_source_key else str(source_props_item[source_key])
-                source_props_map[srckey] = {}
-                countyfp = source_props_item["COUNTYFP"] if track_counties and ("COUNTYFP" in source_props_item) else None
-                countyname = source_props_item["CNTY_NAME"] if track_counties and ("CNTY_NAME" in source_props_item) else None
-                for prop_key, prop_value in source_props_item.items():
-                    if prop_key != srckey and ok_to_agg(prop_key, prop_value):
-                        # To handle more contests, call
-                        prop_key = filter_prop_key(prop_key, state, source_year, listpropsonly)
-                        if prop_key != None:
-                            if not (prop_key in source_props_map[srckey]):
-                                source_props_map[srckey][prop_key] = 0
-                            source_props_map[srckey][prop_key] += int(prop_value)
-                            sum_props(source_props_total, prop_key, prop_value, countymap=source_props_cnty_total, countyfp=countyfp, countyname=countyname)
-                    
-        # Hook to move props from 1 srckey to another, in rare cases
-        adjust_source_props_map(state, source_year, source_props_map)
+    source_props_total = {}
+    source_props_cnty_total = {}
+    # Build source props map {srckey1: {prop1: val1, ...}, ...}
+    source_props_map = {}
+    if (sourceIsCsv):
+        with open(source_props_path) as source_csv_file:
+            source_rows = csv.DictReader(source_csv_file, delimiter=",")
+            plan = compile_column_plan(tuple(source_rows.fieldnames or ()), ok_to_agg, state, source_year, listpropsonly, filter_keys=False, skip_column=source_key)
+            for row in tqdm(source_rows):
+                srprec = ""
+                if source_key in row:
+                    srprec = row[source_key]
+                    source_props_map[srprec] = {}
+                    for prop_key in plan.keys():
+                        prop_value = row[prop_key]
+                        if is_int(prop_value):
+                            source_props_map[srprec][prop_key] = prop_value
+                            sum_props(source_props_total, prop_key, prop_value)
+                else:
+                    print("Blkprops csv: No key", end="\n")
+                    continue
+    else:
+        source_props_map, source_props_total, source_props_cnty_total = read_source_props(source_props_path, source_key, use_index_for_source_key,
+                                                                                          ok_to_agg, state, source_year, listpropsonly)
 
-        pp = log.pretty_printer()
-        log.dprint("Source Props totals")
-        pp.pprint(source_props_total)
-        if track_counties:
-            pp.pprint(source_props_cnty_total)
-        if listpropsonly:
-            return None
+    # Hook to move props from 1 srckey to another, in rare cases
+    adjust_source_props_map(state, source_year, source_props_map)
 
-        # Build map {prec1: {blk1: pct1, ...}, ...}
-        # Then build map {prec1: {blk1: {key1: val1, ...}, ...}, ...} with largest_remainder for all keys on all precincts, so all values are integers
-        prec_blk_pct_map = {}
-        for block, preclist in tqdm(block_map.items()):
-            if isinstance(preclist, list):
-                for prec in preclist:
-                    if prec != "":
-                        if not (prec in prec_blk_pct_map):
-                            prec_blk_pct_map[prec] = {}
-                        if not (block in prec_blk_pct_map[prec]):
-                            prec_blk_pct_map[prec][block] = 0
-            else:
-                prec = preclist
+    pp = log.pretty_printer()
+    log.dprint("Source Props totals")
+    pp.pprint(source_props_total)
+    if track_counties:
+        pp.pprint(source_props_cnty_total)
+    if listpropsonly:
+        return None
+
+    # Build map {prec1: {blk1: pct1, ...}, ...}
+    # Then build map {prec1: {blk1: {key1: val1, ...}, ...}, ...} with largest_remainder for all keys on all precincts, so all values are integers
+    if registry != None:
+        columns, prop_weights = make_weight_columns(log, block_pop_map["columns"], source_props_map, weight_rules, default_weight)
+        segments = block_registry.make_prec_segments(registry, block_map, block_pop_map, tuple(columns))
+        return disaggregate_segments(log, registry, segments, columns, source_props_map, ok_to_agg, engine, sink, prop_weights)
+
+    prec_blk_pct_map = {}
+    for block, preclist in tqdm(block_map.items()):
+        if isinstance(preclist, list):
+            for prec in preclist:
                 if prec != "":
                     if not (prec in prec_blk_pct_map):
                         prec_blk_pct_map[prec] = {}
                     if not (block in prec_blk_pct_map[prec]):
                         prec_blk_pct_map[prec][block] = 0
+        else:
+            prec = preclist
+            if prec != "":
+                if not (prec in prec_blk_pct_map):
+                    prec_blk_pct_map[prec] = {}
+                if not (block in prec_blk_pct_map[prec]):
+                    prec_blk_pct_map[prec][block] = 0
 
-        for prec, blks in prec_blk_pct_map.items():
-            sum_blks_pop = 0
-            for block in blks.keys():
-                if block in block_pop_map:
-                    sum_blks_pop += block_pop_map[block]
-                else:
-                    log.dprint("Block not in block_pop_map: ", block)
-            if sum_blks_pop > 0:
-                for block in blks.keys():
-                    if block in block_pop_map:
-                          blks[block] = block_pop_map[block] / sum_blks_pop
-            else:
-                for block in blks.keys():
-                    blks[block] = 1     # All blocks have zero pop, but pick one in case prec has data
-                    break
+    prec_blk_pct_map, weight_maps, prop_weights = make_prec_pct_maps(log, prec_blk_pct_map, block_pop_map, source_props_map, weight_rules, default_weight)
 
-        prec_blk_key_map = make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg)
-        return make_final_blk_map(log, prec_blk_key_map)
+    return disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, engine, sink, weight_maps, prop_weights)
 
 
 """
@@ -637,7 +860,7 @@ def srprec_key(county, srprec):
 #def keep_key(key):
 #    return key[0:3] == "ATG" or key[0:3] == "GOV" or key[0:3] == "USS" or key[0:3] == "LTG" or key[0:3] == "PRS"
 
-def make_block_props_map_ca(log, source_props_path, block_map_path, ok_to_agg, source_year, listpropsonly):
+def make_block_props_map_ca(log, source_props_path, block_map_path, ok_to_agg, source_year, listpropsonly, engine="dict", sink=None):
     """
         source_props is CSV [COUNTY, SRPREC, props...]   or may have SRPREC_KEY instead of COUNTY
         block_map is CSV [COUNTY, ..., BLOCK_KEY, SRPREC, ]
@@ -652,6 +875,7 @@ def make_block_props_map_ca(log, source_props_path, block_map_path, ok_to_agg, s
     source_props_map = {}
     with open(source_props_path) as source_csv_file, open(block_map_path) as block_csv_file:
         source_rows = csv.DictReader(source_csv_file, delimiter=",")
+        plan = compile_column_plan(tuple(source_rows.fieldnames or ()), ok_to_agg, "CA", source_year, listpropsonly, filter_first=True)
         source_props_total = {}
         source_props_cnty_total = {}
         for row in tqdm(source_rows):
@@ -667,9 +891,9 @@ def make_block_props_map_ca(log, source_props_path, block_map_path, ok_to_agg, s
                 source_props_map[srprec] = {"SRPREC_KEY": srprec}
                 countyfp = row["COUNTY"] if track_counties and ("COUNTY" in row) else None
                 countyname = row["CNTY_NAME"] if track_counties and ("CNTY_NAME" in row) else None
-                for prop_key, prop_value in row.items():
-                    prop_key = filter_prop_key(prop_key, "CA", source_year, listpropsonly)
-                    if prop_key != None and ok_to_agg(prop_key, prop_value):
+                for column, prop_key in plan.items():
+                    prop_value = row[column]
+                    if is_int(prop_value):
                         source_props_map[srprec][prop_key] = prop_value
                         sum_props(source_props_total, prop_key, prop_value, countymap=source_props_cnty_total, countyfp=countyfp, countyname=countyname)
 
@@ -698,10 +922,57 @@ def make_block_props_map_ca(log, source_props_path, block_map_path, ok_to_agg, s
                     prec_blk_pct_map[srprec][block] = 0
                 prec_blk_pct_map[srprec][block] += pctsrprec
         # verify_pcts()
-        prec_blk_key_map = make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg)
-        return make_final_blk_map(log, prec_blk_key_map)
+        return disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, engine, sink)
 
-def make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg):
+def disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, engine="dict", sink=None, weight_maps=None, prop_weights=None):
+    """
+        prec_blk_pct_map {prec: {blk: pct, ...}, ...} and source_props_map {prec: {prop: val, ...}, ...} ==> final block map {blk: {prop: val, ...}, ...}
+        engine: "dict" ==> make_prec_blk_key_map and make_final_blk_map
+                "crosswalk" ==> sparse matrices (see crosswalk.make_final_blk_map); same result
+        sink: aggregate accumulator ==> instead of building the final block map, the block values are aggregated into sink as they're made
+            (one precinct at a time for "dict", all blocks at once for "crosswalk"); returns None
+        weight_maps, prop_weights: props apportioned with other block weights than prec_blk_pct_map's (see make_prec_pct_maps)
+    """
+    if engine == "crosswalk":
+        if not any("datasets" in row for row in source_props_map.values()):
+            if sink is None:
+                return crosswalk.make_final_blk_map(prec_blk_pct_map, source_props_map, ok_to_agg, weight_maps, prop_weights)
+            block_keys, props, block_values, block_present, units = crosswalk.disaggregate_blocks(prec_blk_pct_map, source_props_map, ok_to_agg, weight_maps, prop_weights)
+            crosswalk.add_block_values(sink, block_keys, props, block_values, block_present, [True] * len(props), units)
+            return None
+        log.dprint("Crosswalk engine doesn't handle datasets; using dict engine")
+    prec_blk_key_map = make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg, sink, weight_maps, prop_weights)
+    if sink is not None:
+        return None
+    return make_final_blk_map(log, prec_blk_key_map)
+
+def disaggregate_segments(log, registry, segments, columns, source_props_map, ok_to_agg, engine="dict", sink=None, prop_weights=None):
+    """
+        disaggregate_precs for the compact maps: segments (prec_keys, indptr, blocks, pcts) are the block pcts of each precinct
+        (see block_registry.make_prec_segments), one pcts column for each of columns (prop_weights: see make_prec_pct_maps)
+        Either engine gives the same result, so the segments go to the crosswalk's array disaggregation as they are: block values
+        by ordinal, into sink by ordinal, and block ids decoded only for the final block map.
+        Source rows with "datasets" need the dict engine; then the segments are decoded to pct maps (and a compact sink's dests to a dict)
+    """
+    if not any("datasets" in row for row in source_props_map.values()):
+        block_ordinals, props, block_values, block_present, units = crosswalk.disaggregate_segments(*segments, columns, source_props_map, ok_to_agg, prop_weights)
+        if sink is None:
+            return crosswalk.make_block_value_map(block_registry.block_ids(registry, block_ordinals), props, block_values, block_present, units)
+        crosswalk.add_block_values(sink, None, props, block_values, block_present, [True] * len(props), units, block_ordinals)
+        return None
+    log.dprint("Compact maps: datasets rows; decoded for the dict engine")
+    pct_maps = block_registry.segment_pct_maps(registry, *segments)
+    if sink is not None and sink["registry"] != None:
+        sink["dest_block_map"] = block_registry.decode_dest_codes(sink["registry"], sink["dest_block_map"])
+        sink["registry"] = None
+    return disaggregate_precs(log, pct_maps[0], source_props_map, ok_to_agg, "dict", sink, dict(zip(columns[1:], pct_maps[1:])) if prop_weights != None else None, prop_weights)
+
+def make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg, sink=None, weight_maps=None, prop_weights=None):
+    """
+        Returns {prec: {blk: {key: val, ...}, ...}, ...}, every prop of every precinct apportioned over its blocks
+        (with the pcts of its weight column in weight_maps, if prop_weights gives it one; else prec_blk_pct_map's)
+        sink: aggregate accumulator ==> each precinct's blocks are added into it (aggregate.add_block) and not kept (returns {})
+    """
     prec_blk_key_map = {}
     cant_disagg_set = {}
 
@@ -720,18 +991,34 @@ def make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg):
             for blk in blk_pcts.keys():
                 prec_blk_key_map[srprec][blk] = {}
             row = source_props_map[srprec]
+            # All of the precinct's props are apportioned together (see apportion.largest_remainder)
+            keys = []
+            values = []
             for key, value in row.items():
                 if key == "datasets":
-                    distribute_dataset_values(prec_blk_key_map[srprec], blk_pcts, value)
+                    # apportioned at the row's position, so the blocks' keys are in the same order as distribute_dataset_values gives them
+                    for ds_key, ds_value in dataset_items(value):
+                        keys.append(ds_key)
+                        values.append(int(ds_value))
                 elif ok_to_agg(key):
                     try:
-                        distribute_value(prec_blk_key_map[srprec], blk_pcts, key, int(value), srprec)
+                        values.append(int(value))
+                        keys.append(key)
                         countyfp = blk[2:5] if track_counties else None
                         sum_props(props_total, key, value, countymap=props_cnty_total, countyfp=countyfp)
                     except:
                         if not (key in cant_disagg_set):
                             print("Can't disagg key: ", key)
                             cant_disagg_set[key] = True
+            if len(keys) > 0:
+                blk_values, lacking = apportion_prec(srprec, blk_pcts, keys, values, weight_maps, prop_weights)
+                for blk, blk_row in zip(blk_pcts.keys(), blk_values.tolist()):
+                    prec_blk_key_map[srprec][blk].update(zip(keys, blk_row))
+                for k in np.flatnonzero(lacking).tolist():
+                    print("Distribution lacking:", srprec, keys[k], int(lacking[k]), sep=" ")
+            if sink is not None:
+                for blk, key_map in prec_blk_key_map.pop(srprec).items():
+                    aggregate.add_block(sink, blk, key_map)
 
         else:
             log.dprint("Prec Key not found: ", srprec)
@@ -759,31 +1046,45 @@ def make_prec_blk_key_map(log, prec_blk_pct_map, source_props_map, ok_to_agg):
 
     return prec_blk_key_map
 
+def apportion_prec(srprec, blk_pcts, keys, values, weight_maps=None, prop_weights=None):
+    """
+        apportion.largest_remainder of precinct srprec's props (keys, values) over its blocks, each group of props with the pcts of its weight column
+        Returns (blk_values, lacking) for all keys, as largest_remainder does
+    """
+    if not weight_maps:
+        return apportion.largest_remainder(list(blk_pcts.values()), values)
+    values = np.asarray(values, dtype=np.int64)
+    blk_values = np.zeros((len(blk_pcts), len(keys)), dtype=np.int64)
+    lacking = np.zeros(len(keys), dtype=np.int64)
+    for column, cols in apportion.weight_groups(keys, prop_weights, weight_maps).items():
+        pcts = blk_pcts if column == None else weight_maps[column][srprec]
+        blk_values[:, cols], lacking[cols] = apportion.largest_remainder(list(pcts.values()), values[cols])
+    return blk_values, lacking
+
 def getf(ds, f):
     return 0 if not (f in ds) else (ds[f])
 
-def distribute_dataset_values(blk_key_map, blk_pcts, datasets):
+def dataset_items(datasets):
+    """
+        [(key, value), ...] of the props in datasets {"D10F": {"Tot": 3, ...}, "D10T": {...}}, in the order distribute_dataset_values gives them
+    """
+    items = []
     if "D10F" in datasets:
         ds = datasets["D10F"]
-        distribute_value(blk_key_map, blk_pcts, "TOT", getf(ds, "Tot"))
-        distribute_value(blk_key_map, blk_pcts, "WH", getf(ds, "Wh"))
-        distribute_value(blk_key_map, blk_pcts, "HIS", getf(ds, "His"))
-        distribute_value(blk_key_map, blk_pcts, "BLC", getf(ds, "BlC"))
-        distribute_value(blk_key_map, blk_pcts, "ASNC", getf(ds, "AsnC"))
-        distribute_value(blk_key_map, blk_pcts, "PACC", getf(ds, "PacC"))
-        distribute_value(blk_key_map, blk_pcts, "NATC", getf(ds, "NatC"))
+        items += [("TOT", getf(ds, "Tot")), ("WH", getf(ds, "Wh")), ("HIS", getf(ds, "His")), ("BLC", getf(ds, "BlC")),
+                  ("ASNC", getf(ds, "AsnC")), ("PACC", getf(ds, "PacC")), ("NATC", getf(ds, "NatC"))]
     if "D10T" in datasets:
         ds = datasets["D10T"]
-        distribute_value(blk_key_map, blk_pcts, "TOT18", getf(ds, "Tot"))
-        distribute_value(blk_key_map, blk_pcts, "WH18", getf(ds, "Wh"))
-        distribute_value(blk_key_map, blk_pcts, "HIS18", getf(ds, "His"))
-        distribute_value(blk_key_map, blk_pcts, "BLC18", getf(ds, "BlC"))
-        distribute_value(blk_key_map, blk_pcts, "ASNC18", getf(ds, "AsnC"))
-        distribute_value(blk_key_map, blk_pcts, "PACC18", getf(ds, "PacC"))
-        distribute_value(blk_key_map, blk_pcts, "NATC18", getf(ds, "NatC"))
+        items += [("TOT18", getf(ds, "Tot")), ("WH18", getf(ds, "Wh")), ("HIS18", getf(ds, "His")), ("BLC18", getf(ds, "BlC")),
+                  ("ASNC18", getf(ds, "AsnC")), ("PACC18", getf(ds, "PacC")), ("NATC18", getf(ds, "NatC"))]
+    return items
+
+def distribute_dataset_values(blk_key_map, blk_pcts, datasets):
+    for key, value in dataset_items(datasets):
+        distribute_value(blk_key_map, blk_pcts, key, value)
 
 def distribute_value(blk_key_map, blk_pcts, key, value, prec=''):
-    # Hare quota (Hamilton)
+    # Hare quota (Hamilton), one prop at a time (make_prec_blk_key_map does all of a precinct's props at once with apportion.largest_remainder)
 
     blks_info = []    # [(blk, whole, rem), ...]
     sum_wholes = 0
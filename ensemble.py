@@ -0,0 +1,127 @@
+# Plan ensemble aggregation: district totals of one block dataset for many districting plans
+#
+# For redistricting ensemble analysis: the block data is loaded once as a dense (blocks x props) matrix (load_block_matrix),
+# and plans come as block assignment vectors (district number of each block, in the matrix's block order; see make_assignments).
+# A batch of plans is aggregated with one sparse reduction -- a bincount of each prop by (plan, district) -- so a plan takes
+# milliseconds instead of a step 4 run, and batches can go to worker processes.
+#
+# Library API only; process_state doesn't use it.
+#
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor
+
+from . import agg_logging as log
+from . import crosswalk
+from . import json_stream
+
+def load_block_matrix(block_props_path, ok_to_agg, srcIsGeojson=False, block_keys=None):
+    """
+        Reads block data {blkid: {field1: value1, ...}} (or geojson features with GEOID, if srcIsGeojson) into a dense matrix.
+        Returns (block_keys, props, values):
+            block_keys: block of each row; file order, or block_keys if given (blocks that aren't in the file are all 0)
+            props: the props that aggregate (ok_to_agg name, number values)
+            values: (blocks x props) int64 if all props have integer values, else float64; missing and non number values are 0,
+                and a block that's in the file more than once gets the sum
+    """
+    keys = []
+    rows = []
+    for key, value in json_stream.iter_items(block_props_path, "features" if srcIsGeojson else None):
+        if srcIsGeojson:
+            value = value["properties"]
+            key = value["GEOID"]
+        keys.append(key)
+        rows.append(value)
+    props, values, present, is_int = crosswalk.make_block_frame(keys, rows, None, ok_to_agg)
+    numbers = np.flatnonzero(present.any(axis=0)).tolist()     # leave out props with no number values at all
+    props, values, is_int = [props[c] for c in numbers], values[:, numbers], [is_int[c] for c in numbers]
+
+    if block_keys is None:
+        block_keys = list(dict.fromkeys(keys))
+    ordinals = {block: b for b, block in enumerate(block_keys)}
+    row_blocks = np.array([ordinals.get(key, -1) for key in keys], dtype=np.int64)
+    in_blocks = row_blocks >= 0
+    matrix = np.zeros((len(block_keys), len(props)))
+    np.add.at(matrix, row_blocks[in_blocks], values[in_blocks])
+    if all(is_int):
+        matrix = np.rint(matrix).astype(np.int64)
+    log.dprint("Block matrix: ", block_props_path, ", blocks: ", len(block_keys), ", props: ", len(props), ", dtype: ", matrix.dtype)
+    return block_keys, props, matrix
+
+def make_assignments(block_keys, plans):
+    """
+        plans: list of block assignment maps {blkid: district, ...} (or block maps as step 2 writes them, {blkid: [district]})
+        Returns (assignments, districts): assignments (int32, plans x blocks of block_keys) holds the district number (index into
+            districts, all the plans' districts in order of first appearance) of each block; -1 ==> block isn't in the plan
+        Each plan is lined up with block_keys by one reindex, and its districts numbered by one factorize (first appearance in block order)
+    """
+    district_ordinals = {}
+    assignments = np.full((len(plans), len(block_keys)), -1, dtype=np.int32)
+    for p, plan in enumerate(plans):
+        dests = [dest[0] if isinstance(dest, list) else dest for dest in plan.values()]
+        plan_districts = pd.Series(dests, index=list(plan.keys()), dtype=object).reindex(block_keys)
+        codes, districts = pd.factorize(plan_districts.to_numpy())    # -1 ==> block isn't in the plan (or has no district)
+        if len(districts) > 0:
+            ordinals = np.array([district_ordinals.setdefault(district, len(district_ordinals)) for district in districts], dtype=np.int32)
+            assignments[p] = np.where(codes >= 0, ordinals[codes], -1)
+    return assignments, list(district_ordinals.keys())
+
+def plan_totals(values, assignments, num_districts):
+    """
+        Totals (plans x num_districts x props) of values (blocks x props) for a batch of assignments (plans x blocks):
+        one sparse (plans * districts x blocks) reduction times values, exact for integer values
+    """
+    plan_idx, block_idx = np.nonzero((assignments >= 0) & (assignments < num_districts))
+    rows = plan_idx.astype(np.int64) * num_districts + assignments[plan_idx, block_idx]
+    reducer = sparse.csr_matrix((np.ones(len(rows), dtype=values.dtype), (rows, block_idx)), shape=(assignments.shape[0] * num_districts, values.shape[0]))
+    return np.asarray(reducer @ values).reshape(assignments.shape[0], num_districts, values.shape[1])
+
+# The block matrix of a worker process (set once by the pool initializer, not sent with every batch)
+worker_values = None
+
+def init_worker(values):
+    global worker_values
+    worker_values = values
+
+def worker_plan_totals(batch):
+    assignments, num_districts = batch
+    return plan_totals(worker_values, assignments, num_districts)
+
+def aggregate_plans(values, assignments, num_districts=None, workers=1, batch_plans=None):
+    """
+        District totals of many plans: values is the block matrix (see load_block_matrix); assignments is (plans x blocks)
+        district numbers 0 .. num_districts - 1 (-1 ==> block not counted), or a single plan (blocks)
+        num_districts: None ==> 1 + the largest district number
+        workers: > 1 ==> batches of batch_plans plans (default: about 16M block entries per batch) are done in that many worker processes
+        Returns totals (plans x districts x props), same dtype as values (or districts x props for a single plan)
+    """
+    assignments = np.asarray(assignments)
+    single = assignments.ndim == 1
+    if single:
+        assignments = assignments.reshape(1, -1)
+    if assignments.shape[1] != values.shape[0]:
+        raise ValueError(f'Assignments are for {assignments.shape[1]} blocks, block matrix has {values.shape[0]}')
+    if num_districts == None:
+        num_districts = int(assignments.max()) + 1 if assignments.size > 0 else 0
+    if batch_plans == None:
+        batch_plans = max(1, (1 << 24) // max(1, values.shape[0]))
+    batches = [(assignments[start:start + batch_plans], num_districts) for start in range(0, assignments.shape[0], batch_plans)]
+
+    if workers > 1 and len(batches) > 1:
+        log.dprint("Plans: ", assignments.shape[0], ", batches: ", len(batches), ", workers: ", workers)
+        log.flush()     # so the workers don't inherit (and repeat) unwritten log output
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(values,)) as executor:
+            results = list(executor.map(worker_plan_totals, batches))
+    else:
+        results = [plan_totals(values, batch_assignments, batch_districts) for batch_assignments, batch_districts in batches]
+
+    totals = np.concatenate(results) if len(results) > 0 else np.zeros((0, num_districts, values.shape[1]), dtype=values.dtype)
+    return totals[0] if single else totals
+
+def district_props(totals, props, districts):
+    """
+        One plan's totals (districts x props) as {district: {prop1: total1, ...}, ...}
+    """
+    return {district: dict(zip(props, row)) for district, row in zip(districts, totals.tolist())}
@@ -0,0 +1,121 @@
+# Cache for geometry files that get read (and reprojected) over and over, e.g. the tl_*_tabblock block shapefile
+#
+# Each cached copy is GeoParquet in a cache directory, keyed by the original file's path, size and mtime and the target CRS,
+# holding only the key column(s) and the (reprojected, repaired) geometry.
+#
+# read_columns is the (uncached) reader: only the key column(s) and geometry, thru pyogrio's Arrow reader when available.
+#
+
+import os
+import hashlib
+import importlib.util
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+
+from . import agg_logging as log
+from . import manifest
+
+def cache_path(cache_dir, path, crs, columns, bbox=None):
+    """
+    Path of the cached copy of path, for target crs (None ==> file's own CRS), key columns and bbox (None ==> whole file)
+    The original file is identified by its path, size and mtime (see manifest.file_stat), so it isn't read just to find its cached copy
+    """
+    key = os.path.abspath(path) + '|' + repr(manifest.file_stat(path)) + '|' + (crs.to_wkt() if crs else '') + '|' + ','.join(columns)
+    if bbox is not None:
+        key += '|' + ','.join(repr(float(v)) for v in bbox)
+    key = hashlib.sha1(key.encode()).hexdigest()[0:16]
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '_' + key + '.parquet')
+
+def polygonal_part(geom):
+    """
+    make_valid can turn a polygon into a GeometryCollection (polygons plus stray lines/points); keeps only the polygonal part
+    """
+    if geom.geom_type != 'GeometryCollection':
+        return geom
+    polygons = [part for part in geom.geoms if part.geom_type in ('Polygon', 'MultiPolygon')]
+    return shapely.union_all(polygons) if len(polygons) > 0 else shapely.Polygon()
+
+def repair_geometries(shapes, key_column=None, label=''):
+    """
+    Vectorized pre-pass: finds invalid geometry in GeoDataFrame shapes and repairs it (make_valid, polygonal part only) in place,
+    so the overlap calculations don't have to catch intersection errors.
+    Logs and returns the list of keys (key_column values, or index if no key_column) of the repaired shapes
+    """
+    geoms = shapes.geometry.values
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+    if not invalid.any():
+        return []
+    repaired = shapely.make_valid(geoms[invalid])
+    repaired = np.array([polygonal_part(geom) for geom in repaired], dtype=object)
+    shapes.loc[invalid, shapes.geometry.name] = repaired
+    repaired_keys = (shapes.loc[invalid, key_column] if key_column != None else shapes.index[invalid]).tolist()
+    log.dprint("Repaired invalid geometry: ", label, ", count: ", len(repaired_keys))
+    for key in repaired_keys:
+        log.dprint("Repaired geometry: ", label, ": ", key)
+    return repaired_keys
+
+def read_columns(path, columns, bbox=None, bbox_crs=None):
+    """
+    Reads only columns (list of key columns) and geometry of the geometry file at path, skipping all other attributes
+    (precinct files can have hundreds of election columns). Uses pyogrio with Arrow when those are installed, else fiona.
+    bbox: (minx, miny, maxx, maxy) ==> only features meeting that box are read; bbox_crs is its CRS (None ==> the file's own)
+    Without bbox, row order (and so the index) is the same as gpd.read_file(path).
+    """
+    try:
+        import pyogrio
+    except ImportError:
+        pyogrio = None
+
+    if pyogrio == None:
+        # fiona reads every attribute anyway, but does reproject a GeoSeries bbox to the file's CRS
+        if bbox is not None and bbox_crs is not None:
+            bbox = gpd.GeoSeries([box(*bbox)], crs=bbox_crs)
+        shapes = gpd.read_file(path, bbox=bbox)
+        return shapes[columns + [shapes.geometry.name]]
+
+    if bbox is not None:
+        file_crs = pyogrio.read_info(path)["crs"]
+        if bbox_crs is not None and file_crs:
+            bbox = tuple(gpd.GeoSeries([box(*bbox)], crs=bbox_crs).to_crs(file_crs).total_bounds)
+        bbox = tuple(bbox)
+    # pyogrio raises RuntimeError (not ImportError) for use_arrow without pyarrow, so check for it up front
+    use_arrow = importlib.util.find_spec("pyarrow") != None
+    return gpd.read_file(path, engine="pyogrio", columns=columns, bbox=bbox, use_arrow=use_arrow)
+
+def read_geo(path, columns, crs=None, cache_dir=None, bbox=None, bbox_crs=None, repair=False):
+    """
+    Reads geometry file at path (geojson or shapefile), keeping only columns (list of key columns) and geometry,
+    reprojected to crs (if given, and the file has a CRS) and with invalid geometry repaired (see repair_geometries).
+    Row order (and so the index) is the same as gpd.read_file(path).
+    bbox, bbox_crs: as for read_columns
+
+    If cache_dir is given, the result is read from / written to a GeoParquet cache there (see cache_path).
+    Without pyarrow the cache can't be written, and the file is just read.
+    repair: True ==> a cached copy is checked (and repaired) again, too, as it may have been written without the repair
+    """
+    if cache_dir != None:
+        cached_path = cache_path(cache_dir, path, crs, columns, bbox)
+        if os.path.exists(cached_path):
+            log.dprint("Reading cached geometry: ", cached_path)
+            shapes = gpd.read_parquet(cached_path)
+            if repair:
+                repair_geometries(shapes, columns[0] if len(columns) > 0 else None, path)
+            return shapes
+
+    shapes = read_columns(path, columns, bbox, bbox_crs)
+    if crs and shapes.crs:
+        shapes = shapes.to_crs(crs)
+    repair_geometries(shapes, columns[0] if len(columns) > 0 else None, path)
+
+    if cache_dir != None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cached_path + '.' + str(os.getpid()) + '.tmp'     # steps running at the same time may cache the same file
+            shapes.to_parquet(tmp_path)
+            os.replace(tmp_path, cached_path)
+            log.dprint("Wrote cached geometry: ", cached_path)
+        except ImportError as e:
+            log.dprint("Geometry not cached (", e, "): ", path)
+    return shapes
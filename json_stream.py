@@ -0,0 +1,107 @@
+# Incremental reader for the big JSON files passed between steps: block data {blkid: {field1: value1, ...}, ...},
+# block maps {blkid: [key], ...} and geojson (its "features" array)
+#
+# The file is read a chunk at a time and each member (or array item) is decoded by itself with json.JSONDecoder.raw_decode,
+# so only the current chunk and the current item are in memory, not the whole file and everything parsed from it.
+#
+
+import json
+import re
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+number_rest = re.compile(r'[0-9.eE+\-]*\Z')      # what's left of a number cut off at the end of the chunk
+
+def load(source):
+    """
+    The JSON in the file at path source; source that isn't a path is taken to be the object itself, already in memory
+    (e.g. handed from one step to the next in pipeline mode; see disagg_agg.run_steps)
+    """
+    if not isinstance(source, str):
+        return source
+    with open(source, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+def iter_items(path, member=None, chunk_size=1 << 20):
+    """
+    Yields (key, value) for each member of the top-level JSON object in the file at path, in file order
+    member: name of a member of the top-level object that's an array (e.g. "features" of a geojson) ==> yields (index, item)
+        for each item of that array instead; the other members are skipped
+    """
+    with open(path, encoding='utf-8') as json_file:
+        buf = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            """ Reads the next chunk into buf (dropping what's been used); False at end of file """
+            nonlocal buf, pos, eof
+            chunk = json_file.read(chunk_size) if not eof else ''
+            if chunk == '':
+                eof = True
+                return False
+            buf = buf[pos:] + chunk
+            pos = 0
+            return True
+
+        def next_char():
+            """ Next non-whitespace character (not used up), '' at end of file """
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in whitespace:
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if not fill():
+                    return ''
+
+        def expect(chars):
+            """ Uses up the next non-whitespace character, which must be one of chars """
+            nonlocal pos
+            char = next_char()
+            if char == '' or not (char in chars):
+                raise ValueError(f'{path}: expected one of {chars!r} at {json_file.tell()}, got {char!r}')
+            pos += 1
+            return char
+
+        def decode():
+            """
+            Decodes the next value; a value that reaches the end of the chunk (maybe cut off, e.g. a number) is retried with more text,
+            as is a number followed by nothing but number characters to the end of the chunk (cut off after its '.' or 'e', "12." decodes as 12)
+            """
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    if eof or (end < len(buf) and not (isinstance(value, (int, float)) and number_rest.match(buf, end))):
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        if next_char() == '}':
+            return
+        while True:
+            key = decode()
+            expect(':')
+            if member == None:
+                yield key, decode()
+            elif key == member:
+                expect('[')
+                if next_char() == ']':
+                    pos += 1
+                else:
+                    index = 0
+                    while True:
+                        yield index, decode()
+                        index += 1
+                        if expect(',]') == ']':
+                            break
+            else:
+                decode()
+            if expect(',}') == '}':
+                break
@@ -0,0 +1,110 @@
+# Content-hash manifest for the process_state steps
+#
+# For each step that has run, the manifest records the content hashes of its input files, a hash of its parameters (state, years,
+# config flags) and the hashes of the output files it wrote. A step is up to date -- and can be skipped -- when its inputs and
+# parameters hash the same as when it last ran and its outputs are still the files it wrote. A rebuilt step's outputs are the next
+# step's inputs, so only what's downstream of a real change is rebuilt (and not even that, if a rebuilt output comes out the same).
+# Touching a file doesn't count as a change; editing it does.
+#
+# File hashes are kept with the file's size and mtime, so an unchanged file is hashed once, not on every run.
+#
+
+import os
+import json
+import hashlib
+
+from . import agg_logging as log
+
+shapefile_parts = ['.shp', '.shx', '.dbf', '.prj']
+
+def load(manifest_path):
+    """
+    Manifest at manifest_path {"files": {path: {"stat": ..., "sha1": ...}}, "steps": {step key: record}}; empty if there isn't one
+    """
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as json_file:
+            return json.load(json_file)
+    return {"files": {}, "steps": {}}
+
+def save(manifest, manifest_path):
+    with open(manifest_path + ".tmp", "w") as outf:
+        json.dump(manifest, outf, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def file_parts(path):
+    """
+    Paths of the files that make up the file at path: for a shapefile, its .shp, .shx, .dbf and .prj files (those that exist)
+    """
+    root, ext = os.path.splitext(path)
+    return [root + part for part in shapefile_parts if os.path.exists(root + part)] if ext.lower() == '.shp' else [path]
+
+def file_stat(path):
+    """
+    [size, mtime_ns] of the file at path (of all parts, for a shapefile), or None if it doesn't exist
+    """
+    if not os.path.exists(path):
+        return None
+    stats = [os.stat(part_path) for part_path in file_parts(path)]
+    return [sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats)]
+
+def content_hash(path):
+    """
+    sha1 of the content of the file at path; for a shapefile, of the .shp, .shx, .dbf and .prj files together
+    """
+    sha = hashlib.sha1()
+    for part_path in file_parts(path):
+        with open(part_path, 'rb') as part_file:
+            for chunk in iter(lambda: part_file.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def file_hash(manifest, path):
+    """
+    Content hash of the file at path (None if it doesn't exist); reuses the manifest's hash if the file's size and mtime haven't changed
+    """
+    stat = file_stat(path)
+    if stat == None:
+        return None
+    known = manifest["files"].get(path)
+    if known != None and known["stat"] == stat:
+        return known["sha1"]
+    sha1 = content_hash(path)
+    manifest["files"][path] = {"stat": stat, "sha1": sha1}
+    return sha1
+
+def file_hashes(manifest, paths):
+    return {path: file_hash(manifest, path) for path in paths}
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+def step_key(step, outputs):
+    """
+    Steps are recorded by step number and output files, so runs with other paths (e.g. CVAP vs. election data) don't collide
+    """
+    return str(step) + ": " + ", ".join(outputs)
+
+def is_current(manifest, step, input_hashes, outputs, params):
+    """
+    True ==> step has run with the same input contents (input_hashes, see file_hashes) and params, and its outputs are unchanged since
+    """
+    record = manifest["steps"].get(step_key(step, outputs))
+    if record == None or record["params"] != params_hash(params) or record["inputs"] != input_hashes:
+        return False
+    return record["outputs"] == file_hashes(manifest, outputs)
+
+def record(manifest, step, input_hashes, outputs, params):
+    """
+    Records that step has run on inputs with input_hashes (taken before it ran): hashes of inputs, params and outputs.
+    Not recorded if an output wasn't written. Returns True if recorded.
+    """
+    output_hashes = file_hashes(manifest, outputs)
+    if None in output_hashes.values():
+        log.dprint("Manifest: step ", step, " outputs missing; not recorded")
+        return False
+    manifest["steps"][step_key(step, outputs)] = {
+        "params": params_hash(params),
+        "inputs": input_hashes,
+        "outputs": output_hashes
+    }
+    return True
@@ -0,0 +1,104 @@
+# Random test cases shared by the engine tests
+
+import math
+import random
+
+def ok_to_agg(prop, value=0):
+    return prop != "NAME" and prop != "DKEY"
+
+def make_case(seed, num_precs=40, num_blocks=300, num_props=8, datasets=False):
+    """
+    Random precinct data (precincts with different props, some in another order, a few non-number values),
+    block pcts (some blocks split between precincts) and a block ==> dest map (a few blocks not in it)
+    datasets: True ==> some precincts also have census "datasets" ({"D10F": {"Tot": n, ...}, "D10T": {...}}), among their props
+    """
+    rnd = random.Random(seed)
+    props = ["P" + str(p) for p in range(num_props)]
+    blocks = ["12" + str(b).zfill(13) for b in range(num_blocks)]
+    precs = ["PR" + str(p) for p in range(num_precs)]
+    source_props_map = {}
+    for prec in precs:
+        keys = [prop for prop in props if rnd.random() < 0.7]
+        if rnd.random() < 0.3:
+            rnd.shuffle(keys)
+        row = {"NAME": prec}
+        for key in keys:
+            row[key] = rnd.choice([str(rnd.randint(0, 50)), "x"]) if rnd.random() < 0.05 else rnd.randint(0, 500)
+        if datasets and rnd.random() < 0.5:
+            items = list(row.items())
+            fields = ["Tot", "Wh", "His", "BlC", "AsnC", "PacC", "NatC"]
+            value = {ds: {f: rnd.randint(0, 300) for f in fields if rnd.random() < 0.8} for ds in ("D10F", "D10T") if rnd.random() < 0.8}
+            items.insert(rnd.randint(1, len(items)), ("datasets", value))
+            row = dict(items)
+        source_props_map[prec] = row
+    prec_blk_pct_map = {}
+    for block in blocks:
+        for prec in rnd.sample(precs, rnd.choice([1, 1, 1, 2, 3])):
+            prec_blk_pct_map.setdefault(prec, {})[block] = rnd.random()
+    for blk_pcts in prec_blk_pct_map.values():
+        total = sum(blk_pcts.values())
+        for block in blk_pcts:
+            blk_pcts[block] /= total
+    dests = ["D" + str(d) for d in range(15)]
+    dest_block_map = {block: [rnd.choice(dests)] for block in blocks if rnd.random() < 0.97}
+    return source_props_map, prec_blk_pct_map, dest_block_map
+
+def shuffle_rows(block_props, seed):
+    """ Block data with some rows in another key order, a few non-number and NaN values """
+    rnd = random.Random(seed)
+    rows = {}
+    for block, row in block_props.items():
+        items = list(row.items())
+        if rnd.random() < 0.2:
+            rnd.shuffle(items)
+        if len(items) > 0 and rnd.random() < 0.05:
+            items[0] = (items[0][0], "zz")
+        if len(items) > 0 and rnd.random() < 0.05:
+            items[-1] = (items[-1][0], math.nan)
+        rows[block] = dict(items)
+    return rows
+
+def make_shapes(seed, nx=24, ny=16, spacing=4, jitter=0.6, holes=1):
+    """
+    Synthetic geometry: (precincts, blocks) GeoDataFrames (EPSG:3857) keyed by PKEY and GEOID20
+    Blocks are a nx x ny grid (nx, ny even; ny <= 20) of unit squares (two counties side by side; block groups of 2x2 blocks), plus a few blocks east of
+    everything. Precincts are a grid of spacing x spacing quads over the blocks, some of their corners moved by up to jitter
+    (so they split blocks; quads with no moved corner contain whole block groups), with holes of them left out
+    (blocks that overlap nothing) and one precinct far from any block.
+    """
+    import geopandas as gpd
+    from shapely.geometry import Polygon, box
+    rnd = random.Random(seed)
+    geoids = []
+    geoms = []
+    for y in range(ny):
+        for x in range(nx):
+            county = "001" if x < nx // 2 else "003"
+            geoids.append("12" + county + "00" + str(x // 2).zfill(2) + "00" + str(y // 2) + "00" + str((x % 2) + 2 * (y % 2)))
+            geoms.append(box(x, y, x + 1, y + 1))
+    for b in range(3):
+        geoids.append("120030099000" + str(b).zfill(3))
+        geoms.append(box(nx + 3 + b, 2 * b, nx + 4 + b, 2 * b + 1))
+    blocks = gpd.GeoDataFrame({"GEOID20": geoids}, geometry=geoms, crs="EPSG:3857")
+
+    px = nx // spacing
+    py = ny // spacing
+    corners = {}
+    for j in range(py + 1):
+        for i in range(px + 1):
+            inside = 0 < i < px and 0 < j < py
+            moved = inside and rnd.random() < 0.3
+            corners[(i, j)] = (i * spacing + (rnd.uniform(-jitter, jitter) if moved else 0), j * spacing + (rnd.uniform(-jitter, jitter) if moved else 0))
+    left_out = set(rnd.sample(range(px * py), holes))
+    keys = []
+    geoms = []
+    for j in range(py):
+        for i in range(px):
+            if j * px + i in left_out:
+                continue
+            keys.append("PR" + str(j * px + i))
+            geoms.append(Polygon([corners[(i, j)], corners[(i + 1, j)], corners[(i + 1, j + 1)], corners[(i, j + 1)]]))
+    keys.append("FAR")
+    geoms.append(box(-50, -50, -49, -49))
+    precincts = gpd.GeoDataFrame({"PKEY": keys}, geometry=geoms, crs="EPSG:3857")
+    return precincts, blocks
@@ -0,0 +1,26 @@
+# The repository directory is the package (its modules use relative imports), so the tests load it under a fixed name,
+# whatever the directory is called: `from disaggagg import aggregate`
+#
+# disagg_agg.py (and batch.py) import the user's prepare module (temp/prepare_disagg_agg.py); when there isn't one, the example
+# (prepare_disagg_agg_example.py) stands in for it, so those can be imported, too. Their tests don't call prepare.
+
+import os
+import sys
+import importlib.util
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not ("disaggagg" in sys.modules):
+    spec = importlib.util.spec_from_file_location("disaggagg", os.path.join(package_dir, "__init__.py"), submodule_search_locations=[package_dir])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["disaggagg"] = package
+    spec.loader.exec_module(package)
+
+if not os.path.exists(os.path.join(package_dir, "temp", "prepare_disagg_agg.py")) and not ("disaggagg.temp" in sys.modules):
+    import types
+    from disaggagg import prepare_disagg_agg_example
+    temp = types.ModuleType("disaggagg.temp")
+    temp.__path__ = []
+    temp.prepare_disagg_agg = prepare_disagg_agg_example
+    sys.modules["disaggagg.temp"] = temp
+    sys.modules["disaggagg.temp.prepare_disagg_agg"] = prepare_disagg_agg_example
@@ -0,0 +1,68 @@
+# Streaming aggregation (dest index, block data read a batch at a time) against aggregating the loaded files
+
+import json
+import numpy as np
+
+from disaggagg import agg_logging as log
+from disaggagg import aggregate
+from disaggagg import disaggregate
+
+from cases import make_case, shuffle_rows, ok_to_agg
+
+def write(path, obj):
+    with open(path, "w") as outf:
+        json.dump(obj, outf)
+    return str(path)
+
+def make_files(tmp_path, seed=0):
+    source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed)
+    block_props = shuffle_rows(disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg), seed)
+    county_map = {block: block[2:5] for block in block_props}
+    return (write(tmp_path / "block_data.json", block_props), write(tmp_path / "block_map.json", dest_block_map),
+            write(tmp_path / "county_map.json", county_map), block_props)
+
+def same_json(result, expected):
+    return json.dumps(result) == json.dumps(expected)
+
+def test_stream_same_as_loaded(tmp_path):
+    block_data_path, block_map_path, county_map_path, block_props = make_files(tmp_path)
+    for engine in ("dict", "crosswalk"):
+        expected = aggregate.make_aggregated_props(block_data_path, block_map_path, "DKEY", ok_to_agg, engine=engine)
+        result = aggregate.make_aggregated_props(block_data_path, block_map_path, "DKEY", ok_to_agg, engine=engine, stream=True)
+        assert same_json(result, expected)
+
+def test_stream_small_batches(tmp_path):
+    block_data_path, block_map_path, county_map_path, block_props = make_files(tmp_path, 1)
+    expected = aggregate.make_aggregated_props(block_data_path, block_map_path, "DKEY", ok_to_agg)
+    for engine in ("dict", "crosswalk"):
+        acc = aggregate.make_accumulator({}, "DKEY", ok_to_agg)
+        aggregate.stream_block_props([acc], block_data_path, [aggregate.make_dest_index(block_map_path, chunk_blocks=7)], engine=engine, batch_size=13)
+        assert same_json(aggregate.make_feature_collection(acc), expected)
+
+def test_stream_geojson(tmp_path):
+    block_data_path, block_map_path, county_map_path, block_props = make_files(tmp_path, 2)
+    features = [{"type": "Feature", "geometry": None, "properties": dict(row, GEOID=block)} for block, row in block_props.items()]
+    geojson_path = write(tmp_path / "blocks.geojson", {"type": "FeatureCollection", "features": features})
+    expected = aggregate.make_aggregated_props(geojson_path, block_map_path, "DKEY", ok_to_agg, srcIsGeojson=True)
+    result = aggregate.make_aggregated_props(geojson_path, block_map_path, "DKEY", ok_to_agg, srcIsGeojson=True, stream=True)
+    assert same_json(result, expected)
+
+def test_multi_same_as_one_at_a_time(tmp_path):
+    block_data_path, block_map_path, county_map_path, block_props = make_files(tmp_path, 3)
+    targets = [(block_map_path, "DKEY"), (county_map_path, "COUNTY")]
+    expected = [aggregate.make_aggregated_props(block_data_path, path, dest_key, ok_to_agg) for path, dest_key in targets]
+    for engine in ("dict", "crosswalk"):
+        for stream in (False, True):
+            result = aggregate.make_aggregated_props_multi(block_data_path, targets, ok_to_agg, engine=engine, stream=stream)
+            assert same_json(result, expected)
+
+def test_in_memory_same_as_files(tmp_path):
+    block_data_path, block_map_path, county_map_path, block_props = make_files(tmp_path, 4)
+    with open(block_map_path) as json_file:
+        dest_block_map = json.load(json_file)
+    expected = aggregate.make_aggregated_props(block_data_path, block_map_path, "DKEY", ok_to_agg)
+    assert same_json(aggregate.make_aggregated_props(block_props, dest_block_map, "DKEY", ok_to_agg, stream=True), expected)
+
+def test_lookup_dests():
+    dest_index = (np.array([b"A", b"B", b"C"]), np.array([1, 0, 1], dtype=np.int32), ["X", "Y"])
+    assert aggregate.lookup_dests(dest_index, ["C", "D", "A"]) == {"C": "Y", "A": "Y"}
@@ -0,0 +1,89 @@
+# apportion (the NumPy largest remainder kernel) against disaggregate.distribute_value, the one-prop-at-a-time version it replaced
+
+import json
+import random
+import numpy as np
+
+from disaggagg import agg_logging as log
+from disaggagg import apportion
+from disaggagg import disaggregate
+
+from cases import make_case, ok_to_agg
+
+def distribute(pcts, value):
+    blk_pcts = {"B" + str(b): pct for b, pct in enumerate(pcts)}
+    blk_key_map = {blk: {} for blk in blk_pcts}
+    disaggregate.distribute_value(blk_key_map, blk_pcts, "KEY", value)
+    return [blk_key_map[blk]["KEY"] for blk in blk_pcts]
+
+def random_pcts(rnd, count):
+    weights = [rnd.choice([0, 0, 1, 2, 5, rnd.randint(0, 1000)]) for b in range(count)]
+    total = sum(weights)
+    if total == 0:
+        return [1] + [0] * (count - 1)
+    return [weight / total for weight in weights]
+
+def test_largest_remainder_matches_distribute_value():
+    rnd = random.Random(1)
+    for trial in range(500):
+        pcts = random_pcts(rnd, rnd.randint(1, 30))
+        values = [rnd.choice([0, 1, 2, 3, rnd.randint(0, 100000)]) for p in range(rnd.randint(1, 6))]
+        result, lacking = apportion.largest_remainder(pcts, values)
+        for p, value in enumerate(values):
+            assert result[:, p].tolist() == distribute(pcts, value)
+        assert result.sum(axis=0).tolist() == values
+        assert lacking.tolist() == [0] * len(values)
+
+def test_ties_go_to_the_earlier_block():
+    pcts = [0.25] * 4
+    for value in range(9):
+        assert apportion.largest_remainder(pcts, [value])[0][:, 0].tolist() == distribute(pcts, value)
+    assert apportion.largest_remainder(pcts, [3])[0][:, 0].tolist() == [1, 1, 1, 0]
+
+def test_segments_match_one_precinct_at_a_time():
+    rnd = random.Random(2)
+    segments = [random_pcts(rnd, rnd.choice([1, 2, 3, 3, 7, 20])) for s in range(200)]
+    values = np.array([[rnd.randint(0, 5000) for p in range(5)] for s in segments])
+    indptr = np.cumsum([0] + [len(pcts) for pcts in segments])
+    result, lacking = apportion.largest_remainder_segments(np.concatenate(segments), indptr, values, chunk_elements=1000)
+    for s, pcts in enumerate(segments):
+        expected, expected_lacking = apportion.largest_remainder(pcts, values[s])
+        assert result[indptr[s]:indptr[s + 1]].tolist() == expected.tolist()
+        assert lacking[s].tolist() == expected_lacking.tolist()
+
+def test_lacking_when_pcts_fall_short():
+    result, lacking = apportion.largest_remainder([0.1, 0.1], [10, 0])
+    assert result[:, 0].tolist() == [2, 2]       # 1 each, and 1 more each of the 8 left over
+    assert lacking.tolist() == [6, 0]
+
+def test_weight_groups():
+    groups = apportion.weight_groups(["A", "B", "C", "D"], {"A": "VAP", "B": "CVAP", "C": "TOT"}, ("VAP", "TOT"))
+    assert groups == {"VAP": [0], None: [1, 3], "TOT": [2]}
+
+def baseline_prec_blk_key_map(prec_blk_pct_map, source_props_map):
+    """ The 2019 make_prec_blk_key_map loop: distribute_value one prop at a time, datasets props at the row's "datasets" """
+    dataset_fields = [("TOT", "Tot"), ("WH", "Wh"), ("HIS", "His"), ("BLC", "BlC"), ("ASNC", "AsnC"), ("PACC", "PacC"), ("NATC", "NatC")]
+    prec_blk_key_map = {}
+    for srprec, blk_pcts in prec_blk_pct_map.items():
+        if srprec in source_props_map:
+            prec_blk_key_map[srprec] = {blk: {} for blk in blk_pcts}
+            for key, value in source_props_map[srprec].items():
+                if key == "datasets":
+                    for ds, suffix in (("D10F", ""), ("D10T", "18")):
+                        if ds in value:
+                            for prop, f in dataset_fields:
+                                disaggregate.distribute_value(prec_blk_key_map[srprec], blk_pcts, prop + suffix, value[ds][f] if f in value[ds] else 0)
+                elif ok_to_agg(key):
+                    try:
+                        disaggregate.distribute_value(prec_blk_key_map[srprec], blk_pcts, key, int(value), srprec)
+                    except:
+                        pass
+    return prec_blk_key_map
+
+def test_datasets_rows_same_as_baseline():
+    for seed in range(6):
+        source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed, datasets=True)
+        assert any("datasets" in row for row in source_props_map.values())
+        expected = json.dumps(disaggregate.make_final_blk_map(log, baseline_prec_blk_key_map(prec_blk_pct_map, source_props_map)))
+        for engine in ("dict", "crosswalk"):
+            assert json.dumps(disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, engine)) == expected
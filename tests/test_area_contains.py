@@ -0,0 +1,184 @@
+# area_contains: the bulk, prepared, hierarchical, sharded and nearest mapping paths against the 2019 per-source loop
+# (make_target_source_allmap), on synthetic geometry (see cases.make_shapes)
+
+import numpy as np
+import pytest
+import shapely
+
+from disaggagg import area_contains
+
+from cases import make_shapes
+
+def overlaps(contains_map):
+    """ contains_map with (source key, pct) items (the loop version's single-candidate items have no third element) """
+    return {key: [(item[0], item[1]) for item in items] for key, items in contains_map.items()}
+
+def loop_allmap(precincts, blocks, **kwargs):
+    return area_contains.make_target_source_allmap(precincts, blocks, "PKEY", "GEOID20", False, "FL", 2020, False, **kwargs)
+
+def bulk_allmap(precincts, blocks, **kwargs):
+    return area_contains.make_target_source_allmap_bulk(precincts, blocks, "PKEY", "GEOID20", False, "FL", 2020, False, **kwargs)
+
+def fail_for(monkeypatch, module, name, bad):
+    """ Makes module's (shapely or shapely.lib) name (e.g. "intersection") throw, as GEOS can, for any pair with the geometry bad in it """
+    op = getattr(module, name)
+    def failing(a, b, *args, **kwargs):
+        if any(geom is bad for geom in np.atleast_1d(np.asarray(a, dtype=object))) or any(geom is bad for geom in np.atleast_1d(np.asarray(b, dtype=object))):
+            raise shapely.errors.GEOSException("TopologyException: side location conflict")
+        return op(a, b, *args, **kwargs)
+    monkeypatch.setattr(module, name, failing)
+
+@pytest.mark.parametrize("geometry_repaired", [False, True])
+def test_failed_intersection_falls_back_to_contains_overlaps(monkeypatch, geometry_repaired):
+    precincts, blocks = make_shapes(9)
+    expected = overlaps(loop_allmap(precincts, blocks)[0])
+    bad_key = next(key for key, items in expected.items() if sum(1 for srckey, pct in items if pct > 0) > 1)      # a split block
+    bad = blocks.geometry.values[blocks["GEOID20"].tolist().index(bad_key)]
+    fail_for(monkeypatch, shapely, "intersection", bad)
+    fail_for(monkeypatch, shapely.lib, "intersection_scalar", bad)
+
+    loop_map = overlaps(loop_allmap(precincts, blocks, geometry_repaired=geometry_repaired)[0])
+    bulk_map = overlaps(bulk_allmap(precincts, blocks, geometry_repaired=geometry_repaired)[0])
+    assert bulk_map == loop_map
+    source_shapes = dict(zip(precincts["PKEY"], precincts.geometry))
+    assert bulk_map[bad_key] == [(srckey, area_contains.overlap_fallback(source_shapes[srckey], bad)) for srckey, pct in expected[bad_key]]
+    assert {key: items for key, items in bulk_map.items() if key != bad_key} == {key: items for key, items in expected.items() if key != bad_key}
+
+    # contains/overlaps throw, too: the block's pairs are logged and left out
+    fail_for(monkeypatch, shapely.lib, "contains_scalar", bad)
+    loop_map = overlaps(loop_allmap(precincts, blocks, geometry_repaired=geometry_repaired)[0])
+    bulk_map = overlaps(bulk_allmap(precincts, blocks, geometry_repaired=geometry_repaired)[0])
+    assert bulk_map == loop_map and bulk_map[bad_key] == []
+
+def final_map(res_tuple, source_is_block_group=False):
+    return area_contains.make_final_map(res_tuple, source_is_block_group)
+
+def test_bulk_same_as_loop():
+    for seed in range(4):
+        precincts, blocks = make_shapes(seed, holes=seed % 3)
+        expected = loop_allmap(precincts, blocks)
+        for chunk_size in (100000, 50):
+            result = bulk_allmap(precincts, blocks, chunk_size=chunk_size)
+            assert overlaps(result[0]) == overlaps(expected[0])
+            assert list(result[0]) == list(expected[0]) and result[1] == expected[1]
+            assert final_map(result) == final_map(expected)
+
+def test_bulk_same_as_loop_with_index_keys():
+    precincts, blocks = make_shapes(5)
+    precincts = precincts.set_index("PKEY")
+    expected = area_contains.make_target_source_allmap(precincts, blocks, None, "GEOID20", True, "FL", 2020, False)
+    result = area_contains.make_target_source_allmap_bulk(precincts, blocks, None, "GEOID20", True, "FL", 2020, False)
+    assert overlaps(result[0]) == overlaps(expected[0]) and result[1] == expected[1]
+
+def logged_count(output, label):
+    """ The last count logged (log.dprint without a log file prints the args tuple) with label """
+    lines = [line for line in output.splitlines() if line.startswith("('" + label)]
+    return int(lines[-1].split(",")[1].strip(" )'\\n"))
+
+def test_prepared_fast_path_same_as_intersections(capsys):
+    for seed in range(3):
+        precincts, blocks = make_shapes(seed)
+        expected = loop_allmap(precincts, blocks)
+        loop_prepared = loop_allmap(precincts, blocks, use_prepared=True)
+        bulk_prepared = bulk_allmap(precincts, blocks, use_prepared=True)
+        assert overlaps(bulk_prepared[0]) == overlaps(loop_prepared[0])
+        assert logged_count(capsys.readouterr().out, "Interior (no intersection needed) count") > 0
+        for key, items in overlaps(bulk_prepared[0]).items():
+            expected_items = overlaps(expected[0])[key]
+            assert [srckey for srckey, pct in items] == [srckey for srckey, pct in expected_items]
+            for (srckey, pct), (expected_srckey, expected_pct) in zip(items, expected_items):
+                if pct != expected_pct:
+                    # an interior block: 1.0 without the intersection
+                    assert pct == 1.0 and expected_pct == pytest.approx(1.0)
+        assert final_map(bulk_prepared) == final_map(expected)
+
+def test_hierarchical_same_as_loop(capsys, tmp_path):
+    for seed in range(3):
+        precincts, blocks = make_shapes(seed)
+        expected = final_map(loop_allmap(precincts, blocks))
+        blkgrp_shapes = area_contains.make_block_group_shapes(blocks, "GEOID20")
+        assert final_map(bulk_allmap(precincts, blocks, blkgrp_shapes=blkgrp_shapes)) == expected
+        assert logged_count(capsys.readouterr().out, "Block groups within a single source") > 0
+        assert final_map(bulk_allmap(precincts, blocks, blkgrp_shapes=blkgrp_shapes, use_prepared=True)) == expected
+
+    # block group shapes from a file with its own key
+    blkgrp_path = str(tmp_path / "blkgrps.geojson")
+    blkgrp_shapes.rename(columns={"blkgrp": "BGKEY"}).to_file(blkgrp_path)
+    file_blkgrp_shapes = area_contains.make_block_group_shapes(blocks, "GEOID20", blkgrp_path, "BGKEY")
+    assert sorted(file_blkgrp_shapes["blkgrp"]) == sorted(blkgrp_shapes["blkgrp"])
+    assert final_map(bulk_allmap(precincts, blocks, blkgrp_shapes=file_blkgrp_shapes)) == expected
+
+def test_hierarchical_map_writes_no_overlap_table(tmp_path):
+    precincts, blocks = make_shapes(4)
+    precinct_path, block_path = str(tmp_path / "precincts.geojson"), str(tmp_path / "blocks.geojson")
+    precincts.to_file(precinct_path)
+    blocks.to_file(block_path)
+    overlap_path = str(tmp_path / "overlap.npz")
+    result = area_contains.make_target_source_map(precinct_path, block_path, "PKEY", "GEOID20", False, "FL", 2020, False,
+                                                  overlap_path=overlap_path, hierarchical=True)
+    assert result == final_map(loop_allmap(precincts, blocks))
+    assert not (tmp_path / "overlap.npz").exists()
+
+    area_contains.make_target_source_map(precinct_path, block_path, "PKEY", "GEOID20", False, "FL", 2020, False, overlap_path=overlap_path, bulk_query=True)
+    assert area_contains.make_target_source_map_from_overlap(overlap_path) == result
+
+def test_sharded_same_as_single_process():
+    precincts, blocks = make_shapes(6)
+    for bulk_query in (False, True):
+        expected = area_contains.make_allmap(precincts, blocks, "PKEY", "GEOID20", False, "FL", 2020, False, bulk_query=bulk_query)
+        result = area_contains.make_target_source_allmap_sharded(precincts, blocks, "PKEY", "GEOID20", False, "FL", 2020, False, 2, bulk_query=bulk_query)
+        assert overlaps(result[0]) == overlaps(expected[0]) and result[1] == expected[1]
+        assert list(result[0]) == list(expected[0])
+    blkgrp_shapes = area_contains.make_block_group_shapes(blocks, "GEOID20")
+    result = area_contains.make_target_source_allmap_sharded(precincts, blocks, "PKEY", "GEOID20", False, "FL", 2020, False, 2, blkgrp_shapes=blkgrp_shapes)
+    assert final_map(result) == final_map(loop_allmap(precincts, blocks))
+
+def test_maps_same_as_separate_maps(tmp_path):
+    precincts, blocks = make_shapes(3)
+    other_precincts = make_shapes(7)[0].rename(columns={"PKEY": "DKEY"})
+    paths = {name: str(tmp_path / (name + ".geojson")) for name in ("precincts", "other", "blocks")}
+    precincts.to_file(paths["precincts"])
+    other_precincts.to_file(paths["other"])
+    blocks.to_file(paths["blocks"])
+    for options in ({}, {"bulk_query": True}, {"hierarchical": True}, {"nearest_fallback": True}):
+        larger_list = [(paths["precincts"], "PKEY", False, False, str(tmp_path / "source.npz"), None),
+                       (paths["other"], "DKEY", False, False, str(tmp_path / "dest.npz"), None)]
+        result = area_contains.make_target_source_maps(larger_list, paths["blocks"], "GEOID20", "FL", 2020, False, **options)
+        if not "hierarchical" in options:
+            assert [area_contains.make_target_source_map_from_overlap(larger[4]) for larger in larger_list] == result
+        expected = [area_contains.make_target_source_map(larger_path, paths["blocks"], larger_key, "GEOID20", False, "FL", 2020, False, **options)
+                    for larger_path, larger_key, use_index, source_is_block_group, overlap_path, overlap_metadata in larger_list]
+        assert result == expected
+        assert result[0] != result[1]
+
+def brute_force_nearest(contains_map, precincts, blocks, max_distance=None, same_county=False):
+    """ {block key: nearest precinct key (lowest position on ties)} for the blocks of contains_map that overlap nothing """
+    source_keys = precincts["PKEY"].tolist()
+    county_sources = {}
+    for key, items in contains_map.items():
+        for item in items:
+            if item[1] > 0:
+                county_sources.setdefault(key[2:5], set()).add(item[0])
+    nearest = {}
+    for key, geom in zip(blocks["GEOID20"], blocks.geometry):
+        if len(contains_map[key]) > 0:
+            continue
+        candidates = [(shapely.distance(precinct, geom), pos) for pos, precinct in enumerate(precincts.geometry)
+                      if not same_county or source_keys[pos] in county_sources.get(key[2:5], set())]
+        candidates = [candidate for candidate in candidates if max_distance == None or candidate[0] <= max_distance]
+        if len(candidates) > 0:
+            nearest[key] = source_keys[min(candidates)[1]]
+    return nearest
+
+@pytest.mark.parametrize("options", [{}, {"max_distance": 3.5}, {"same_county": True}, {"max_distance": 1.5, "same_county": True}])
+def test_nearest_same_as_brute_force(options):
+    for seed in range(3):
+        precincts, blocks = make_shapes(seed, holes=2)
+        contains_map = loop_allmap(precincts, blocks)[0]
+        expected = brute_force_nearest(contains_map, precincts, blocks, **options)
+        orphans = [key for key, items in contains_map.items() if len(items) == 0]
+        count = area_contains.assign_nearest_sources(contains_map, precincts, blocks, "PKEY", "GEOID20", False, **options)
+        assert count == len(expected) and count > 0
+        assert {key: contains_map[key] for key in orphans if len(contains_map[key]) > 0} == {key: [(srckey, 0, None)] for key, srckey in expected.items()}
+        if "max_distance" in options:
+            assert len(expected) < len(orphans)
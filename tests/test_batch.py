@@ -0,0 +1,61 @@
+# Batch runner: jobs in reused worker processes, each with its own log, failures reported in the summary
+
+import os
+import json
+import multiprocessing
+
+import pytest
+
+from disaggagg import agg_logging as log
+from disaggagg import batch
+from disaggagg import disagg_agg
+
+pytestmark = pytest.mark.skipif(not ("fork" in multiprocessing.get_all_start_methods()), reason="the workers see the stubs only when forked")
+
+@pytest.fixture
+def working_path(tmp_path, monkeypatch):
+    """ prepare.get_paths puts every job in tmp_path; process_state logs one line, and fails for state 'XX' before it sets up its log """
+    def get_paths(root_paths, state, isElections, year, isCVAP, destyear, isACS):
+        paths = dict.fromkeys(("source_geo_path", "source_data_path", "block_geo_path", "dest_geo_path", "dest_data_path", "block_pop_path",
+                               "block2source_map_path", "block2dest_map_path", "block_data_from_source_path", "block_data_from_dest_path",
+                               "agg_data_from_source_path"))
+        paths["working_path"] = str(tmp_path) + "/" + state + "_"
+        return paths
+
+    def process_state(root_paths, state, steps, state_codes, year, destyear, config):
+        if state == "XX":
+            raise ValueError("no such state")
+        log.set_output(get_paths(root_paths, state, True, year, False, destyear, False)["working_path"] + disagg_agg.make_logfile_name(steps, year, destyear, config), "Test Logging")
+        log.dprint("Job ", state)
+
+    monkeypatch.setattr(disagg_agg.prepare, "get_paths", get_paths, raising=False)
+    monkeypatch.setattr(disagg_agg, "process_state", process_state)
+    return str(tmp_path) + "/"
+
+def test_jobs_run_in_reused_workers(working_path):
+    # one worker: the failing job runs after a job that logged to its own file, in the same process
+    history_path = working_path + "history.json"
+    with open(history_path, "w") as outf:
+        json.dump({"GA_output3_2020to2020_elec_fulldisagg": 3, "XX_output3_2020to2020_elec_fulldisagg": 2}, outf)
+    summary = batch.run_batch({}, ["GA", "XX", "MI"], [(2020, 2020, {})], [3], workers=1, history_path=history_path, state_codes={})
+    assert [row["state"] for row in summary] == ["GA", "XX", "MI"]
+    assert [row["status"] for row in summary] == ["ok", "ValueError: no such state", "ok"]
+    for row in summary:
+        assert row["seconds"] != None and row["peak_mb"] > 0
+    for state in ("GA", "MI"):
+        with open(summary[["GA", "XX", "MI"].index(state)]["log"]) as log_file:
+            assert log_file.read().splitlines() == ["Test Logging", "Job " + state]
+    with open(history_path) as json_file:
+        assert sorted(json.load(json_file)) == ["GA_output3_2020to2020_elec_fulldisagg", "MI_output3_2020to2020_elec_fulldisagg",
+                                                "XX_output3_2020to2020_elec_fulldisagg"]
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="the peak memory count is only reset on Linux")
+def test_peak_memory_is_per_job():
+    batch.reset_peak_memory()
+    before = batch.peak_memory_mb()
+    big = bytearray(200 << 20)
+    big[::4096] = b"x" * len(big[::4096])
+    assert batch.peak_memory_mb() >= before + 150
+    del big
+    batch.reset_peak_memory()
+    assert batch.peak_memory_mb() < before + 150
@@ -0,0 +1,190 @@
+# Block registry: ordinals, encode/decode round trips, and the compact maps path (segments, dests by ordinal) against the dict versions
+
+import json
+import random
+import numpy as np
+import pytest
+
+from disaggagg import agg_logging as log
+from disaggagg import aggregate
+from disaggagg import block_registry
+from disaggagg import crosswalk
+from disaggagg import disaggregate
+
+from cases import make_case, shuffle_rows, ok_to_agg
+
+def random_block_map(rnd, num_blocks=200, num_keys=30, lists=True):
+    blocks = ["06" + str(rnd.randint(0, 10 ** 13)).zfill(13) for b in range(num_blocks)]
+    keys = ["K" + str(k) for k in range(num_keys)] + [""]
+    if lists:
+        return {block: rnd.sample(keys, min(len(keys), rnd.choice([1, 1, 1, 2, 3]))) for block in blocks}
+    return {block: rnd.choice(keys) for block in blocks}
+
+def test_register_and_lookup():
+    registry = block_registry.make_registry(["B", "A", "C"])
+    assert block_registry.lookup(registry, ["A", "B", "C", "D"]).tolist() == [1, 0, 2, -1]
+    # New blocks get the next ordinals, in order of first appearance; existing ordinals don't change
+    assert block_registry.register(registry, ["E", "A", "D", "E"]).tolist() == [3, 1, 4, 3]
+    assert block_registry.block_ids(registry, np.array([4, 0, 3])) == ["D", "B", "E"]
+    assert block_registry.lookup(block_registry.make_registry(), ["A"]).tolist() == [-1]
+
+def test_block_map_round_trip():
+    rnd = random.Random(1)
+    for lists in (True, False):
+        for trial in range(20):
+            block_map = random_block_map(rnd, lists=lists)
+            registry = block_registry.make_registry()
+            encoded = block_registry.encode_block_map(registry, block_map)
+            assert encoded["blocks"].dtype == np.int32 and encoded["codes"].dtype == np.int32
+            assert json.dumps(block_registry.decode_block_map(registry, encoded)) == json.dumps(block_map)
+
+def test_empty_lists_dropped():
+    registry = block_registry.make_registry()
+    encoded = block_registry.encode_block_map(registry, {"A": ["X"], "B": [], "C": ["Y", "X"]})
+    assert block_registry.decode_block_map(registry, encoded) == {"A": ["X"], "C": ["Y", "X"]}
+
+def test_dest_index_same_as_from_file(tmp_path):
+    rnd = random.Random(2)
+    block_map = random_block_map(rnd)
+    path = tmp_path / "block_map.json"
+    with open(path, "w") as outf:
+        json.dump(block_map, outf)
+    registry = block_registry.make_registry()
+    ids, codes, dests = block_registry.make_dest_index(registry, block_registry.encode_block_map(registry, block_map))
+    file_ids, file_codes, file_dests = aggregate.make_dest_index(str(path))
+    assert ids.tolist() == file_ids.tolist()
+    assert [dests[code] for code in codes.tolist()] == [file_dests[code] for code in file_codes.tolist()]
+    blocks = list(block_map) + ["nope"]
+    assert aggregate.lookup_dests((ids, codes, dests), blocks) == aggregate.lookup_dests((file_ids, file_codes, file_dests), blocks)
+
+def test_weights_round_trip():
+    rnd = random.Random(3)
+    registry = block_registry.make_registry(["X"])
+    block_pop_map = {"06" + str(b).zfill(13): rnd.randint(0, 100) for b in range(50)}
+    weights = block_registry.encode_block_weights(registry, block_pop_map)
+    assert weights["columns"] == None and weights["values"].dtype == np.int32
+    ordinals = block_registry.lookup(registry, list(block_pop_map) + ["X", "nope"])
+    values, known = block_registry.weight_values(weights, ordinals)
+    assert values[:, 0].tolist() == list(block_pop_map.values()) + [0, 0]
+    assert known.tolist() == [True] * len(block_pop_map) + [False, False]
+
+    multi = {block: {"TOT": rnd.randint(0, 100), "VAP": rnd.random()} for block in block_pop_map}
+    weights = block_registry.encode_block_weights(registry, multi)
+    assert weights["columns"] == ["TOT", "VAP"] and weights["values"].dtype == np.float64
+    values, known = block_registry.weight_values(weights, block_registry.lookup(registry, list(multi)), ("VAP", "CVAP", "TOT"))
+    assert values.tolist() == [[row["VAP"], 0, row["TOT"]] for row in multi.values()]
+
+def in_order(pct_maps):
+    return [[(prec, list(blk_pcts.items())) for prec, blk_pcts in pct_map.items()] for pct_map in pct_maps]
+
+def test_pct_maps_same_as_dict_version():
+    rnd = random.Random(4)
+    for trial in range(50):
+        block_map = random_block_map(rnd, num_blocks=rnd.randint(1, 100), num_keys=rnd.randint(1, 20))
+        blocks = list(block_map)
+        block_pop_map = {block: rnd.choice([0, 0, rnd.randint(0, 50)]) for block in blocks if rnd.random() < 0.9}
+        prec_blks = {}
+        for block, keys in block_map.items():
+            for key in keys:
+                if key != "":
+                    prec_blks.setdefault(key, {})[block] = 0
+        expected = disaggregate.make_prec_pct_map(log, prec_blks, block_pop_map)
+        registry = block_registry.make_registry()
+        encoded = block_registry.encode_block_map(registry, block_map)
+        segments = block_registry.make_prec_segments(registry, encoded, block_registry.encode_block_weights(registry, block_pop_map))
+        assert segments[1].dtype == np.int64 and segments[2].dtype == np.int32
+        result = block_registry.segment_pct_maps(registry, *segments)
+        assert in_order(result) == in_order(expected)       # (pcts are floats here, where the dict version has some int 0s and 1s)
+
+def test_dest_codes():
+    rnd = random.Random(6)
+    block_map = random_block_map(rnd)
+    registry = block_registry.make_registry(["X"])
+    dest_codes = block_registry.make_dest_codes(registry, block_registry.encode_block_map(registry, block_map))
+    blocks = list(block_map) + ["X", "nope"]
+    codes = block_registry.lookup_dest_codes(registry, dest_codes, blocks)
+    assert [dest_codes[1][code] if code >= 0 else None for code in codes.tolist()] == [crosswalk.block_dest(block_map, block) for block in blocks]
+    ordinals = block_registry.lookup(registry, blocks[:-1])
+    assert block_registry.lookup_dest_codes(registry, dest_codes, ordinals=ordinals).tolist() == codes[:-1].tolist()
+
+def compact_case(seed, multi=False, datasets=False):
+    """ A make_case block ==> precincts map with block weights, as dicts and encoded """
+    rnd = random.Random(seed)
+    source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed)
+    block_map = {}
+    for prec, blk_pcts in prec_blk_pct_map.items():
+        for block in blk_pcts:
+            block_map.setdefault(block, []).append(prec)
+    block_map.update({block: [""] for block in list(block_map)[:3]})
+    if multi:
+        block_pop_map = {block: {"TOT": rnd.choice([0, rnd.randint(0, 50)]), "VAP": rnd.randint(0, 30)} for block in block_map if rnd.random() < 0.95}
+    else:
+        block_pop_map = {block: rnd.choice([0, rnd.randint(0, 50)]) for block in block_map if rnd.random() < 0.95}
+    if datasets:
+        for row in list(source_props_map.values())[::4]:
+            row["datasets"] = {"D10F": {"Tot": rnd.randint(0, 99), "Wh": rnd.randint(0, 9)}}
+    registry = block_registry.make_registry()
+    encoded_map = block_registry.encode_block_map(registry, block_map)
+    encoded_dests = block_registry.encode_block_map(registry, dest_block_map)
+    weights = block_registry.encode_block_weights(registry, block_pop_map)
+    return source_props_map, block_map, block_pop_map, dest_block_map, registry, encoded_map, weights, encoded_dests
+
+def dict_disaggregate(source_props_map, block_map, block_pop_map, engine, sink=None, **kwargs):
+    """ make_block_props_map's dict forms path """
+    prec_blks = {}
+    for block, precs in block_map.items():
+        for prec in precs:
+            if prec != "":
+                prec_blks.setdefault(prec, {})[block] = 0
+    pct_map, weight_maps, prop_weights = disaggregate.make_prec_pct_maps(log, prec_blks, block_pop_map, source_props_map, **kwargs)
+    return disaggregate.disaggregate_precs(log, pct_map, source_props_map, ok_to_agg, engine, sink, weight_maps, prop_weights)
+
+def compact_disaggregate(source_props_map, registry, encoded_map, weights, engine, sink=None, **kwargs):
+    """ make_block_props_map's compact maps path """
+    columns, prop_weights = disaggregate.make_weight_columns(log, weights["columns"], source_props_map, **kwargs)
+    segments = block_registry.make_prec_segments(registry, encoded_map, weights, tuple(columns))
+    return disaggregate.disaggregate_segments(log, registry, segments, columns, source_props_map, ok_to_agg, engine, sink, prop_weights)
+
+def test_compact_disaggregation_same_as_dict_version():
+    for seed in range(12):
+        multi = seed % 3 == 1
+        kwargs = {"weight_rules": (("P[0-3]", "VAP"),), "default_weight": "TOT"} if multi else {}
+        source_props_map, block_map, block_pop_map, dest_block_map, registry, encoded_map, weights, encoded_dests = compact_case(seed, multi, seed % 3 == 2)
+        for engine in ("dict", "crosswalk"):
+            expected = dict_disaggregate(source_props_map, block_map, block_pop_map, engine, **kwargs)
+            assert json.dumps(compact_disaggregate(source_props_map, registry, encoded_map, weights, engine, **kwargs)) == json.dumps(expected)
+
+            acc = aggregate.make_accumulator(dest_block_map, "DKEY", ok_to_agg)
+            dict_disaggregate(source_props_map, block_map, block_pop_map, engine, acc, **kwargs)
+            compact_acc = aggregate.make_accumulator(block_registry.make_dest_codes(registry, encoded_dests), "DKEY", ok_to_agg, registry)
+            assert compact_disaggregate(source_props_map, registry, encoded_map, weights, engine, compact_acc, **kwargs) == None
+            assert json.dumps(aggregate.make_feature_collection(compact_acc)) == json.dumps(aggregate.make_feature_collection(acc))
+            assert compact_acc["props_total"] == acc["props_total"]
+            if engine == "crosswalk":       # (the dict engine's sink counts a block once per precinct it gets values from)
+                assert compact_acc["props_count"] == acc["props_count"]
+
+def test_compact_accumulator_by_block_id():
+    source_props_map, block_map, block_pop_map, dest_block_map, registry, encoded_map, weights, encoded_dests = compact_case(7)
+    block_props = shuffle_rows(dict_disaggregate(source_props_map, block_map, block_pop_map, "dict"), 7)
+    block_props["not-a-block"] = {"TOT": 5, "P1": 2}
+    results = []
+    for acc in (aggregate.make_accumulator(dest_block_map, "DKEY", ok_to_agg),
+                aggregate.make_accumulator(block_registry.make_dest_codes(registry, encoded_dests), "DKEY", ok_to_agg, registry)):
+        aggregate.add_block_props(acc, block_props, engine="dict" if acc["registry"] == None else "crosswalk")
+        results.append((json.dumps(aggregate.make_feature_collection(acc)), acc["props_total"], acc["props_count"]))
+    assert results[1] == results[0]
+
+def test_weight_rule_column_not_in_table_uses_default_column():
+    source_props_map, block_map, block_pop_map, dest_block_map, registry, encoded_map, weights, encoded_dests = compact_case(4, True)
+    typo = {"weight_rules": (("P[0-3]", "VPA"),), "default_weight": "TOT"}
+    for engine in ("dict", "crosswalk"):
+        expected = json.dumps(dict_disaggregate(source_props_map, block_map, block_pop_map, engine))
+        assert json.dumps(dict_disaggregate(source_props_map, block_map, block_pop_map, engine, **typo)) == expected
+        assert json.dumps(compact_disaggregate(source_props_map, registry, encoded_map, weights, engine, **typo)) == expected
+
+def test_default_weight_column_not_in_table_is_an_error():
+    source_props_map, block_map, block_pop_map, dest_block_map, registry, encoded_map, weights, encoded_dests = compact_case(4, True)
+    with pytest.raises(ValueError):
+        dict_disaggregate(source_props_map, block_map, block_pop_map, "dict", default_weight="POP")
+    with pytest.raises(ValueError):
+        compact_disaggregate(source_props_map, registry, encoded_map, weights, "dict", default_weight="POP")
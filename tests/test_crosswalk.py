@@ -0,0 +1,76 @@
+# The crosswalk (sparse matrix) engine against the dict engine: same block data and aggregates, down to the json they're written as
+
+import json
+import random
+import numpy as np
+
+from disaggagg import agg_logging as log
+from disaggagg import aggregate
+from disaggagg import crosswalk
+from disaggagg import disaggregate
+
+from cases import make_case, shuffle_rows, ok_to_agg
+
+def test_disaggregate_same_as_dict_engine():
+    for seed in range(20):
+        source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed)
+        expected = disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, "dict")
+        result = disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, "crosswalk")
+        assert json.dumps(result) == json.dumps(expected)
+
+def test_disaggregate_with_weight_columns():
+    rnd = random.Random(5)
+    source_props_map, prec_blk_pct_map, dest_block_map = make_case(5)
+    blocks = {block for blk_pcts in prec_blk_pct_map.values() for block in blk_pcts}
+    block_pop_map = {block: {"TOT": rnd.randint(0, 50), "VAP": rnd.randint(0, 30)} for block in sorted(blocks)}
+    kwargs = {"weight_rules": (("P[0-3]", "VAP"),), "default_weight": "TOT"}
+    prec_blks = {prec: dict.fromkeys(blk_pcts, 0) for prec, blk_pcts in prec_blk_pct_map.items()}
+    pct_map, weight_maps, prop_weights = disaggregate.make_prec_pct_maps(log, prec_blks, block_pop_map, source_props_map, **kwargs)
+    assert list(weight_maps) == ["VAP"]
+    expected = disaggregate.disaggregate_precs(log, pct_map, source_props_map, ok_to_agg, "dict", None, weight_maps, prop_weights)
+    result = disaggregate.disaggregate_precs(log, pct_map, source_props_map, ok_to_agg, "crosswalk", None, weight_maps, prop_weights)
+    assert json.dumps(result) == json.dumps(expected)
+
+def aggregated(dest_block_map, block_props, engine, srcIsGeojson=False):
+    acc = aggregate.make_accumulator(dest_block_map, "DKEY", ok_to_agg)
+    aggregate.add_block_props(acc, block_props, srcIsGeojson, engine)
+    return json.dumps(aggregate.make_feature_collection(acc)), acc["props_total"], acc["props_count"]
+
+def test_aggregate_same_as_dict_engine():
+    for seed in range(20):
+        source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed)
+        block_props = shuffle_rows(disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg), seed)
+        assert aggregated(dest_block_map, block_props, "crosswalk") == aggregated(dest_block_map, block_props, "dict")
+
+def test_aggregate_geojson_same_as_dict_engine():
+    source_props_map, prec_blk_pct_map, dest_block_map = make_case(3)
+    block_props = disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg)
+    features = [{"type": "Feature", "geometry": None, "properties": dict(row, GEOID=block)} for block, row in block_props.items()]
+    geojson = {"type": "FeatureCollection", "features": features + features[:10]}     # a block can be in a geojson more than once
+    assert aggregated(dest_block_map, geojson, "crosswalk", True) == aggregated(dest_block_map, geojson, "dict", True)
+
+def test_disaggregate_into_sink_same_as_dict_engine():
+    for seed in range(10):
+        source_props_map, prec_blk_pct_map, dest_block_map = make_case(seed)
+        results = []
+        for engine in ("dict", "crosswalk"):
+            acc = aggregate.make_accumulator(dest_block_map, "DKEY", ok_to_agg)
+            assert disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, engine, acc) == None
+            results.append(json.dumps(aggregate.make_feature_collection(acc)))
+        assert results[1] == results[0]
+
+def test_sink_same_as_aggregating_the_block_data():
+    source_props_map, prec_blk_pct_map, dest_block_map = make_case(7)
+    acc = aggregate.make_accumulator(dest_block_map, "DKEY", ok_to_agg)
+    disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, "crosswalk", acc)
+    block_props = disaggregate.disaggregate_precs(log, prec_blk_pct_map, source_props_map, ok_to_agg, "crosswalk")
+    assert json.loads(aggregated(dest_block_map, block_props, "crosswalk")[0]) == aggregate.make_feature_collection(acc)
+
+def test_first_seen_orders():
+    # dest 0: rows A, B then B, C; dest 1: rows C, A; unit 4 isn't mapped
+    layouts, ranks = crosswalk.row_layouts([{"A": 1, "B": 1}, {"B": 1, "C": 1}, {"C": 1, "A": 1}, {"A": 1, "B": 1}, {"C": 1}], ["A", "B", "C"])
+    assert layouts.tolist() == [0, 1, 2, 0, 3]
+    present = ranks[layouts] >= 0
+    dest_present = present[[0, 1]].any(axis=0), present[[2, 3]].any(axis=0)
+    dest_orders, orders = crosswalk.first_seen_orders(np.array([0, 0, 1, 1, -1]), present, layouts, ranks, np.array(dest_present))
+    assert [orders[o] for o in dest_orders.tolist()] == [(0, 1, 2), (2, 0, 1)]
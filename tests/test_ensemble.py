@@ -0,0 +1,62 @@
+# ensemble.make_assignments / aggregate_plans against per block lookups
+
+import random
+
+import numpy as np
+
+from disaggagg import crosswalk
+from disaggagg import ensemble
+
+def loop_assignments(block_keys, plans):
+    """ make_assignments as a plain loop over plans x blocks """
+    district_ordinals = {}
+    assignments = np.full((len(plans), len(block_keys)), -1, dtype=np.int32)
+    for p, plan in enumerate(plans):
+        for b, block in enumerate(block_keys):
+            district = crosswalk.block_dest(plan, block)
+            if district != None:
+                assignments[p, b] = district_ordinals.setdefault(district, len(district_ordinals))
+    return assignments, list(district_ordinals.keys())
+
+def make_plans(seed, block_keys, num_plans=6):
+    rnd = random.Random(seed)
+    plans = []
+    for p in range(num_plans):
+        districts = [rnd.randrange(1, 8) for _ in range(3)] + ["D" + str(rnd.randrange(3))]
+        blocks = rnd.sample(block_keys, rnd.randrange(len(block_keys) + 1)) + ["not-a-block"]
+        if p % 2 == 0:
+            plans.append({block: [rnd.choice(districts)] for block in blocks})
+        else:
+            plans.append({block: rnd.choice(districts) for block in blocks})
+    plans.append({})
+    return plans
+
+def test_make_assignments():
+    for seed in range(10):
+        block_keys = ["b" + str(b) for b in range(40)]
+        plans = make_plans(seed, block_keys)
+        assignments, districts = ensemble.make_assignments(block_keys, plans)
+        expected, expected_districts = loop_assignments(block_keys, plans)
+        assert districts == expected_districts
+        assert assignments.dtype == np.int32
+        assert np.array_equal(assignments, expected)
+
+def test_aggregate_plans():
+    block_keys = ["b" + str(b) for b in range(40)]
+    plans = make_plans(3, block_keys)
+    values = np.arange(len(block_keys) * 2, dtype=np.int64).reshape(len(block_keys), 2)
+    assignments, districts = ensemble.make_assignments(block_keys, plans)
+    totals = ensemble.aggregate_plans(values, assignments, len(districts))
+    for p, plan in enumerate(plans):
+        for d, district in enumerate(districts):
+            rows = [b for b, block in enumerate(block_keys) if crosswalk.block_dest(plan, block) == district]
+            assert totals[p, d].tolist() == values[rows].sum(axis=0).tolist()
+
+def test_load_block_matrix_keys(tmp_path):
+    path = tmp_path / "blocks.json"
+    path.write_text('{"b1": {"TOT": 3, "VAP": 1}, "b0": {"TOT": 2}, "b1": {"TOT": 4}}')
+    block_keys, props, values = ensemble.load_block_matrix(str(path), lambda prop: True)
+    assert block_keys == ["b1", "b0"] and props == ["TOT", "VAP"]
+    assert values.tolist() == [[7, 1], [2, 0]]
+    block_keys, props, values = ensemble.load_block_matrix(str(path), lambda prop: True, block_keys=np.array(["b0", "b2", "b1"]))
+    assert values.tolist() == [[2, 0], [0, 0], [7, 1]]
@@ -0,0 +1,58 @@
+# geo_cache: key-column reads and the GeoParquet cache
+
+import os
+import importlib.util
+
+import geopandas as gpd
+import pytest
+from pyproj import CRS
+from shapely.geometry import box
+
+from disaggagg import geo_cache
+
+@pytest.fixture
+def blocks_path(tmp_path):
+    blocks = gpd.GeoDataFrame({"GEOID20": ["1200100010011" + str(10 + b) for b in range(6)], "POP": range(6), "NAME": list("abcdef")},
+                              geometry=[box(x, y, x + 1, y + 1) for y in range(2) for x in range(3)], crs="EPSG:3857")
+    path = str(tmp_path / "blocks.shp")
+    blocks.to_file(path)
+    return path
+
+def test_read_columns_keeps_key_and_geometry_in_file_order(blocks_path):
+    shapes = geo_cache.read_columns(blocks_path, ["GEOID20"])
+    expected = gpd.read_file(blocks_path)
+    assert list(shapes.columns) == ["GEOID20", "geometry"]
+    assert shapes["GEOID20"].tolist() == expected["GEOID20"].tolist()
+    assert shapes.geometry.geom_equals(expected.geometry).all()
+
+def test_read_columns_without_pyarrow(blocks_path, monkeypatch):
+    pyogrio = pytest.importorskip("pyogrio")
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name, *args: None if name == "pyarrow" else find_spec(name, *args))
+    monkeypatch.setattr(pyogrio.raw, "HAS_PYARROW", False)     # as pyogrio is without pyarrow: use_arrow ==> RuntimeError
+    shapes = geo_cache.read_columns(blocks_path, ["GEOID20"], bbox=(0, 0, 1.5, 0.5))
+    assert shapes["GEOID20"].tolist() == ["120010001001110", "120010001001111"]
+
+def test_cached_copy_is_read_back(blocks_path, tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    cache_dir = str(tmp_path / "geo_cache") + "/"
+    shapes = geo_cache.read_geo(blocks_path, ["GEOID20"], crs=CRS("EPSG:4326"), cache_dir=cache_dir)
+    def read_columns(*args):
+        raise AssertionError("the original file was read again")
+    monkeypatch.setattr(geo_cache, "read_columns", read_columns)
+    cached = geo_cache.read_geo(blocks_path, ["GEOID20"], crs=CRS("EPSG:4326"), cache_dir=cache_dir)
+    assert cached["GEOID20"].tolist() == shapes["GEOID20"].tolist()
+    assert cached.crs == shapes.crs and cached.geometry.geom_equals_exact(shapes.geometry, 1e-12).all()
+
+def test_cache_key_is_path_size_and_mtime(blocks_path, tmp_path, monkeypatch):
+    def content_hash(path):
+        raise AssertionError("the file's content was hashed")
+    monkeypatch.setattr(geo_cache.manifest, "content_hash", content_hash)
+    cache_dir = str(tmp_path / "geo_cache")
+    key_path = geo_cache.cache_path(cache_dir, blocks_path, None, ["GEOID20"])
+    assert geo_cache.cache_path(cache_dir, blocks_path, None, ["GEOID20"]) == key_path
+    assert geo_cache.cache_path(cache_dir, blocks_path, None, ["GEOID20"], bbox=(0, 0, 1, 1)) != key_path
+    dbf_path = blocks_path[:-4] + ".dbf"
+    stat = os.stat(dbf_path)
+    os.utime(dbf_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert geo_cache.cache_path(cache_dir, blocks_path, None, ["GEOID20"]) != key_path
@@ -0,0 +1,38 @@
+# json_stream.iter_items against json.load, with chunks small enough to cut every token somewhere
+
+import json
+
+from disaggagg import json_stream
+
+block_data = {
+    "060014001001000": {"TOT": 12.5, "VAP": -3e-7, "X": 1E+10, "Y": 0.000125, "Z": -12, "E": 2.5e3},
+    "060014001001001": {"NAME": "Café \"A\", \\ 1", "ok": True, "no": False, "none": None, "list": [1.75, [], {}, -0.5]},
+    "060014001001002": {},
+    "060014001001003": 123456789.125,
+    "060014001001004": [-1e-3, 7]
+}
+
+def write(tmp_path, obj, indent=None):
+    path = tmp_path / "data.json"
+    with open(path, "w", encoding="utf-8") as outf:
+        json.dump(obj, outf, indent=indent, ensure_ascii=False)
+    return str(path)
+
+def test_members_with_small_chunks(tmp_path):
+    for indent in (None, 1):
+        path = write(tmp_path, block_data, indent)
+        for chunk_size in range(1, 48):
+            assert list(json_stream.iter_items(path, chunk_size=chunk_size)) == list(block_data.items()), chunk_size
+
+def test_array_member_with_small_chunks(tmp_path):
+    features = [{"type": "Feature", "geometry": None, "properties": dict(row, GEOID=block)} for block, row in block_data.items() if isinstance(row, dict)]
+    path = write(tmp_path, {"type": "FeatureCollection", "crs": {"x": 1.5}, "features": features, "bbox": [0.5, 1e2]})
+    for chunk_size in range(1, 48):
+        assert list(json_stream.iter_items(path, "features", chunk_size)) == list(enumerate(features)), chunk_size
+
+def test_empty(tmp_path):
+    assert list(json_stream.iter_items(write(tmp_path, {}), chunk_size=1)) == []
+    assert list(json_stream.iter_items(write(tmp_path, {"features": []}), "features", 1)) == []
+
+def test_load_in_memory():
+    assert json_stream.load(block_data) is block_data
@@ -0,0 +1,137 @@
+# Content-hash manifest: which changes make a step stale (see manifest.is_current and disagg_agg.check_manifest)
+
+import os
+
+import pytest
+
+from disaggagg import manifest
+from disaggagg import disagg_agg
+
+def write(path, text, mtime_ns=None):
+    with open(path, "w") as outf:
+        outf.write(text)
+    if mtime_ns != None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = {
+        "source_geo_path": str(tmp_path / "precs.geojson"),
+        "block_geo_path": str(tmp_path / "blocks.geojson"),
+        "block2source_map_path": str(tmp_path / "block_to_source_map.json"),
+        "working_path": str(tmp_path) + "/"
+    }
+    for key in ("dest_geo_path", "block2dest_map_path", "source_data_path", "dest_data_path", "block_pop_path", "block_data_from_source_path",
+                "block_data_from_dest_path", "agg_data_from_source_path"):
+        paths[key] = None      # not read or written by step 1
+    write(paths["source_geo_path"], "precincts")
+    write(paths["block_geo_path"], "blocks")
+    return paths
+
+def run_step(step_manifest, paths, config):
+    """ check_manifest / record as run_steps_with_manifest does for step 1; returns whether the step was current """
+    current, input_hashes, outputs, params = disagg_agg.check_manifest(step_manifest, 1, paths, config, "FL", 2020, 2020)
+    if not current:
+        write(paths["block2source_map_path"], "map")
+        manifest.record(step_manifest, 1, input_hashes, outputs, params)
+    return current
+
+def test_unchanged_step_is_current(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    assert not run_step(step_manifest, paths, {})
+    assert run_step(step_manifest, paths, {})
+
+def test_changed_option_makes_step_stale(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    run_step(step_manifest, paths, {"preparedFastPath": False})
+    assert not run_step(step_manifest, paths, {"preparedFastPath": True})
+    assert not run_step(step_manifest, paths, {"preparedFastPath": True, "geoCache": True})
+    assert run_step(step_manifest, paths, {"preparedFastPath": True, "geoCache": True})
+
+def test_runtime_option_keeps_step_current(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    run_step(step_manifest, paths, {})
+    assert run_step(step_manifest, paths, {"mapWorkers": 4, "useManifest": True})
+
+def test_changed_input_content_makes_step_stale(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    run_step(step_manifest, paths, {})
+    os.utime(paths["source_geo_path"])
+    assert run_step(step_manifest, paths, {})       # touched, not changed
+    write(paths["source_geo_path"], "precincts, edited", os.stat(paths["source_geo_path"]).st_mtime_ns)
+    assert not run_step(step_manifest, paths, {})
+
+def test_changed_output_makes_step_stale(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    run_step(step_manifest, paths, {})
+    write(paths["block2source_map_path"], "another map")
+    assert not run_step(step_manifest, paths, {})
+
+def test_file_hash_reuses_hash_of_unchanged_file(paths):
+    step_manifest = {"files": {}, "steps": {}}
+    sha1 = manifest.file_hash(step_manifest, paths["block_geo_path"])
+    step_manifest["files"][paths["block_geo_path"]]["sha1"] = "known"
+    assert manifest.file_hash(step_manifest, paths["block_geo_path"]) == "known"
+    write(paths["block_geo_path"], "blocks, edited")
+    assert manifest.file_hash(step_manifest, paths["block_geo_path"]) != sha1
+
+def write_block_map_inputs(tmp_path):
+    """ Two precincts side by side, a 4x2 grid of blocks under them and a block off to the east that overlaps neither """
+    import geopandas as gpd
+    from shapely.geometry import box
+    precincts = gpd.GeoDataFrame({"PKEY": ["A", "B"]}, geometry=[box(0, 0, 2, 2), box(2, 0, 4, 2)], crs="EPSG:3857")
+    blocks = [box(x, y, x + 1, y + 1) for y in range(2) for x in range(4)] + [box(5, 0, 6, 1)]
+    blocks = gpd.GeoDataFrame({"GEOID20": ["120010001001" + str(100 + b) for b in range(len(blocks))]}, geometry=blocks, crs="EPSG:3857")
+    precincts.to_file(str(tmp_path / "precs.geojson"), driver="GeoJSON")
+    blocks.to_file(str(tmp_path / "blocks.geojson"), driver="GeoJSON")
+    return str(tmp_path / "precs.geojson"), str(tmp_path / "blocks.geojson"), "120010001001108"
+
+def test_remade_map_does_not_reuse_overlap_table_of_other_options(tmp_path):
+    import json
+    precs_path, blocks_path, orphan = write_block_map_inputs(tmp_path)
+    block2geo_path = str(tmp_path / "block_to_source_map.json")
+    def make_block_map(map_options):
+        # as a step the manifest decided to run does (see run_steps_with_manifest)
+        disagg_agg.make_block_map("FL", "12", precs_path, "PKEY", blocks_path, "GEOID20", block2geo_path, 2020, False, map_options=map_options, saveOverlap=True, remake=True)
+        with open(block2geo_path) as json_file:
+            return json.load(json_file)
+
+    assert make_block_map({"nearest_fallback": False})[orphan] == [""]
+    assert make_block_map({"nearest_fallback": True})[orphan] == ["B"]
+    assert make_block_map({"nearest_fallback": False})[orphan] == [""]
+
+def write_overlap_table(paths, overlap_path, map_options, metadata=True):
+    """ Writes a (dummy) overlap table as make_block_map does; returns its metadata (see disagg_agg.overlap_table_metadata) """
+    from disaggagg import area_contains
+    overlap_metadata = disagg_agg.overlap_table_metadata(overlap_path, paths["source_geo_path"], "PKEY", paths["block_geo_path"], "GEOID20", False, map_options)
+    area_contains.write_overlap_table(overlap_path, {"120010001001100": [("A", 1.0)]}, {"A"}, overlap_metadata if metadata else None)
+    return overlap_metadata
+
+def table_is_current(paths, overlap_path, map_options):
+    overlap_metadata = disagg_agg.overlap_table_metadata(overlap_path, paths["source_geo_path"], "PKEY", paths["block_geo_path"], "GEOID20", False, map_options)
+    return disagg_agg.overlap_table_is_current(overlap_path, overlap_metadata)
+
+@pytest.mark.parametrize("changed", [{"nearest_fallback": True}, {"use_prepared": True}, {"repair_geometry": True}, {"cache_dir": "cache/"},
+                                     {"hierarchical": True}])
+def test_overlap_table_stale_after_option_change(paths, tmp_path, changed):
+    overlap_path = str(tmp_path / "overlap.npz")
+    map_options = {"bulk_query": True, "nearest_fallback": False, "use_prepared": False, "repair_geometry": False, "cache_dir": None, "workers": 1}
+    write_overlap_table(paths, overlap_path, map_options)
+    assert table_is_current(paths, overlap_path, map_options)
+    assert not table_is_current(paths, overlap_path, dict(map_options, **changed))
+    assert table_is_current(paths, overlap_path, dict(map_options, workers=4))
+
+def test_overlap_table_stale_after_content_change(paths, tmp_path):
+    overlap_path = str(tmp_path / "overlap.npz")
+    mtime_ns = os.stat(paths["block_geo_path"]).st_mtime_ns
+    write_overlap_table(paths, overlap_path, {})
+    os.utime(paths["block_geo_path"], ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert table_is_current(paths, overlap_path, {})        # touched: hashed again, same content
+    write(paths["block_geo_path"], "blocks, edited", mtime_ns)
+    assert not table_is_current(paths, overlap_path, {})
+
+def test_overlap_table_without_metadata_not_current(paths, tmp_path):
+    overlap_path = str(tmp_path / "overlap.npz")
+    write_overlap_table(paths, overlap_path, {}, metadata=False)
+    assert not table_is_current(paths, overlap_path, {})
+    assert not table_is_current(paths, str(tmp_path / "missing.npz"), {})
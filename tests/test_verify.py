@@ -0,0 +1,73 @@
+# disagg_agg_verify totals against the 2019 row by row loops
+
+import math
+
+import pandas as pd
+
+from disaggagg import disagg_agg_verify
+
+def baseline_source_totals(source_data, ok_to_agg):
+    """ The 2019 source loop: float() of each cell, cells that fail skipped, NaN added in """
+    totals = {}
+    for i in source_data.index:
+        for key in source_data.keys():
+            try:
+                value = source_data.loc[i, key]
+                if key == "datasets":
+                    for ds in ("D10F", "D10T"):
+                        if ds in value:
+                            for f, v in value[ds].items():
+                                fm = disagg_agg_verify.fmap(f, ds)
+                                totals[fm] = totals[fm] + float(v) if fm in totals else float(v)
+                elif ok_to_agg(key):
+                    num = float(value)
+                    totals[key] = totals[key] + num if key in totals else num
+            except:
+                pass
+    return totals
+
+def baseline_agg_totals(agg_data):
+    """ The 2019 aggregated data loop: NaN skipped """
+    totals = {}
+    for i in agg_data.index:
+        for key in agg_data.keys():
+            try:
+                num = float(agg_data.loc[i, key])
+                if not math.isnan(num):
+                    totals[key] = totals[key] + num if key in totals else num
+            except:
+                pass
+    return totals
+
+def source_frame():
+    return pd.DataFrame({
+        "GEOID": ["a", "b", "c", "d"],
+        "POP": [10, 20, 30, 40],
+        "VAP": [1.5, math.nan, 2.25, 4.0],
+        "EMPTY": [math.nan] * 4,
+        "MIXED": ["12", "x", 3, None],
+        "NAME": ["p", "q", "r", "s"],
+        "datasets": [{"D10F": {"Tot": 5, "Wh": 1}, "D10T": {"Tot": 4}}, {"D10F": {"Tot": 6}}, {}, {"D10F": {"Tot": math.nan, "Wh": 2}}]
+    })
+
+def ok_to_agg(prop):
+    return prop not in ("GEOID", "NAME")
+
+def test_source_totals_vs_baseline():
+    source_data = source_frame()
+    expected = baseline_source_totals(source_data, ok_to_agg)
+    totals = disagg_agg_verify.column_totals(source_data, [key for key in source_data.columns if key != "datasets" and ok_to_agg(key)])
+    for key, total in disagg_agg_verify.datasets_totals(source_data["datasets"]).items():
+        totals[key] = totals[key] + total if key in totals else total
+
+    # Cells without NaN: same totals
+    assert {key: totals[key] for key in ("POP", "MIXED", "WH", "TOT18")} == {key: expected[key] for key in ("POP", "MIXED", "WH", "TOT18")}
+    # NaN cells: the baseline total went NaN; now they're skipped (and an all NaN column is left out)
+    assert math.isnan(expected["VAP"]) and totals["VAP"] == 7.75
+    assert math.isnan(expected["TOT"]) and totals["TOT"] == 11
+    assert math.isnan(expected["EMPTY"]) and "EMPTY" not in totals
+    assert sorted(totals) == sorted(key for key in expected if key != "EMPTY")
+
+def test_agg_totals_vs_baseline():
+    agg_data = source_frame().drop(columns=["datasets"])
+    assert disagg_agg_verify.column_totals(agg_data) == baseline_agg_totals(agg_data)